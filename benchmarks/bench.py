@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+"""Benchmark a whole prepuller run against a fake Kubernetes API and a
+fake tag registry, and report wall time, time per phase, API calls and
+peak memory.
+
+Run from a checkout with the prepuller installed (pip install -e .):
+
+    python benchmarks/bench.py --scenario scale
+    python benchmarks/bench.py --nodes 200 --pull-latency 0.2 --json
+
+With --replicas, several prepullers split the nodes between them
+through --sharding hash, as separate replicas would.  Only the thread
+engine and the pod backend are exercised.
+"""
+import argparse
+import copy
+import json
+import random
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from fakekube import FakeKube
+from fakeregistry import FakeRegistry
+from prepuller.metrics import InstrumentedApi
+from prepuller.prepuller import Prepuller
+
+SCENARIOS = {
+    "small": {"nodes": 10, "tags": 500, "dailies": 3, "weeklies": 2,
+              "releases": 1},
+    "medium": {"nodes": 100, "tags": 2000, "dailies": 6, "weeklies": 3,
+               "releases": 1},
+    # The scale we need to support: 1000 nodes by 20 images.
+    "scale": {"nodes": 1000, "tags": 5000, "dailies": 15, "weeklies": 4,
+              "releases": 1},
+}
+
+
+class BenchPrepuller(Prepuller):
+    """A Prepuller whose Kubernetes client is a FakeKube.
+    """
+
+    def __init__(self, kube, args=None):
+        self.kube = kube
+        super(BenchPrepuller, self).__init__(args=args)
+
+    def _load_config(self):
+        return self.kube.namespace
+
+    def _make_client(self):
+        self.api_client = None
+        self.client = self._rate_limited(InstrumentedApi(self.kube,
+                                                         self.metrics))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS),
+                        default="small",
+                        help="Preset for nodes, tags and retention [small]")
+    parser.add_argument("--nodes", type=int, help="Number of nodes")
+    parser.add_argument("--tags", type=int,
+                        help="Number of tags in the registry")
+    parser.add_argument("--dailies", type=int, help="Dailies to keep")
+    parser.add_argument("--weeklies", type=int, help="Weeklies to keep")
+    parser.add_argument("--releases", type=int, help="Releases to keep")
+    parser.add_argument("--present", type=float, default=0.0,
+                        help="Chance that a node already has each image [0]")
+    parser.add_argument("--pull-latency", type=float, default=0.05,
+                        help="Seconds to pull an image [0.05]")
+    parser.add_argument("--jitter", type=float, default=0.2,
+                        help="Pull latency spread, as a fraction [0.2]")
+    parser.add_argument("--schedule-latency", type=float, default=0.001,
+                        help="Seconds before a pod is scheduled [0.001]")
+    parser.add_argument("--failure-rate", type=float, default=0.0,
+                        help="Fraction of pods that fail [0]")
+    parser.add_argument("--api-error-rate", type=float, default=0.0,
+                        help="Fraction of API writes that raise a 500 [0]")
+    parser.add_argument("--server-write-qps", type=int, default=0,
+                        help=("Writes a second the fake API server takes" +
+                              " before answering 429 [no limit]"))
+    parser.add_argument("--api-write-qps", type=float, default=20,
+                        help="Prepuller --api-write-qps [20]")
+    parser.add_argument("--api-read-qps", type=float, default=50,
+                        help="Prepuller --api-read-qps [50]")
+    parser.add_argument("--node-disk", default="100Gi",
+                        help="Ephemeral storage of each node [100Gi]")
+    parser.add_argument("--disk-budget", type=float,
+                        help="Prepuller --disk-budget [no limit]")
+    parser.add_argument("--registry-latency", type=float, default=0.0,
+                        help="Seconds to answer each tag page [0]")
+    parser.add_argument("--registry-failure-rate", type=float, default=0.0,
+                        help="Fraction of tag pages that fail [0]")
+    parser.add_argument("--node-concurrency", type=int, default=1,
+                        help="Prepuller --node-concurrency [1]")
+    parser.add_argument("--max-in-flight", type=int, default=50,
+                        help="Prepuller --max-in-flight [50]")
+    parser.add_argument("--scan-workers", type=int, default=8,
+                        help="Prepuller --scan-workers [8]")
+    parser.add_argument("--incremental-scan", action="store_true",
+                        help="Prepuller --incremental-scan")
+    parser.add_argument("--pull-order", default="priority",
+                        choices=["priority", "layers", "name"],
+                        help="Prepuller --pull-order [priority]")
+    parser.add_argument("--repull", action="store_true",
+                        help="Prepuller --repull")
+    parser.add_argument("--no-pin-digests", dest="pin_digests",
+                        action="store_false",
+                        help="Prepuller --no-pin-digests")
+    parser.add_argument("--registry-auth", action="store_true",
+                        help="Make registry API requests need a bearer" +
+                        " token")
+    parser.add_argument("--registry-api", choices=["hub", "registry"],
+                        default="hub",
+                        help="Prepuller --registry-api [hub]")
+    parser.add_argument("--replicas", type=int, default=1,
+                        help="Prepuller replicas sharing the nodes [1]")
+    parser.add_argument("--member-ttl", type=int, default=3,
+                        help="Prepuller --member-ttl with --replicas [3]")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help=("Also report peak Python heap use via" +
+                              " tracemalloc (slows the run)"))
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Random seed [0]")
+    parser.add_argument("--json", action="store_true",
+                        help="Print the report as JSON")
+    parser.add_argument("-d", "--debug", action="store_true",
+                        help="Debug logging from the prepuller")
+    opts = parser.parse_args()
+    for key, value in SCENARIOS[opts.scenario].items():
+        if getattr(opts, key) is None:
+            setattr(opts, key, value)
+    return opts
+
+
+def prepuller_args(opts, registry, replica=0):
+    args = copy.copy(Prepuller.args)
+    args.debug = opts.debug
+    args.repo = "127.0.0.1"
+    args.port = str(registry.port)
+    args.insecure = True
+    args.owner = registry.owner
+    args.name = registry.name
+    args.registry_api = opts.registry_api
+    args.path = registry.path
+    if opts.registry_api == "registry":
+        args.path = registry.tag_list_path
+    args.dailies = opts.dailies
+    args.weeklies = opts.weeklies
+    args.releases = opts.releases
+    args.namespace = FakeKube.namespace
+    args.timeout = -1
+    args.node_concurrency = opts.node_concurrency
+    args.max_in_flight = opts.max_in_flight
+    args.scan_workers = opts.scan_workers
+    args.incremental_scan = opts.incremental_scan
+    args.pull_order = opts.pull_order
+    args.api_write_qps = opts.api_write_qps
+    args.api_read_qps = opts.api_read_qps
+    args.disk_budget = opts.disk_budget
+    args.pin_digests = opts.pin_digests
+    args.repull = opts.repull
+    if opts.replicas > 1:
+        args.sharding = "hash"
+        args.replica_id = "bench-replica-%d" % replica
+        args.member_ttl = opts.member_ttl
+    return args
+
+
+def present_images(opts, registry, nodes):
+    """Put each tag on each node with probability opts.present, named as
+    the kubelet would report it.
+    """
+    if not opts.present:
+        return {}
+    rng = random.Random(opts.seed)
+    prefix = "127.0.0.1:%d/%s/%s" % (registry.port, registry.owner,
+                                     registry.name)
+    present = {}
+    for idx in range(nodes):
+        name = "bench-node-%05d" % idx
+        present[name] = []
+        for tag in registry.tags:
+            if rng.random() < opts.present:
+                present[name].append(prefix + ":" + tag["name"])
+                present[name].append(prefix + "@" + registry.digest(
+                    tag["name"]))
+    return present
+
+
+def metric_sum(pps, name, **labels):
+    """Add up a metric across replicas, over the series whose labels
+    include those given.
+    """
+    return sum([y["value"] for x in pps for y in x.metrics.to_dict()["metrics"]
+                if y["name"] == name and
+                all([y["labels"].get(k) == labels[k] for k in labels])])
+
+
+def run_replica(kube, opts, registry, replica, results):
+    pp = BenchPrepuller(kube, args=prepuller_args(opts, registry, replica))
+    try:
+        pp.update_images_from_repo()
+        pp.build_nodelist()
+        pp.build_plan()
+        pp.clean_completed_pods()
+        failures = pp.run_pods()
+    finally:
+        if pp.shard:
+            pp.shard.leave()
+    results[replica] = (pp, failures or [])
+
+
+def run(opts):
+    registry = FakeRegistry(tags=opts.tags, seed=opts.seed,
+                            latency=opts.registry_latency,
+                            auth=opts.registry_auth,
+                            failure_rate=opts.registry_failure_rate).start()
+    kube = FakeKube(nodes=opts.nodes,
+                    present=present_images(opts, registry, opts.nodes),
+                    resolve=lambda x: registry.digest(x.rsplit(":", 1)[1]),
+                    seed=opts.seed,
+                    pull_latency=opts.pull_latency,
+                    jitter=opts.jitter,
+                    schedule_latency=opts.schedule_latency,
+                    failure_rate=opts.failure_rate,
+                    api_error_rate=opts.api_error_rate,
+                    write_qps=opts.server_write_qps,
+                    disk=opts.node_disk).start()
+    if opts.trace_memory:
+        tracemalloc.start()
+    start = time.time()
+    results = {}
+    try:
+        threads = [threading.Thread(target=run_replica,
+                                    args=(kube, opts, registry, x, results))
+                   for x in range(opts.replicas)]
+        for thd in threads:
+            thd.start()
+        for thd in threads:
+            thd.join()
+        wall = time.time() - start
+    finally:
+        kube.stop()
+        registry.stop()
+    if len(results) < opts.replicas:
+        raise RuntimeError("%d of %d replicas failed" % (
+            opts.replicas - len(results), opts.replicas))
+    pps = [results[x][0] for x in sorted(results)]
+    pp = pps[0]
+    report = {"scenario": opts.scenario,
+              "nodes": opts.nodes,
+              "tags": opts.tags,
+              "images": len(pp.images),
+              "replicas": opts.replicas,
+              "nodes_per_replica": [len(x.nodes) for x in pps],
+              "pulls": sum([sum([len(x.plan[y]) for y in x.plan])
+                            for x in pps]),
+              "skipped": sum([sum([len(x.skipped[y]) for y in x.skipped])
+                              for x in pps]),
+              "over_budget": sum([sum([len(x.over_budget[y])
+                                       for y in x.over_budget])
+                                  for x in pps]),
+              # Pulls that raised, which includes those that timed out,
+              # and pods that ran and failed, which do not raise.
+              "failures": (sum([len(results[x][1]) for x in results]) +
+                           metric_sum(pps, "prepuller_pulls_total",
+                                      phase="Failed")),
+              "pulls_by_phase": dict([
+                  (x, metric_sum(pps, "prepuller_pulls_total", phase=x))
+                  for x in ["Succeeded", "Failed", "Deleted"]]),
+              "timeouts": metric_sum(pps, "prepuller_failures_total",
+                                     kind="pod_timeout"),
+              "wall_seconds": round(wall, 3),
+              "phases": {},
+              "api_calls": dict(kube.calls),
+              "api_throttled": kube.throttled,
+              "api_retries": metric_sum(pps,
+                                        "prepuller_api_retries_total"),
+              "registry_requests": registry.requests,
+              "registry_not_modified": registry.not_modified,
+              "manifest_requests": registry.manifest_requests,
+              "kubelet_registry_pulls": kube.registry_pulls,
+              "expected_bytes": sum([sum(x.expected_bytes.values())
+                                     for x in pps]),
+              "peak_pods": kube.peak_pods,
+              # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+              "peak_rss_kb": resource.getrusage(
+                  resource.RUSAGE_SELF).ru_maxrss}
+    if sys.platform == "darwin":
+        report["peak_rss_kb"] //= 1024
+    # The slowest replica's time for each phase.
+    phases = report["phases"]
+    for item in [y for x in pps for y in x.metrics.to_dict()["metrics"]]:
+        if item["name"] == "prepuller_phase_duration_seconds":
+            phase = item["labels"]["phase"]
+            phases[phase] = max(phases.get(phase, 0),
+                                round(item["value"], 3))
+    if opts.trace_memory:
+        report["peak_heap_kb"] = tracemalloc.get_traced_memory()[1] // 1024
+        tracemalloc.stop()
+    return report
+
+
+def print_report(report):
+    print("Scenario %s: %d nodes, %d tags, %d images" % (
+        report["scenario"], report["nodes"], report["tags"],
+        report["images"]))
+    if report["replicas"] > 1:
+        print("  %d replicas with %s nodes" % (
+            report["replicas"],
+            ", ".join([str(x) for x in report["nodes_per_replica"]])))
+    print("  pulls %d, skipped %d, over budget %d, failed %d" % (
+        report["pulls"], report["skipped"], report["over_budget"],
+        report["failures"]))
+    print("    %s; %d timed out" % (", ".join(
+        ["%d %s" % (report["pulls_by_phase"][x], x)
+         for x in sorted(report["pulls_by_phase"])]), report["timeouts"]))
+    print("  wall time %.3f s" % report["wall_seconds"])
+    for phase in sorted(report["phases"]):
+        print("    %-10s %.3f s" % (phase, report["phases"][phase]))
+    print("  API calls %d (%d throttled, %d retried)" % (
+        sum(report["api_calls"].values()), report["api_throttled"],
+        report["api_retries"]))
+    for verb in sorted(report["api_calls"]):
+        print("    %-34s %d" % (verb, report["api_calls"][verb]))
+    print("  registry requests %d (%d not modified, %d manifests)" % (
+        report["registry_requests"], report["registry_not_modified"],
+        report["manifest_requests"]))
+    if report["expected_bytes"]:
+        print("  expected bytes %d" % report["expected_bytes"])
+    print("  kubelet registry round-trips %d" % (
+        report["kubelet_registry_pulls"]))
+    print("  peak pods %d" % report["peak_pods"])
+    print("  peak RSS %d KiB" % report["peak_rss_kb"])
+    if "peak_heap_kb" in report:
+        print("  peak heap %d KiB" % report["peak_heap_kb"])
+
+
+def main():
+    opts = parse_args()
+    report = run(opts)
+    if opts.json:
+        print(json.dumps(report, sort_keys=True, indent=4))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
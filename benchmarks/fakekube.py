@@ -0,0 +1,449 @@
+"""In-memory stand-in for the parts of the Kubernetes CoreV1 API that the
+prepuller uses, with a simulated kubelet that moves pods through their
+phases after configurable delays.  ConfigMaps are kept too, with
+resource version checks on replace, for replica coordination.
+"""
+import copy
+import datetime
+import heapq
+import itertools
+import json
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _parse_selector(selector):
+    """Turn "a=b,c=d" into a list of (key, value) pairs.  Only equality
+    is supported, which is all the prepuller uses.
+    """
+    pairs = []
+    for term in (selector or "").split(","):
+        if term:
+            k, v = term.split("=", 1)
+            pairs.append((k.strip(), v.strip()))
+    return pairs
+
+
+class FakeWatchResponse(object):
+    """Looks enough like an unpreloaded urllib3 response for
+    kubernetes.watch to stream events from it.
+    """
+
+    def __init__(self, kube, queue, timeout):
+        self.kube = kube
+        self.queue = queue
+        self.deadline = time.time() + (timeout or 3600)
+        self.closed = False
+
+    def read_chunked(self, decode_content=False):
+        while not self.closed and time.time() < self.deadline:
+            with self.kube._cond:
+                if not self.queue:
+                    self.kube._cond.wait(min(1.0, max(
+                        0, self.deadline - time.time())))
+                lines = list(self.queue)
+                self.queue.clear()
+            for line in lines:
+                yield line
+
+    def close(self):
+        self.closed = True
+        self.kube._unsubscribe(self.queue)
+
+    def release_conn(self):
+        pass
+
+
+class FakeKube(object):
+    """A fake CoreV1Api holding nodes and pods in memory.
+
+    Pods created here are scheduled after `schedule_latency` seconds,
+    start once their image is pulled, and finish `run_latency` seconds
+    later; a pull takes `pull_latency` seconds, give or take `jitter` (a
+    fraction), or `check_latency` if the node already has the image, or
+    no time at all if it has it and the pull policy is IfNotPresent.
+    Pulls that go to the registry are counted in `registry_pulls`.  As
+    with a default kubelet, each node pulls one image at a time.  A
+    `failure_rate` fraction of pods end "Failed", and an `api_error_rate`
+    fraction of write calls raise a 500.  Write calls beyond `write_qps`
+    in any one second get a 429 with a Retry-After, as from an API server
+    applying priority and fairness.  Nodes have `disk` of ephemeral
+    storage, and every image on them takes 1 GiB.
+    """
+    namespace = "bench"
+    schedule_latency = 0.001
+    pull_latency = 0.05
+    check_latency = 0.002
+    run_latency = 0.001
+    jitter = 0.2
+    failure_rate = 0.0
+    api_error_rate = 0.0
+    write_qps = 0
+    disk = "100Gi"
+    history = 10000
+    hostname_label = "kubernetes.io/hostname"
+
+    def __init__(self, nodes=10, present=None, resolve=None, seed=0,
+                 **kwargs):
+        for key in kwargs:
+            if not hasattr(self, key):
+                raise TypeError("Unknown setting '%s'" % key)
+            setattr(self, key, kwargs[key])
+        self.random = random.Random(seed)
+        # resolve(image) gives the digest an image tag points to, if any.
+        self.resolve = resolve
+        self.calls = {}
+        self.nodes = {}
+        self.pods = {}
+        self.configmaps = {}
+        self.node_free = {}
+        self.resource_version = 0
+        self.events = deque(maxlen=self.history)
+        self.expired = 0
+        self.watchers = []
+        self.peak_pods = 0
+        self.throttled = 0
+        self.registry_pulls = 0
+        self._window = (0, 0)
+        self._serializer = client.ApiClient()
+        self._cond = threading.Condition()
+        self._timers = []
+        self._seq = itertools.count()
+        self._thread = None
+        self._stopping = False
+        for idx in range(nodes):
+            name = "bench-node-%05d" % idx
+            images = []
+            for img in (present or {}).get(name, []):
+                images.append(client.V1ContainerImage(names=[img],
+                                                      size_bytes=1 << 30))
+            self.nodes[name] = client.V1Node(
+                metadata=client.V1ObjectMeta(
+                    name=name, labels={self.hostname_label: name},
+                    resource_version=self._next_version()),
+                spec=client.V1NodeSpec(unschedulable=False),
+                status=client.V1NodeStatus(
+                    images=images,
+                    capacity={"ephemeral-storage": self.disk},
+                    allocatable={"ephemeral-storage": self.disk},
+                    conditions=[client.V1NodeCondition(type="Ready",
+                                                       status="True")]))
+
+    def start(self):
+        self._stopping = False
+        self._thread = threading.Thread(target=self._kubelet,
+                                        name="fake-kubelet")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+
+    # Bookkeeping
+
+    def _count(self, verb):
+        with self._cond:
+            self.calls[verb] = self.calls.get(verb, 0) + 1
+
+    def _next_version(self):
+        self.resource_version += 1
+        return str(self.resource_version)
+
+    def _maybe_fail(self):
+        if self.write_qps:
+            with self._cond:
+                second = int(time.time())
+                writes = 1
+                if self._window[0] == second:
+                    writes += self._window[1]
+                self._window = (second, writes)
+                if writes > self.write_qps:
+                    self.throttled += 1
+                    exc = ApiException(status=429,
+                                       reason="Too Many Requests")
+                    exc.headers = {"Retry-After": "1"}
+                    raise exc
+        if self.api_error_rate and self.random.random() < self.api_error_rate:
+            raise ApiException(status=500, reason="Injected failure")
+
+    def _emit(self, etype, pod):
+        # Call with the condition held.
+        pod.metadata.resource_version = self._next_version()
+        line = json.dumps({"type": etype,
+                           "object":
+                           self._serializer.sanitize_for_serialization(pod)})
+        line += "\n"
+        if len(self.events) == self.events.maxlen:
+            self.expired = self.events[0][0]
+        self.events.append((self.resource_version, line))
+        for queue in self.watchers:
+            queue.append(line)
+        self._cond.notify_all()
+
+    def _subscribe(self, resource_version):
+        # Call with the condition held.
+        queue = deque()
+        if resource_version:
+            rv = int(resource_version)
+            if rv < self.expired:
+                queue.append(json.dumps({
+                    "type": "ERROR",
+                    "object": {"kind": "Status", "code": 410,
+                               "message": "too old resource version"}}) +
+                    "\n")
+                return queue
+            queue.extend([x[1] for x in self.events if x[0] > rv])
+        self.watchers.append(queue)
+        return queue
+
+    def _unsubscribe(self, queue):
+        with self._cond:
+            if queue in self.watchers:
+                self.watchers.remove(queue)
+
+    def _page(self, items, limit, cont):
+        start = int(cont or 0)
+        if limit:
+            page = items[start:start + limit]
+            if start + limit < len(items):
+                return page, str(start + limit)
+            return page, None
+        return items[start:], None
+
+    def _pod_matches(self, pod, label_selector, field_selector):
+        labels = pod.metadata.labels or {}
+        for k, v in _parse_selector(label_selector):
+            if labels.get(k) != v:
+                return False
+        for k, v in _parse_selector(field_selector):
+            if k == "status.phase" and pod.status.phase != v:
+                return False
+            if k == "spec.nodeName" and pod.spec.node_name != v:
+                return False
+        return True
+
+    # The API
+
+    def list_node(self, label_selector=None, limit=None, _continue=None,
+                  watch=False, resource_version=None, **kwargs):
+        """list or watch objects of kind Node
+
+        :return: V1NodeList
+        """
+        self._count("watch" if watch else "list_node")
+        with self._cond:
+            if watch:
+                return FakeWatchResponse(self, deque(),
+                                         kwargs.get("timeout_seconds"))
+            items = [self.nodes[x] for x in sorted(self.nodes)]
+            pairs = _parse_selector(label_selector)
+            items = [x for x in items
+                     if all([(x.metadata.labels or {}).get(k) == v
+                             for k, v in pairs])]
+            items, cont = self._page(items, limit, _continue)
+            return client.V1NodeList(
+                items=items,
+                metadata=client.V1ListMeta(
+                    _continue=cont,
+                    resource_version=str(self.resource_version)))
+
+    def list_namespaced_pod(self, namespace, label_selector=None,
+                            field_selector=None, limit=None, _continue=None,
+                            watch=False, resource_version=None, **kwargs):
+        """list or watch objects of kind Pod
+
+        :return: V1PodList
+        """
+        self._count("watch" if watch else "list_namespaced_pod")
+        with self._cond:
+            if watch:
+                return FakeWatchResponse(self,
+                                         self._subscribe(resource_version),
+                                         kwargs.get("timeout_seconds"))
+            items = [self.pods[x] for x in sorted(self.pods)
+                     if self._pod_matches(self.pods[x], label_selector,
+                                          field_selector)]
+            items, cont = self._page(items, limit, _continue)
+            return client.V1PodList(
+                items=items,
+                metadata=client.V1ListMeta(
+                    _continue=cont,
+                    resource_version=str(self.resource_version)))
+
+    def read_namespaced_pod(self, name, namespace, **kwargs):
+        self._count("read_namespaced_pod")
+        with self._cond:
+            if name not in self.pods:
+                raise ApiException(status=404, reason="Not Found")
+            return self.pods[name]
+
+    def create_namespaced_pod(self, namespace, body, **kwargs):
+        self._count("create_namespaced_pod")
+        self._maybe_fail()
+        with self._cond:
+            name = body.metadata.name
+            if name in self.pods:
+                raise ApiException(status=409, reason="AlreadyExists")
+            if body.spec.node_name not in self.nodes:
+                raise ApiException(status=422, reason="No such node")
+            pod = client.V1Pod(
+                metadata=client.V1ObjectMeta(
+                    name=name, namespace=namespace, uid=str(uuid.uuid4()),
+                    labels=dict(body.metadata.labels or {}),
+                    creation_timestamp=_now()),
+                spec=body.spec,
+                status=client.V1PodStatus(phase="Pending", conditions=[]))
+            self.pods[name] = pod
+            self.peak_pods = max(self.peak_pods, len(self.pods))
+            self._emit("ADDED", pod)
+            self._later(self.schedule_latency, self._schedule, name)
+            return pod
+
+    def delete_namespaced_pod(self, name, namespace, body=None, **kwargs):
+        self._count("delete_namespaced_pod")
+        self._maybe_fail()
+        with self._cond:
+            pod = self.pods.pop(name, None)
+            if not pod:
+                raise ApiException(status=404, reason="Not Found")
+            self._emit("DELETED", pod)
+            return client.V1Status(status="Success")
+
+    def delete_collection_namespaced_pod(self, namespace, label_selector=None,
+                                         field_selector=None, **kwargs):
+        self._count("delete_collection_namespaced_pod")
+        with self._cond:
+            for name in sorted(self.pods):
+                pod = self.pods[name]
+                if self._pod_matches(pod, label_selector, field_selector):
+                    del self.pods[name]
+                    self._emit("DELETED", pod)
+            return client.V1Status(status="Success")
+
+    def read_namespaced_config_map(self, name, namespace, **kwargs):
+        self._count("read_namespaced_config_map")
+        with self._cond:
+            if name not in self.configmaps:
+                raise ApiException(status=404, reason="Not Found")
+            return copy.deepcopy(self.configmaps[name])
+
+    def create_namespaced_config_map(self, namespace, body, **kwargs):
+        self._count("create_namespaced_config_map")
+        with self._cond:
+            name = body.metadata.name
+            if name in self.configmaps:
+                raise ApiException(status=409, reason="AlreadyExists")
+            cm = copy.deepcopy(body)
+            cm.metadata.resource_version = self._next_version()
+            self.configmaps[name] = cm
+            return copy.deepcopy(cm)
+
+    def replace_namespaced_config_map(self, name, namespace, body,
+                                      **kwargs):
+        self._count("replace_namespaced_config_map")
+        with self._cond:
+            current = self.configmaps.get(name)
+            if not current:
+                raise ApiException(status=404, reason="Not Found")
+            if (body.metadata.resource_version and
+                    body.metadata.resource_version !=
+                    current.metadata.resource_version):
+                raise ApiException(status=409, reason="Conflict")
+            cm = copy.deepcopy(body)
+            cm.metadata.resource_version = self._next_version()
+            self.configmaps[name] = cm
+            return copy.deepcopy(cm)
+
+    # The kubelet
+
+    def _later(self, delay, action, name):
+        # Call with the condition held.
+        heapq.heappush(self._timers,
+                       (time.time() + delay, next(self._seq), action, name))
+        self._cond.notify_all()
+
+    def _kubelet(self):
+        with self._cond:
+            while not self._stopping:
+                now = time.time()
+                while self._timers and self._timers[0][0] <= now:
+                    _, _, action, name = heapq.heappop(self._timers)
+                    if name in self.pods:
+                        action(self.pods[name])
+                timeout = 1.0
+                if self._timers:
+                    timeout = max(0, self._timers[0][0] - time.time())
+                self._cond.wait(timeout)
+
+    def _has_image(self, node, img):
+        images = self.nodes[node].status.images or []
+        return any([img in (x.names or []) for x in images])
+
+    def _pull_time(self, node, img, policy=None):
+        if self._has_image(node, img) and policy == "IfNotPresent":
+            return 0
+        with self._cond:
+            self.registry_pulls += 1
+        if self._has_image(node, img):
+            return self.check_latency
+        spread = self.pull_latency * self.jitter
+        return max(0, self.pull_latency +
+                   self.random.uniform(-spread, spread))
+
+    def _schedule(self, pod):
+        node = pod.spec.node_name
+        img = pod.spec.containers[0].image
+        pod.status.conditions.append(client.V1PodCondition(
+            type="PodScheduled", status="True", last_transition_time=_now()))
+        self._emit("MODIFIED", pod)
+        # One pull at a time per node.
+        now = time.time()
+        done = max(now, self.node_free.get(node, now)) + self._pull_time(
+            node, img, pod.spec.containers[0].image_pull_policy)
+        self.node_free[node] = done
+        self._later(done - now, self._start, pod.metadata.name)
+
+    def _start(self, pod):
+        pod.status.phase = "Running"
+        pod.status.start_time = _now()
+        self._add_image(pod.spec.node_name, pod.spec.containers[0].image)
+        self._emit("MODIFIED", pod)
+        self._later(self.run_latency, self._finish, pod.metadata.name)
+
+    def _finish(self, pod):
+        failed = (self.failure_rate and
+                  self.random.random() < self.failure_rate)
+        pod.status.phase = "Failed" if failed else "Succeeded"
+        container = pod.spec.containers[0]
+        pod.status.container_statuses = [client.V1ContainerStatus(
+            name=container.name, image=container.image, image_id="",
+            ready=False, restart_count=0,
+            state=client.V1ContainerState(
+                terminated=client.V1ContainerStateTerminated(
+                    exit_code=1 if failed else 0,
+                    started_at=pod.status.start_time,
+                    finished_at=_now())))]
+        self._emit("MODIFIED", pod)
+
+    def _add_image(self, node, img):
+        if self._has_image(node, img):
+            return
+        names = [img]
+        if self.resolve:
+            digest = self.resolve(img)
+            if digest:
+                names.append(img.rsplit(":", 1)[0] + "@" + digest)
+        self.nodes[node].status.images.append(
+            client.V1ContainerImage(names=names, size_bytes=1 << 30))
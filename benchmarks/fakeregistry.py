@@ -0,0 +1,281 @@
+"""Local stand-in for the Docker Hub tag listing endpoint,
+/v2/repositories/<owner>/<name>/tags/, serving a synthetic tag history,
+and for the registry API's tag listing and manifest endpoints,
+/v2/<owner>/<name>/tags/list and /v2/<owner>/<name>/manifests/.
+"""
+import datetime
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeRegistry(object):
+    """Serve `tags` synthetic tags, one every `interval` hours going back
+    from `newest`: mostly dailies, with a weekly every seventh and a
+    release every thirtieth, plus some experimental tags that no retention
+    rule keeps.  Each response is delayed by `latency` seconds, and a
+    `failure_rate` fraction of requests get a 503.  Pages carry ETags and
+    honor If-None-Match, and ordering=last_updated gives newest first.
+
+    The registry API lists tag names alone, `n` at a time after `last`,
+    with a Link header to the next page, as registries do.
+
+    Every image has the same `base_layers`, a layer shared by the tags
+    of its month, and a layer of its own.  With `auth`, the registry API
+    needs a bearer token from /token, as on Docker Hub.  With `users`, a
+    dict of username to password, the Hub tag listing needs a JWT from
+    a POST to /v2/users/login/.
+    """
+    owner = "lsstsqre"
+    name = "jld-lab"
+    latency = 0.0
+    failure_rate = 0.0
+    max_page_size = 100
+    interval = 6
+    newest = datetime.datetime(2018, 6, 1)
+    base_layers = 3
+    auth = False
+    token = "fake-token"
+    users = None
+    jwt = "fake-jwt"
+
+    def __init__(self, tags=1000, seed=0, **kwargs):
+        for key in kwargs:
+            if not hasattr(self, key):
+                raise TypeError("Unknown setting '%s'" % key)
+            setattr(self, key, kwargs[key])
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.manifest_requests = 0
+        self.not_modified = 0
+        self.logins = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self.tags = self._make_tags(tags)
+        self.by_name = dict([(x["name"], x) for x in self.tags])
+        self.by_digest = dict([(x["images"][0]["digest"], x)
+                               for x in self.tags])
+        self.path = "/v2/repositories/%s/%s/tags/" % (self.owner, self.name)
+        self.manifest_path = "/v2/%s/%s/manifests/" % (self.owner,
+                                                       self.name)
+        self.tag_list_path = "/v2/%s/%s/tags/list" % (self.owner,
+                                                      self.name)
+
+    def _make_tags(self, count):
+        tags = []
+        for idx in range(count):
+            when = self.newest - datetime.timedelta(hours=idx * self.interval)
+            if idx % 30 == 0:
+                name = "r%d" % (1000 - idx // 30)
+            elif idx % 7 == 0:
+                name = when.strftime("w%Y%W") + "_%d" % idx
+            elif idx % 11 == 0:
+                name = "exp_%d" % idx
+            else:
+                name = when.strftime("d%Y%m%d") + "_%d" % idx
+            digest = "sha256:" + hashlib.sha256(
+                name.encode("utf-8")).hexdigest()
+            tags.append({"name": name,
+                         "last_updated": when.strftime(
+                             "%Y-%m-%dT%H:%M:%S.%fZ"),
+                         "full_size": self.random.randint(1 << 30, 4 << 30),
+                         "images": [{"digest": digest,
+                                     "architecture": "amd64",
+                                     "os": "linux"}]})
+        # The default order is not by time.
+        self.random.shuffle(tags)
+        return tags
+
+    def layers(self, entry):
+        """Return the synthetic layers of a tag entry.
+        """
+        def layer(name, size):
+            return {"digest": "sha256:" + hashlib.sha256(
+                name.encode("utf-8")).hexdigest(), "size": size}
+        month = entry["last_updated"][:7]
+        layers = [layer("base-%d" % x, 200 << 20)
+                  for x in range(self.base_layers)]
+        layers.append(layer("month-" + month, 500 << 20))
+        layers.append(layer("tag-" + entry["name"], 50 << 20))
+        return layers
+
+    def digest(self, tag):
+        """Return the digest a tag points to, or None.
+        """
+        entry = self.by_name.get(tag)
+        if entry:
+            return entry["images"][0]["digest"]
+        return None
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                registry._handle(self)
+
+            def do_HEAD(self):
+                registry._handle(self)
+
+            def do_POST(self):
+                registry._handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        thd = threading.Thread(target=self._server.serve_forever,
+                               name="fake-registry")
+        thd.daemon = True
+        thd.start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def _handle(self, req):
+        with self._lock:
+            self.requests += 1
+            fail = (self.failure_rate and
+                    self.random.random() < self.failure_rate)
+        if self.latency:
+            time.sleep(self.latency)
+        url = urlparse(req.path)
+        if fail:
+            self._send(req, 503, b"{}")
+            return
+        if url.path == "/token":
+            self._send(req, 200, json.dumps(
+                {"token": self.token}).encode("utf-8"))
+            return
+        if url.path == "/v2/users/login/" and req.command == "POST":
+            self._login(req)
+            return
+        if url.path.startswith(self.manifest_path):
+            self._manifest(req, url.path[len(self.manifest_path):])
+            return
+        if url.path == self.tag_list_path:
+            self._tag_list(req, parse_qs(url.query))
+            return
+        if url.path != self.path:
+            self._send(req, 404, b"{}")
+            return
+        if (self.users and req.headers.get("Authorization") !=
+                "JWT " + self.jwt):
+            self._send(req, 401, b"{}")
+            return
+        query = parse_qs(url.query)
+        page = int(query.get("page", ["1"])[0])
+        page_size = min(int(query.get("page_size", ["10"])[0]),
+                        self.max_page_size)
+        tags = self.tags
+        if query.get("ordering", [""])[0] == "last_updated":
+            tags = sorted(tags, key=lambda x: x["last_updated"],
+                          reverse=True)
+        results = tags[(page - 1) * page_size:page * page_size]
+        nxt = None
+        if page * page_size < len(tags):
+            nxt = "http://%s%s?page=%d&page_size=%d" % (
+                req.headers.get("Host"), self.path, page + 1, page_size)
+        body = json.dumps({"count": len(tags), "next": nxt,
+                           "results": results}).encode("utf-8")
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        if req.headers.get("If-None-Match") == etag:
+            with self._lock:
+                self.not_modified += 1
+            self._send(req, 304, b"", etag)
+            return
+        self._send(req, 200, body, etag)
+
+    def _login(self, req):
+        length = int(req.headers.get("Content-Length") or 0)
+        try:
+            creds = json.loads(req.rfile.read(length).decode("utf-8"))
+        except ValueError:
+            creds = {}
+        if (not self.users or
+                self.users.get(creds.get("username")) !=
+                creds.get("password")):
+            self._send(req, 401, b"{}")
+            return
+        with self._lock:
+            self.logins += 1
+        self._send(req, 200, json.dumps({"token": self.jwt}).encode("utf-8"))
+
+    def _authorized(self, req):
+        """Check the registry API's bearer token, having sent the
+        challenge if it is missing.
+        """
+        if (not self.auth or req.headers.get("Authorization") ==
+                "Bearer " + self.token):
+            return True
+        req.send_response(401)
+        req.send_header(
+            "WWW-Authenticate",
+            'Bearer realm="http://%s/token",service="fake",' % (
+                req.headers.get("Host")) +
+            'scope="repository:%s/%s:pull"' % (self.owner, self.name))
+        req.send_header("Content-Length", "0")
+        req.end_headers()
+        return False
+
+    def _tag_list(self, req, query):
+        if not self._authorized(req):
+            return
+        names = sorted([x["name"] for x in self.tags])
+        last = query.get("last", [None])[0]
+        if last:
+            names = [x for x in names if x > last]
+        count = min(int(query.get("n", [str(self.max_page_size)])[0]),
+                    self.max_page_size)
+        page = names[:count]
+        headers = {}
+        if len(names) > count:
+            headers["Link"] = '<%s?n=%d&last=%s>; rel="next"' % (
+                self.tag_list_path, count, page[-1])
+        body = json.dumps({"name": "%s/%s" % (self.owner, self.name),
+                           "tags": page}).encode("utf-8")
+        self._send(req, 200, body, headers=headers)
+
+    def _manifest(self, req, ref):
+        with self._lock:
+            self.manifest_requests += 1
+        if not self._authorized(req):
+            return
+        entry = self.by_digest.get(ref) or self.by_name.get(ref)
+        if not entry:
+            self._send(req, 404, b"{}")
+            return
+        body = json.dumps({
+            "schemaVersion": 2,
+            "mediaType":
+            "application/vnd.docker.distribution.manifest.v2+json",
+            "layers": self.layers(entry)}).encode("utf-8")
+        self._send(req, 200, body, headers={
+            "Docker-Content-Digest": entry["images"][0]["digest"]})
+
+    def _send(self, req, status, body, etag=None, headers=None):
+        req.send_response(status)
+        req.send_header("Content-Type", "application/json")
+        req.send_header("Content-Length", str(len(body)))
+        if etag:
+            req.send_header("ETag", etag)
+        for key in headers or {}:
+            req.send_header(key, headers[key])
+        req.end_headers()
+        if req.command != "HEAD":
+            req.wfile.write(body)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""Benchmark reducing a tag history to the tags we keep, as
+ScanRepo._reduce_results() does after every full scan, over synthetic
+histories of growing size, and report time per tag and peak memory.
+The time per tag should stay flat as the history grows.
+
+Run from a checkout with the prepuller installed (pip install -e .):
+
+    python benchmarks/reduce.py
+    python benchmarks/reduce.py --tags 200000 --sort name --json
+"""
+import argparse
+import json
+import time
+import tracemalloc
+from fakeregistry import FakeRegistry
+from prepuller.scanrepo import ScanRepo
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--tags", type=int, default=100000,
+                        help="Tags in the largest history [100000]")
+    parser.add_argument("--steps", type=int, default=4,
+                        help="Histories to try, up to --tags [4]")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Runs per history; the best is kept [5]")
+    parser.add_argument("--sort", default="comp_ts",
+                        help="Sort field [comp_ts]")
+    parser.add_argument("--dailies", type=int, default=15,
+                        help="Dailies to keep [15]")
+    parser.add_argument("--weeklies", type=int, default=4,
+                        help="Weeklies to keep [4]")
+    parser.add_argument("--releases", type=int, default=1,
+                        help="Releases to keep [1]")
+    parser.add_argument("--json", action="store_true",
+                        help="Print the report as JSON")
+    return parser.parse_args()
+
+
+def reduce_once(opts, results):
+    repo = ScanRepo(dailies=opts.dailies, weeklies=opts.weeklies,
+                    releases=opts.releases, sort_field=opts.sort)
+    start = time.perf_counter()
+    repo._reduce_results(results)
+    repo.extract_image_info()
+    return time.perf_counter() - start
+
+
+def run(opts):
+    history = FakeRegistry(tags=opts.tags).tags
+    report = []
+    for step in range(1, opts.steps + 1):
+        results = history[:opts.tags * step // opts.steps]
+        best = min([reduce_once(opts, results)
+                    for x in range(opts.repeat)])
+        tracemalloc.start()
+        reduce_once(opts, results)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        report.append({"tags": len(results),
+                       "seconds": round(best, 4),
+                       "us_per_tag": round(best * 1e6 / len(results), 3),
+                       "peak_kib": peak // 1024})
+    return report
+
+
+def main():
+    opts = parse_args()
+    report = run(opts)
+    if opts.json:
+        print(json.dumps(report, sort_keys=True, indent=4))
+        return
+    print("%10s %10s %10s %10s" % ("tags", "seconds", "us/tag",
+                                   "peak KiB"))
+    for row in report:
+        print("%10d %10.4f %10.3f %10d" % (row["tags"], row["seconds"],
+                                           row["us_per_tag"],
+                                           row["peak_kib"]))
+
+
+if __name__ == "__main__":
+    main()
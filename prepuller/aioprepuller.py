@@ -0,0 +1,443 @@
+import asyncio
+import time
+from collections import deque
+from kubernetes import client
+from .metrics import InstrumentedApi
+from .podwatcher import PodPhases
+from .prepuller import Prepuller
+try:
+    import aiohttp
+    from kubernetes_asyncio import client as aclient
+    from kubernetes_asyncio import config as aconfig
+    from kubernetes_asyncio import watch as awatch
+    from kubernetes_asyncio.client.rest import ApiException
+    from kubernetes_asyncio.config.config_exception import ConfigException
+except ImportError:
+    aiohttp = None
+
+
+class AsyncPodWatcher(PodPhases):
+    """Coroutine counterpart of PodWatcher: one shared watch on the
+    prepuller pods, resolving a future for each pod being waited on.
+    """
+
+    def __init__(self, client, namespace, label_selector=None,
+                 watch_timeout=None, relist_limit=None, ours=None,
+                 logger=None):
+        super(AsyncPodWatcher, self).__init__(
+            client, namespace, label_selector=label_selector,
+            watch_timeout=watch_timeout, relist_limit=relist_limit,
+            ours=ours, logger=logger)
+        self.waiters = {}
+        self._task = None
+
+    def start(self):
+        """Start the watch task on the running event loop.
+        """
+        if not self._task:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """Cancel the watch task.
+        """
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def wait(self, podname, timeout=None):
+        """Wait until the named pod reaches a terminal phase and return
+        that phase, or None if the timeout (in seconds) expires first.
+        """
+        fut = asyncio.get_event_loop().create_future()
+        self.waiters[podname] = fut
+        try:
+            phase = self.phases.get(podname)
+            if phase in self.terminal:
+                return phase
+            if phase is None:
+                await self._check(podname)
+                if fut.done():
+                    return fut.result()
+            return await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self.waiters.pop(podname, None)
+
+    async def _check(self, podname):
+        """Read a pod the watch has not told us about, in case it
+        finished or was deleted before we began waiting on it.
+        """
+        try:
+            pod = await self._read(podname)
+        except ApiException as e:
+            self.logger.debug("Cannot read pod %s: %s" % (podname, str(e)))
+            return
+        self._checked(podname, pod)
+
+    async def _read(self, podname):
+        """Return the named pod, or None if there is no such pod.
+        """
+        try:
+            return await self.client.read_namespaced_pod(podname,
+                                                         self.namespace)
+        except ApiException as e:
+            if e.status != 404:
+                raise
+        return None
+
+    def final_pod(self, podname):
+        return self.final.get(podname)
+
+    def forget(self, podname):
+        self._forget(podname)
+
+    def replaced(self, podname, uid=None):
+        self._forget(podname, uid)
+
+    def _update(self, podname, phase, deleted=False, pod=None):
+        if self._record(podname, phase, deleted=deleted, pod=pod):
+            fut = self.waiters.get(podname)
+            if fut and not fut.done():
+                fut.set_result(self.phases[podname])
+
+    async def _run(self):
+        while True:
+            try:
+                if self.resource_version is None:
+                    await self._relist()
+                await self._watch_pods()
+            except asyncio.CancelledError:
+                raise
+            except ApiException as e:
+                if e.status == 410:
+                    self.logger.debug("Watch expired; relisting pods.")
+                else:
+                    self.logger.warning("Pod watch failed: %s" % str(e))
+                    await asyncio.sleep(self.retry_delay)
+                self.resource_version = None
+            except Exception as e:
+                self.logger.warning("Pod watch failed: %s" % str(e))
+                self.resource_version = None
+                await asyncio.sleep(self.retry_delay)
+
+    async def _relist(self):
+        kwargs = self._relist_kwargs()
+        seen = set()
+        while True:
+            podlist = await self.client.list_namespaced_pod(self.namespace,
+                                                            **kwargs)
+            if not self._relisted_page(podlist, kwargs, seen):
+                break
+        for podname in self._missing(seen):
+            try:
+                pod = await self._read(podname)
+            except ApiException as e:
+                self.logger.debug("Cannot read pod %s: %s" % (podname,
+                                                             str(e)))
+                continue
+            self._reread(podname, pod)
+        self._relisted(podlist, seen)
+
+    async def _watch_pods(self):
+        async with awatch.Watch() as w:
+            async for event in w.stream(self.client.list_namespaced_pod,
+                                        self.namespace,
+                                        **self._watch_kwargs()):
+                if not self._event(event):
+                    return
+
+
+class AsyncPrepuller(Prepuller):
+    """Prepuller that runs the whole pipeline as coroutines on a single
+    event loop.  Planning (image selection, node filtering, pod specs) is
+    shared with Prepuller; only the I/O differs.  Concurrency is limited
+    by the same node_concurrency and max_in_flight arguments, but costs
+    a coroutine rather than a thread per pull.
+    """
+    api_client = None
+    serializer = None
+    _kube_config_needed = False
+
+    def __init__(self, args=None):
+        if aiohttp is None:
+            raise ImportError("The async engine needs the 'async' extra:" +
+                              " pip install prepuller[async]")
+        super(AsyncPrepuller, self).__init__(args=args)
+
+    def _load_config(self):
+        # Loading kubeconfig is itself a coroutine here, so it waits for
+        # setup().
+        self.configuration = aclient.Configuration()
+        try:
+            aconfig.load_incluster_config(
+                client_configuration=self.configuration)
+            return self._incluster_namespace()
+        except ConfigException:
+            self._kube_config_needed = True
+        return None
+
+    def _make_client(self):
+        pass
+
+    def run_standalone(self):
+        """Run the whole pipeline to completion on a new event loop.
+        """
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self.run())
+        finally:
+            loop.close()
+
+    async def run(self):
+        """Scan, list nodes, clean up and prepull, as in
+        main.standalone().
+        """
+        await self.setup()
+        try:
+            await self.update_images_from_repo()
+            with self.metrics.timer("nodelist"):
+                await self.build_nodelist()
+            self.build_plan()
+            with self.metrics.timer("cleanup"):
+                await self.clean_completed_pods()
+            with self.metrics.timer("run"):
+                await self.run_pods()
+        finally:
+            await self.close()
+
+    async def setup(self):
+        """Create the API client.
+        """
+        if self._kube_config_needed:
+            try:
+                await aconfig.load_kube_config(
+                    client_configuration=self.configuration)
+            except Exception:
+                self.logger.critical("Must be run from a system with" +
+                                     " k8s API access.")
+                raise
+            self._kube_config_needed = False
+        # One pool for the API server, shared by every in-flight pull
+        # and by the watch.
+        self.configuration.connection_pool_maxsize = max(
+            self.configuration.connection_pool_maxsize,
+            self.args.max_in_flight)
+        self.api_client = aclient.ApiClient(self.configuration)
+        self.client = self._rate_limited(
+            InstrumentedApi(aclient.CoreV1Api(self.api_client),
+                            self.metrics),
+            is_async=True, transient=[aiohttp.ClientError])
+        # Pods are built with the synchronous client's models, which
+        # its ApiClient knows how to turn into JSON.
+        self.serializer = client.ApiClient()
+
+    async def close(self):
+        if self.watcher:
+            await self.watcher.stop()
+            self.watcher = None
+        if self.api_client:
+            await self.api_client.close()
+            self.api_client = None
+
+    async def update_images_from_repo(self):
+        """Scan the repos, as the thread engine does, off the event
+        loop.  The scan is a few registry requests per repo, run once,
+        so it gains nothing from being rewritten as coroutines.
+        """
+        await asyncio.get_event_loop().run_in_executor(
+            None, super(AsyncPrepuller, self).update_images_from_repo)
+
+    async def build_nodelist(self):
+        """Make a list of all schedulable nodes.
+        """
+        self.logger.debug("Getting schedulable node list.")
+        kwargs = self._node_list_kwargs()
+        kwargs["limit"] = self.args.node_page_size
+        items = []
+        while True:
+            try:
+                nodelist = await self.client.list_node(**kwargs)
+            except ApiException as e:
+                if not self._restart_list(kwargs, e):
+                    raise
+                items = []
+                continue
+            items.extend(nodelist.items)
+            if not self._next_page(kwargs, nodelist):
+                break
+        self._select_nodes(items)
+
+    async def clean_completed_pods(self):
+        """Delete completed prepuller pods in bulk, or, without
+        permission to do that, list them by label and delete them all at
+        once.
+        """
+        self.logger.debug("Looking for completed pods to delete.")
+        selector = self._any_replica_selector()
+        try:
+            await asyncio.gather(*[
+                self.client.delete_collection_namespaced_pod(
+                    self.namespace, label_selector=selector,
+                    field_selector="status.phase=%s" % phase)
+                for phase in self.completed_phases])
+            return
+        except ApiException as e:
+            if e.status != 403:
+                raise
+        kwargs = {"label_selector": selector, "limit": 500}
+        cleanup = []
+        while True:
+            podlist = await self.client.list_namespaced_pod(self.namespace,
+                                                            **kwargs)
+            cleanup.extend(self._completed_pods(podlist.items))
+            if not self._next_page(kwargs, podlist):
+                break
+        await asyncio.gather(*[self.delete_pod(x) for x in cleanup])
+
+    async def run_pods(self):
+        """Run pods for all nodes.  Each node gets node_concurrency worker
+        coroutines, and a semaphore holds the cluster to max_in_flight.
+        """
+        self._in_flight = asyncio.Semaphore(self.args.max_in_flight)
+        self._pull_time = 0.0
+        self._pulls = 0
+        deferred = []
+        self.watcher = AsyncPodWatcher(
+            self.client, self.namespace,
+            label_selector=self._any_replica_selector(),
+            ours=self.namer.lookup, logger=self.logger)
+        self.watcher.start()
+        failures = []
+        workers = []
+        for node in self.plan:
+            queue = deque(self.plan[node])
+            for _ in range(min(self.args.node_concurrency, len(queue))):
+                workers.append(self._node_worker(node, queue, failures,
+                                                 deferred))
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            await self.watcher.stop()
+            self.watcher = None
+        self._report_deferred(deferred)
+        if failures:
+            self.logger.error("%d pulls failed." % len(failures))
+            self.metrics.inc("prepuller_failures_total", {"kind": "pull"},
+                             value=len(failures))
+        return failures
+
+    async def _node_worker(self, node, queue, failures, deferred):
+        while queue:
+            img = queue.popleft()
+            try:
+                async with self._in_flight:
+                    # As PullScheduler: stop once a pull of average
+                    # length would overrun the deadline.
+                    if (self.deadline and self._pulls and
+                            time.time() + self._pull_time / self._pulls >
+                            self.deadline):
+                        deferred.append((node, img))
+                        deferred.extend([(node, x) for x in queue])
+                        queue.clear()
+                        return
+                    start = time.time()
+                    await self.run_single_pod(node, img)
+                    self._pull_time += time.time() - start
+                    self._pulls += 1
+            except Exception as e:
+                self.logger.error("Pull on node '%s' failed: %s" % (
+                    node, str(e)))
+                failures.append((node, img, e))
+
+    async def run_single_pod(self, node, img):
+        """Start a pod to pull an image on a node, wait for it to
+        finish, and return its final phase.
+        """
+        self.logger.debug("Pulling '%s' on node '%s'" % (img, node))
+        podname = await self.start_single_pod(node, img)
+        return await self.wait_for_pod(podname)
+
+    async def start_single_pod(self, node, img):
+        """Create the pod to pull an image on a node and return its
+        name.  A pod already there is waited on or replaced, as in
+        Prepuller.start_single_pod().
+        """
+        pod = self._build_pod(node, img)
+        name = pod.metadata.name
+        body = self.serializer.sanitize_for_serialization(pod)
+        for attempt in range(self.replace_tries):
+            try:
+                made_pod = await self.client.create_namespaced_pod(
+                    self.namespace, body)
+                return made_pod.metadata.name
+            except ApiException as e:
+                if e.status != 409:
+                    raise
+            try:
+                existing = await self.client.read_namespaced_pod(
+                    name, self.namespace)
+            except ApiException as e:
+                if e.status != 404:
+                    raise
+                existing = None
+            reason = self._stale_reason(existing, pod)
+            if not reason:
+                return name
+            self._replacing(name, existing, reason, self.watcher)
+            if existing:
+                await self.delete_pod(name, now=True)
+            if attempt:
+                await asyncio.sleep(self.replace_delay)
+        raise RuntimeError("Could not replace pod '%s'" % name)
+
+    async def wait_for_pod(self, podname, delay=1, max_tries=3600):
+        """Wait for a pod to finish, then delete it, and return its
+        final phase.
+        """
+        timeout = delay * max_tries
+        phase = await self.watcher.wait(podname, timeout=timeout)
+        pod = self.watcher.final_pod(podname)
+        self.watcher.forget(podname)
+        if phase is None:
+            errstr = ("Pod '%s' did not complete after " % podname +
+                      "%d %d s iterations." % (max_tries, delay))
+            self.logger.error(errstr)
+            self.metrics.failure("pod_timeout")
+            self._journal_pull(podname, "Timeout")
+            try:
+                await self.delete_pod(podname, now=True)
+            except Exception as e:
+                self.logger.warning("Cannot delete pod '%s': %s" % (
+                    podname, str(e)))
+            raise RuntimeError(errstr)
+        self._record_pull(podname, phase, pod)
+        if phase == "Deleted":
+            self.logger.warning("Pod '%s' was deleted before completing" %
+                                podname)
+            return phase
+        if phase == "Failed":
+            self.logger.error("Pod '%s' failed%s" % (
+                podname, self._describe_pod(podname)))
+        await self.delete_pod(podname)
+        return phase
+
+    async def delete_pod(self, podname, now=False):
+        """Delete a named pod; with now, without a grace period.
+        """
+        self.logger.debug("Deleting pod %s" % podname)
+        options = aclient.V1DeleteOptions()
+        if now:
+            options.grace_period_seconds = 0
+        try:
+            await self.client.delete_namespaced_pod(
+                podname, self.namespace, body=options)
+        except ApiException as e:
+            if e.status != 404:
+                raise
+            self.logger.debug("Pod %s was already gone" % podname)
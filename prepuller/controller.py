@@ -0,0 +1,248 @@
+import signal
+import threading
+import time
+from kubernetes import watch
+from kubernetes.client.rest import ApiException
+from .scheduler import PullScheduler
+
+
+class PrepullController(object):
+    """Keep every schedulable node stocked with the current image set.
+
+    Rather than repeating a whole run on a timer, the controller watches
+    nodes and rescans the repository periodically, and pulls only what is
+    missing: new images onto every node, and every image onto nodes that
+    join the cluster.  Kubernetes configuration, the repository session
+    and the pod watcher are set up once and reused.
+    """
+    rescan_interval = 300
+    watch_timeout = 300
+    retry_delay = 5
+
+    def __init__(self, prepuller, rescan_interval=None):
+        self.prepuller = prepuller
+        self.logger = prepuller.logger
+        if rescan_interval:
+            self.rescan_interval = rescan_interval
+        args = prepuller.args
+        self.scheduler = PullScheduler(self._pull,
+                                       per_node=args.node_concurrency,
+                                       max_in_flight=args.max_in_flight,
+                                       logger=self.logger)
+        # Images queued, running or done, by node
+        self.wanted = {}
+        self.resource_version = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        if prepuller.shard:
+            prepuller.shard.on_change = self._reshard
+
+    def run(self):
+        """Do an initial full pass, then follow node and repository
+        changes until stopped by SIGTERM or SIGINT.
+        """
+        signal.signal(signal.SIGTERM, self._stop_handler)
+        pp = self.prepuller
+        pp.update_images_from_repo()
+        pp.build_nodelist()
+        pp.clean_completed_pods()
+        self.scheduler.start()
+        with self._lock:
+            for node in pp.nodes:
+                self.wanted[node] = set()
+            self._reconcile()
+        # Watch from the list just made, rather than listing again.
+        self.resource_version = pp.nodes_version
+        thd = threading.Thread(target=self._watch_nodes,
+                               name="node-watcher")
+        thd.daemon = True
+        thd.start()
+        try:
+            while not self._stopping.wait(self.rescan_interval):
+                self.rescan()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        """Stop queueing pulls and shut down.  Pods already running are
+        left to finish and be cleaned up by the next start.
+        """
+        self.logger.info("Stopping prepuller controller.")
+        self._stopping.set()
+        self.scheduler.stop()
+        self.prepuller._stop_watcher()
+
+    def _stop_handler(self, signum, frame):
+        self.logger.info("Received signal %d." % signum)
+        self._stopping.set()
+
+    def rescan(self):
+        """Report the pulls that failed since the last rescan, rescan the
+        repository, and queue any new images and failed pulls.
+        """
+        self._report_failures()
+        try:
+            self.prepuller.update_images_from_repo()
+        except Exception as e:
+            self.logger.error("Repository scan failed: %s" % str(e))
+            return
+        with self._lock:
+            self._reconcile()
+
+    def _report_failures(self):
+        pp = self.prepuller
+        failures, deferred = self.scheduler.take()
+        pp._report_deferred(deferred)
+        if failures:
+            self.logger.error("%d pulls failed since the last rescan." %
+                              len(failures))
+            pp.metrics.inc("prepuller_failures_total", {"kind": "pull"},
+                           value=len(failures))
+
+    def _reconcile(self):
+        # Call with the lock held.
+        images = set(self.prepuller.images)
+        for node in self.wanted:
+            # Images that have dropped out of the set no longer count.
+            self.wanted[node] &= images
+            self._reconcile_node(node)
+
+    def _reconcile_node(self, node):
+        # Call with the lock held.
+        pp = self.prepuller
+        wanted = self.wanted[node]
+        missing = []
+        for img in pp.ordered_images():
+            if img in wanted:
+                continue
+            if not pp.args.repull and pp._node_has_image(node, img):
+                continue
+            # Failures are retried here on every rescan, so only pulls
+            # done in an earlier run are left out.
+            if pp._journal_skip(node, img) == "done":
+                continue
+            missing.append(img)
+        if missing and pp.disk:
+            pending = [x for x in wanted if not pp._node_has_image(node, x)]
+            missing, over = pp._fit_disk(node, missing, pending)
+            if over:
+                # Left out of wanted, so they are weighed again later.
+                self.logger.info("Node '%s' has no room for %d images" % (
+                    node, len(over)))
+        if missing:
+            self.logger.info("Queueing %d images for node '%s'" % (
+                len(missing), node))
+            wanted.update(missing)
+            self.scheduler.submit(node, pp._order_for_node(node, missing))
+
+    def _pull(self, node, img):
+        pp = self.prepuller
+        phase = None
+        try:
+            phase = pp.run_single_pod(node, img)
+        finally:
+            if phase != "Succeeded":
+                # Try again after the next rescan.
+                with self._lock:
+                    if node in self.wanted:
+                        self.wanted[node].discard(img)
+
+    def _reshard(self):
+        """Take on, and give up, nodes after the set of replicas changed.
+        """
+        self.logger.info("Replicas changed; rechecking nodes.")
+        self._relist_nodes()
+
+    def _node_event(self, etype, node):
+        pp = self.prepuller
+        name = node.metadata.name
+        with self._lock:
+            if etype == "DELETED" or not pp._node_is_schedulable(node):
+                if name in self.wanted:
+                    self.logger.info("Node '%s' is gone or unschedulable" %
+                                     name)
+                    self._drop_node(name)
+                return
+            if pp.shard and not pp.shard.owns(node):
+                if name in self.wanted:
+                    self.logger.info("Node '%s' now belongs to %s" % (
+                        name, pp.shard.owner(node)))
+                    self._drop_node(name)
+                return
+            pp.node_images[name] = pp._images_on_node(node)
+            pp.node_uids[name] = node.metadata.uid
+            if pp._lists_all_images(node):
+                pp.full_image_lists.add(name)
+            else:
+                pp.full_image_lists.discard(name)
+            if pp.disk:
+                pp.disk.add_node(node, pp._normalize_image)
+            if name not in self.wanted:
+                self.logger.info("New node '%s'" % name)
+                self.wanted[name] = set()
+                pp.nodes.append(name)
+                self._reconcile_node(name)
+
+    def _drop_node(self, name):
+        # Call with the lock held.
+        pp = self.prepuller
+        del self.wanted[name]
+        self.scheduler.drop(name)
+        pp.node_images.pop(name, None)
+        pp.node_uids.pop(name, None)
+        pp.full_image_lists.discard(name)
+        if pp.disk:
+            pp.disk.drop_node(name)
+        if name in pp.nodes:
+            pp.nodes.remove(name)
+
+    def _watch_nodes(self):
+        while not self._stopping.is_set():
+            try:
+                if self.resource_version is None:
+                    self._relist_nodes()
+                self._watch_node_events()
+            except ApiException as e:
+                if e.status != 410:
+                    self.logger.warning("Node watch failed: %s" % str(e))
+                    time.sleep(self.retry_delay)
+                self.resource_version = None
+            except Exception as e:
+                self.logger.warning("Node watch failed: %s" % str(e))
+                self.resource_version = None
+                time.sleep(self.retry_delay)
+
+    def _relist_nodes(self):
+        pp = self.prepuller
+        seen = set()
+        for node in pp._list_nodes(pp.client):
+            seen.add(node.metadata.name)
+            self._node_event("ADDED", node)
+        with self._lock:
+            for name in [x for x in self.wanted if x not in seen]:
+                self.logger.info("Node '%s' is gone" % name)
+                self._drop_node(name)
+        self.resource_version = pp.nodes_version
+
+    def _watch_node_events(self):
+        v1 = self.prepuller.client
+        w = watch.Watch()
+        for event in w.stream(v1.list_node,
+                              resource_version=self.resource_version,
+                              timeout_seconds=self.watch_timeout,
+                              **self.prepuller._node_list_kwargs()):
+            if self._stopping.is_set():
+                w.stop()
+                break
+            if event["type"] == "ERROR":
+                raw = event["raw_object"]
+                if raw.get("code") != 410:
+                    self.logger.warning("Node watch error: %s" %
+                                        raw.get("message"))
+                self.resource_version = None
+                return
+            node = event["object"]
+            self.resource_version = node.metadata.resource_version
+            self._node_event(event["type"], node)
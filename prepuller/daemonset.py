@@ -0,0 +1,231 @@
+import time
+from kubernetes import client, watch
+from kubernetes.client.rest import ApiException
+from .metrics import InstrumentedApi
+
+
+class DaemonSetPuller(object):
+    """Pull images through DaemonSets rather than one bare pod per
+    (node, image) pair, so that API writes scale with images instead of
+    nodes times images.
+
+    In the "combined" layout, nodes with the same images to pull share
+    a DaemonSet with one init container per image; init containers run
+    one after another, so each node pulls its images in order, and no
+    node pulls an image the plan did not give it.  In the "per-image"
+    layout each image gets its own DaemonSet.  Either way the pods end
+    in a pause container, a DaemonSet is rolled out when all its pods
+    are ready, and then it is deleted.  Node affinity on the hostname
+    label keeps the pods to the nodes in the plan, and the pods carry
+    the same tolerations as the bare pods.  Rollouts are waited on for
+    at most `rollout_timeout` seconds, and not past the run's deadline.
+    """
+    labels = {"app": "prepuller-daemonset"}
+    hostname_label = "kubernetes.io/hostname"
+    watch_timeout = 300
+    rollout_timeout = 3600
+
+    def __init__(self, prepuller, layout=None, rollout_timeout=None):
+        self.prepuller = prepuller
+        self.logger = prepuller.logger
+        self.namespace = prepuller.namespace
+        self.api = prepuller._rate_limited(InstrumentedApi(
+            client.AppsV1Api(prepuller.api_client), prepuller.metrics))
+        self.layout = layout or prepuller.args.daemonset_layout
+        if rollout_timeout:
+            self.rollout_timeout = rollout_timeout
+
+    def run(self):
+        """Create the DaemonSets for the plan, wait for them to roll out,
+        and delete them.  Return a list of (name, images) for the
+        DaemonSets that did not finish.
+        """
+        self.clean_daemonsets()
+        plan = self.build_plan()
+        if not plan:
+            self.logger.info("Nothing to pull.")
+            return []
+        names = []
+        try:
+            for name in sorted(plan):
+                images, nodes = plan[name]
+                self.logger.debug("Creating DaemonSet %s for %d images" %
+                                  (name, len(images)))
+                self.api.create_namespaced_daemon_set(
+                    self.namespace, self._build_daemonset(name, images,
+                                                          nodes))
+                names.append(name)
+            unfinished = self.wait_for_rollout(names)
+        finally:
+            for name in names:
+                self.delete_daemonset(name)
+        self._journal([x for x in names if x not in unfinished], plan)
+        return [(x, plan[x][0]) for x in unfinished]
+
+    def _journal(self, finished, plan):
+        """Record the pulls of the DaemonSets that rolled out in the
+        journal.
+        """
+        pp = self.prepuller
+        if not pp.journal:
+            return
+        for name in finished:
+            images, nodes = plan[name]
+            for img in images:
+                for node in nodes:
+                    pp.journal.record(pp._journal_node(node), img,
+                                      pp.digests.get(img), "Succeeded")
+
+    def build_plan(self):
+        """Turn the per-node plan into a dict of DaemonSet name to
+        (images, nodes).  Nodes with nothing to pull are left out.
+        """
+        pp = self.prepuller
+        by_image = {}
+        for node in pp.plan:
+            for img in pp.plan[node]:
+                by_image.setdefault(img, []).append(node)
+        if not by_image:
+            return {}
+        # Init containers run in order, so put the important ones first.
+        order = [x for x in pp.ordered_images() if x in by_image]
+        plan = {}
+        if self.layout == "per-image":
+            for idx, img in enumerate(order):
+                plan["pp-ds-%d" % idx] = ([img], sorted(by_image[img]))
+            return plan
+        by_set = {}
+        for node in pp.plan:
+            if pp.plan[node]:
+                by_set.setdefault(frozenset(pp.plan[node]), []).append(node)
+        groups = sorted([([x for x in order if x in images], sorted(nodes))
+                         for images, nodes in by_set.items()])
+        for idx, group in enumerate(groups):
+            plan["pp-ds-%d" % idx] = group
+        return plan
+
+    def _build_daemonset(self, name, images, nodes):
+        pp = self.prepuller
+        labels = dict(self.labels)
+        labels["daemonset"] = name
+        hostnames = [pp.node_labels.get(x, {}).get(self.hostname_label, x)
+                     for x in nodes]
+        affinity = client.V1Affinity(
+            node_affinity=client.V1NodeAffinity(
+                required_during_scheduling_ignored_during_execution=(
+                    client.V1NodeSelector(node_selector_terms=[
+                        client.V1NodeSelectorTerm(match_expressions=[
+                            client.V1NodeSelectorRequirement(
+                                key=self.hostname_label,
+                                operator="In",
+                                values=hostnames)])]))))
+        init_containers = [pp._build_container(img, "pull-%d" % idx)
+                           for idx, img in enumerate(images)]
+        pause = client.V1Container(image=pp.args.pause_image,
+                                   image_pull_policy="IfNotPresent",
+                                   name="pause")
+        spec = client.V1PodSpec(affinity=affinity,
+                                init_containers=init_containers,
+                                containers=[pause],
+                                tolerations=pp.tolerations or None)
+        return client.V1DaemonSet(
+            metadata=client.V1ObjectMeta(
+                name=name, labels=labels,
+                annotations={"prepuller/images": ",".join(images)}),
+            spec=client.V1DaemonSetSpec(
+                selector=client.V1LabelSelector(match_labels=labels),
+                template=client.V1PodTemplateSpec(
+                    metadata=client.V1ObjectMeta(labels=labels),
+                    spec=spec)))
+
+    def _selector(self):
+        return ",".join(["%s=%s" % (k, v) for k, v in
+                         sorted(self.labels.items())])
+
+    def _is_rolled_out(self, ds):
+        status = ds.status
+        if not status or status.observed_generation is None:
+            return False
+        if status.observed_generation < ds.metadata.generation:
+            return False
+        desired = status.desired_number_scheduled or 0
+        ready = status.number_ready or 0
+        return (ready >= desired and
+                (status.updated_number_scheduled or 0) >= desired)
+
+    def wait_for_rollout(self, names):
+        """Watch our DaemonSets until all of the named ones have every
+        pod ready, or the rollout timeout expires.  Return the names of
+        those that did not finish.
+        """
+        pending = set(names)
+        deadline = time.time() + self.rollout_timeout
+        if self.prepuller.deadline:
+            deadline = min(deadline, self.prepuller.deadline)
+        started = time.time()
+        resource_version = None
+        while pending and time.time() < deadline:
+            if resource_version is None:
+                dslist = self.api.list_namespaced_daemon_set(
+                    self.namespace, label_selector=self._selector())
+                for ds in dslist.items:
+                    self._check(ds, pending)
+                resource_version = dslist.metadata.resource_version
+                continue
+            timeout = int(min(self.watch_timeout, deadline - time.time()))
+            if timeout <= 0:
+                break
+            w = watch.Watch()
+            try:
+                for event in w.stream(self.api.list_namespaced_daemon_set,
+                                      self.namespace,
+                                      label_selector=self._selector(),
+                                      resource_version=resource_version,
+                                      timeout_seconds=timeout):
+                    if event["type"] == "ERROR":
+                        resource_version = None
+                        break
+                    ds = event["object"]
+                    resource_version = ds.metadata.resource_version
+                    self._check(ds, pending)
+                    if not pending:
+                        w.stop()
+                        break
+            except ApiException as e:
+                if e.status != 410:
+                    raise
+                resource_version = None
+        for name in pending:
+            self.logger.error("DaemonSet %s did not roll out in %d s" % (
+                name, time.time() - started))
+            self.prepuller.metrics.failure("rollout_timeout")
+        return sorted(pending)
+
+    def _check(self, ds, pending):
+        name = ds.metadata.name
+        if name in pending and self._is_rolled_out(ds):
+            self.logger.debug("DaemonSet %s rolled out to %d nodes" % (
+                name, ds.status.desired_number_scheduled or 0))
+            pending.discard(name)
+
+    def delete_daemonset(self, name):
+        """Delete a DaemonSet and, in the background, its pods.
+        """
+        self.logger.debug("Deleting DaemonSet %s" % name)
+        try:
+            self.api.delete_namespaced_daemon_set(
+                name, self.namespace,
+                client.V1DeleteOptions(propagation_policy="Background"))
+        except ApiException as e:
+            if e.status != 404:
+                raise
+
+    def clean_daemonsets(self):
+        """Delete DaemonSets left behind by an interrupted run.
+        """
+        dslist = self.api.list_namespaced_daemon_set(
+            self.namespace, label_selector=self._selector())
+        for ds in dslist.items:
+            self.logger.info("Deleting stale DaemonSet %s" %
+                             ds.metadata.name)
+            self.delete_daemonset(ds.metadata.name)
@@ -0,0 +1,101 @@
+import re
+
+SUFFIXES = {"Ki": 1 << 10, "Mi": 1 << 20, "Gi": 1 << 30, "Ti": 1 << 40,
+            "Pi": 1 << 50, "Ei": 1 << 60, "k": 10 ** 3, "M": 10 ** 6,
+            "G": 10 ** 9, "T": 10 ** 12, "P": 10 ** 15, "E": 10 ** 18,
+            "m": 0.001, "": 1}
+
+
+def parse_quantity(value):
+    """Turn a Kubernetes resource quantity, such as "100Gi" or "1e9",
+    into a number.  Return None if it cannot be parsed.
+    """
+    if value is None:
+        return None
+    match = re.match(r"^([+-]?[0-9.]+(?:[eE][+-]?[0-9]+)?)([a-zA-Z]*)$",
+                     str(value).strip())
+    if not match or match.group(2) not in SUFFIXES:
+        return None
+    return float(match.group(1)) * SUFFIXES[match.group(2)]
+
+
+class DiskBudget(object):
+    """Keep the images on each node within a share of its disk, so that
+    what we pull does not push the node past the kubelet's image garbage
+    collection threshold and get evicted again.
+
+    A node may hold `fraction` of its ephemeral-storage capacity, and no
+    more than its allocatable ephemeral storage, in images.  What it
+    holds already is the sum of the sizes in node.status.images; the
+    kubelet reports only the largest fifty or so images, so this errs
+    low on nodes with many images.  Those sizes are also kept by image
+    reference, to price pulling the same image onto other nodes.
+    Registry sizes are compressed, so they are scaled by `unpack_ratio`
+    to guess the size on disk.
+    """
+    unpack_ratio = 2.0
+
+    def __init__(self, fraction):
+        self.fraction = fraction
+        self.limits = {}
+        self.used = {}
+        self.sizes = {}
+
+    def add_node(self, node, normalize):
+        """Record the disk limit and the images of a node object, with
+        normalize() to put image names into the form we look them up by.
+        """
+        name = node.metadata.name
+        status = node.status
+        used = 0
+        for image in (status and status.images) or []:
+            size = image.size_bytes or 0
+            used += size
+            for ref in image.names or []:
+                self.sizes[normalize(ref)] = size
+        self.used[name] = used
+        capacity = parse_quantity(
+            ((status and status.capacity) or {}).get("ephemeral-storage"))
+        allocatable = parse_quantity(
+            ((status and status.allocatable) or {}).get("ephemeral-storage"))
+        limit = None
+        if capacity:
+            limit = capacity * self.fraction
+            if allocatable:
+                limit = min(limit, allocatable)
+        self.limits[name] = limit
+
+    def drop_node(self, name):
+        self.limits.pop(name, None)
+        self.used.pop(name, None)
+
+    def free(self, name):
+        """Return the bytes of images a node can still take, or None if
+        its capacity is not known.
+        """
+        limit = self.limits.get(name)
+        if limit is None:
+            return None
+        return max(0, limit - self.used.get(name, 0))
+
+    def fit(self, name, images, cost, pending=0):
+        """Split a node's images, in priority order, into those that fit
+        in what is left of its budget after `pending` bytes, and those
+        that do not.  cost(chosen, img) gives the bytes img adds to the
+        node after the images in chosen.  Images too big to fit are
+        passed over for smaller ones further down.
+        """
+        free = self.free(name)
+        if free is None:
+            return list(images), []
+        free -= pending
+        chosen = []
+        over = []
+        for img in images:
+            size = cost(chosen, img)
+            if size <= free:
+                chosen.append(img)
+                free -= size
+            else:
+                over.append(img)
+        return chosen, over
@@ -0,0 +1,253 @@
+import base64
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+
+
+class JournalConflict(Exception):
+    """Someone else wrote the journal since we read it."""
+    pass
+
+
+class PullJournal(object):
+    """A record, kept across runs, of the pulls that finished, so that a
+    run cut short by its timeout is picked up where it stopped instead of
+    starting over.
+
+    Entries are keyed by node, image and digest, so a tag that moves is
+    pulled again, and hold the last outcome, when it came and how many
+    times in a row the pull has failed.  The node is named by the
+    caller, which should tell apart nodes made again under the same
+    name.  Entries older than `max_age` seconds are dropped: the journal
+    only bridges a run and the next, and images pulled long ago may
+    since have been garbage-collected.  Outcomes are written back every
+    `flush_interval` seconds and by save(), which merges them into what
+    is stored, so that replicas sharing a journal do not lose each
+    other's entries.  Subclasses say where the journal is stored.
+    """
+    max_age = 86400
+    flush_interval = 30
+    retries = 5
+    logger = None
+
+    def __init__(self, logger=None):
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(__name__)
+        self.entries = {}
+        self._changed = set()
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._saved = time.time()
+
+    def _read(self):
+        """Return the stored journal, as decoded JSON or None, and a token
+        to hand back to _write().
+        """
+        raise NotImplementedError
+
+    def _write(self, data, token):
+        """Store the journal, raising JournalConflict if it changed since
+        _read() returned token.
+        """
+        raise NotImplementedError
+
+    @contextmanager
+    def _locked(self):
+        yield
+
+    def _decode(self, data):
+        entries = {}
+        for ref, nodes in ((data or {}).get("pulls") or {}).items():
+            img, digest = ref, None
+            if "@" in ref:
+                img, digest = ref.rsplit("@", 1)
+            for node, entry in nodes.items():
+                entries[(node, img, digest)] = list(entry)
+        return entries
+
+    def _encode(self, entries):
+        pulls = {}
+        for (node, img, digest), entry in entries.items():
+            ref = img
+            if digest:
+                ref = img + "@" + digest
+            pulls.setdefault(ref, {})[node] = entry
+        return {"version": 1, "pulls": pulls}
+
+    def load(self):
+        """Read the stored journal.  Failure to read is logged, and leaves
+        the journal empty.
+        """
+        try:
+            with self._locked():
+                data = self._read()[0]
+        except Exception as e:
+            self.logger.warning("Cannot read pull journal: %s" % str(e))
+            return
+        with self._lock:
+            self.entries = self._decode(data)
+        self.logger.info("Pull journal holds %d entries." %
+                         len(self.entries))
+
+    def done(self, node, img, digest):
+        entry = self.entries.get((node, img, digest))
+        return bool(entry) and entry[0] == "Succeeded"
+
+    def failures(self, node, img, digest):
+        entry = self.entries.get((node, img, digest))
+        if not entry:
+            return 0
+        return entry[2]
+
+    def record(self, node, img, digest, phase):
+        """Record the outcome of a pull, and write the journal back if it
+        is time to.
+        """
+        key = (node, img, digest)
+        with self._lock:
+            failures = 0
+            if phase != "Succeeded":
+                failures = self.failures(node, img, digest) + 1
+            self.entries[key] = [phase, round(time.time()), failures]
+            self._changed.add(key)
+        if time.time() - self._saved > self.flush_interval:
+            self.save(wait=False)
+
+    def save(self, wait=True):
+        """Merge our new entries into the stored journal and write it,
+        retrying on conflicts.  Without wait, give up at once if another
+        thread is already saving.  Failure to write is logged, not raised.
+        """
+        if not self._save_lock.acquire(wait):
+            return
+        try:
+            self._saved = time.time()
+            with self._lock:
+                changed = dict([(x, self.entries[x]) for x in self._changed])
+            if not changed:
+                return
+            for attempt in range(self.retries):
+                with self._locked():
+                    data, token = self._read()
+                    merged = self._decode(data)
+                    merged.update(changed)
+                    cutoff = time.time() - self.max_age
+                    merged = dict([(x, merged[x]) for x in merged
+                                   if merged[x][1] >= cutoff])
+                    try:
+                        self._write(self._encode(merged), token)
+                    except JournalConflict:
+                        continue
+                with self._lock:
+                    for key in changed:
+                        if self.entries.get(key) is changed[key]:
+                            self._changed.discard(key)
+                    merged.update(dict([(x, self.entries[x])
+                                        for x in self._changed]))
+                    self.entries = merged
+                return
+            self.logger.warning("Pull journal kept changing; not saved.")
+        except Exception as e:
+            self.logger.warning("Cannot write pull journal: %s" % str(e))
+        finally:
+            self._save_lock.release()
+
+
+class FileJournal(PullJournal):
+    """A PullJournal in a local JSON file, replaced atomically and guarded
+    by a lock file, like the tag cache.
+    """
+
+    def __init__(self, path, logger=None):
+        super(FileJournal, self).__init__(logger=logger)
+        self.path = path
+        self.lockname = path + ".lock"
+
+    @contextmanager
+    def _locked(self):
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with open(self.lockname, "a") as lockf:
+            fcntl.flock(lockf, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockf, fcntl.LOCK_UN)
+
+    def _read(self):
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f), None
+        except (OSError, ValueError):
+            return None, None
+
+    def _write(self, data, token):
+        fd, tmpname = tempfile.mkstemp(
+            dir=os.path.dirname(self.path) or ".", prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmpname, self.path)
+        except BaseException:
+            os.unlink(tmpname)
+            raise
+
+
+class ConfigMapJournal(PullJournal):
+    """A PullJournal in a ConfigMap, so that it outlives the pod.  The
+    JSON is compressed to stay well within the ConfigMap size limit on
+    large clusters, and written at the resource version read, as the
+    shard membership is.
+    """
+    key = "journal"
+
+    def __init__(self, client, namespace, name, logger=None):
+        super(ConfigMapJournal, self).__init__(logger=logger)
+        self.client = client
+        self.namespace = namespace
+        self.name = name
+
+    def _read(self):
+        try:
+            cm = self.client.read_namespaced_config_map(self.name,
+                                                        self.namespace)
+        except ApiException as e:
+            if e.status != 404:
+                raise
+            return None, None
+        raw = (cm.data or {}).get(self.key)
+        if not raw:
+            return None, cm
+        return json.loads(zlib.decompress(
+            base64.b64decode(raw)).decode("utf-8")), cm
+
+    def _write(self, data, cm):
+        raw = base64.b64encode(zlib.compress(
+            json.dumps(data).encode("utf-8"))).decode("ascii")
+        try:
+            if cm is None:
+                self.client.create_namespaced_config_map(
+                    self.namespace, client.V1ConfigMap(
+                        metadata=client.V1ObjectMeta(name=self.name),
+                        data={self.key: raw}))
+            else:
+                cm.data = {self.key: raw}
+                self.client.replace_namespaced_config_map(
+                    self.name, self.namespace, cm)
+        except ApiException as e:
+            if e.status == 409:
+                raise JournalConflict()
+            raise
@@ -0,0 +1,82 @@
+class LayerPlan(object):
+    """Order each node's pulls to make the most of the layers images
+    share, and estimate how many bytes each node has to fetch.
+
+    `layers` maps image to a list of (layer digest, size) tuples.  A
+    node's first pull is the image with the most bytes in layers that
+    its other pulls also need, which brings the common base down once.
+    After that the image with the fewest bytes still to fetch goes next,
+    so images become usable as early as possible.  Ties keep the order
+    the images came in (priority order), and images whose layers are
+    unknown go last, in that order.
+    """
+
+    def __init__(self, layers):
+        self.layers = layers
+        self.sizes = {}
+        for img in layers:
+            for digest, size in layers[img]:
+                self.sizes[digest] = size
+        self._orders = {}
+
+    def digests(self, img):
+        return set([x[0] for x in self.layers.get(img, [])])
+
+    def present_layers(self, images):
+        """Return the layers held by a node that has the given images.
+        """
+        present = set()
+        for img in images:
+            present.update(self.digests(img))
+        return present
+
+    def _bytes(self, digests):
+        return sum([self.sizes[x] for x in digests])
+
+    def expected_bytes(self, images, present=None):
+        """Return the bytes a node with the given layers present needs to
+        fetch to pull the images.  Unknown images count as nothing.
+        """
+        needed = set()
+        for img in images:
+            needed.update(self.digests(img))
+        return self._bytes(needed - set(present or ()))
+
+    def order(self, images, present=None):
+        """Return the images in the order to pull them onto a node which
+        already has the layers in present.
+        """
+        present = frozenset(present or ())
+        key = (tuple(images), present)
+        if key not in self._orders:
+            self._orders[key] = self._order(images, present)
+        return list(self._orders[key])
+
+    def _order(self, images, present):
+        known = [x for x in images if x in self.layers]
+        unknown = [x for x in images if x not in self.layers]
+        if not known:
+            return unknown
+        missing = {}
+        for img in known:
+            missing[img] = self.digests(img) - present
+        users = {}
+        for img in known:
+            for digest in missing[img]:
+                users[digest] = users.get(digest, 0) + 1
+
+        def shared(img):
+            return sum([self.sizes[x] * (users[x] - 1)
+                        for x in missing[img]])
+
+        first = max(known, key=lambda x: (shared(x), -known.index(x)))
+        ordered = [first]
+        have = set(present) | missing[first]
+        rest = [x for x in known if x != first]
+        while rest:
+            nxt = min(rest, key=lambda x: (self._bytes(missing[x] - have),
+                                           rest.index(x)))
+            ordered.append(nxt)
+            have |= missing[nxt]
+            rest.remove(nxt)
+        return ordered + unknown
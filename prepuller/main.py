@@ -1,15 +1,57 @@
 #!/usr/bin/env python3
 import argparse
+import json
+import os
 import shlex
+from .controller import PrepullController
+from .planner import DryRunPlanner
 from .prepuller import Prepuller
+from .scanrepo import describe_cache
 
 
 def standalone():
     args = parse_args()
-    prepuller = Prepuller(args=args)
+    if args.cache_info:
+        print(json.dumps(describe_cache(args.cache_dir), sort_keys=True,
+                         indent=4))
+        return
+    if args.plan:
+        # Either engine plans the same way.
+        planner = DryRunPlanner(Prepuller(args=args),
+                                history=args.plan_history)
+        print(json.dumps(planner.run(), sort_keys=True, indent=4))
+        return
+    if args.engine == "async":
+        from .aioprepuller import AsyncPrepuller
+        prepuller = AsyncPrepuller(args=args)
+    else:
+        prepuller = Prepuller(args=args)
+    if args.metrics_port:
+        prepuller.metrics.serve(args.metrics_port)
+    try:
+        run(prepuller, args)
+    finally:
+        if prepuller.shard:
+            prepuller.shard.leave()
+        if prepuller.journal:
+            prepuller.journal.save()
+        if args.metrics_file:
+            prepuller.metrics.write(args.metrics_file,
+                                    fmt=args.metrics_format)
+
+
+def run(prepuller, args):
+    if args.engine == "async":
+        prepuller.run_standalone()
+        return
+    if args.daemon:
+        controller = PrepullController(prepuller,
+                                       rescan_interval=args.rescan_interval)
+        controller.run()
+        return
     prepuller.update_images_from_repo()
     prepuller.build_nodelist()
-    prepuller.build_pod_specs()
+    prepuller.build_plan()
     prepuller.clean_completed_pods()
     prepuller.run_pods()
 
@@ -50,6 +92,35 @@ def parse_args():
     parser.add_argument("-s", "--sort", "--sort-field", "--sort-by",
                         help="Field to sort results by [comp_ts]",
                         default="comp_ts")
+    parser.add_argument("--registry-api", choices=["hub", "registry"],
+                        help="API to list tags through: Docker Hub's" +
+                        " (hub), or the Docker Registry HTTP API, which" +
+                        " gives no tag times, so tags sort by name" +
+                        " (registry) [hub]",
+                        default="hub")
+    parser.add_argument("--repos", "--repositories",
+                        help="YAML or JSON file listing repositories to" +
+                        " scan at once, each with its own retention, sort" +
+                        " and credentials; anything left out comes from" +
+                        " the options above [scan only the one repo]")
+    parser.add_argument("--scan-workers", type=int,
+                        help="Tag pages to fetch at once [8]",
+                        default=8)
+    parser.add_argument("--incremental-scan", action="store_true",
+                        help="Read tags newest first and stop once the" +
+                        " newest of each class are known (needs a" +
+                        " time sort field)")
+    parser.add_argument("--cache-dir",
+                        help="Directory for the persistent tag cache" +
+                        " [no cache]")
+    parser.add_argument("--cache-ttl", type=int,
+                        help=("Seconds a cached scan is used without" +
+                              " asking the registry (0 to always" +
+                              " revalidate) [0]"),
+                        default=0)
+    parser.add_argument("--cache-info", action="store_true",
+                        help="Describe the tag cache in --cache-dir and" +
+                        " exit")
     parser.add_argument("--no-scan", action="store_true",
                         help="Do not do repo scan (only useful in" +
                         " conjunction with --list)")
@@ -62,12 +133,183 @@ def parse_args():
                               "(-1 for no timeout) [3300]"),
                         type=int,
                         default=3300)
+    parser.add_argument("--node-concurrency", type=int,
+                        help=("Images to pull at once on each node (more" +
+                              " than 1 needs kubelet" +
+                              " --serialize-image-pulls=false) [1]"),
+                        default=1)
+    parser.add_argument("--max-in-flight", type=int,
+                        help="Maximum pods running across the cluster [50]",
+                        default=50)
+    parser.add_argument("--repull", action="store_true",
+                        help="Pull images even on nodes that already" +
+                        " report having them")
+    parser.add_argument("--engine", choices=["thread", "async"],
+                        help=("Run pulls on a thread pool or as coroutines" +
+                              " on one event loop (needs the 'async'" +
+                              " extra) [thread]"),
+                        default="thread")
+    parser.add_argument("--pull-order",
+                        choices=["priority", "layers", "name"],
+                        help=("Pull the newest release, weekly and daily" +
+                              " first, and older tags later; reorder each" +
+                              " node's pulls for layer reuse, using the" +
+                              " image manifests; or pull by image name" +
+                              " [priority]"),
+                        default="priority")
+    parser.add_argument("--priority-weights",
+                        help=("JSON file mapping images or tags to usage" +
+                              " weights, such as spawn counts, that raise" +
+                              " their pull priority"))
+    parser.add_argument("--backend", choices=["pod", "daemonset"],
+                        help=("Pull with one pod per node and image, or" +
+                              " with DaemonSets [pod]"),
+                        default="pod")
+    parser.add_argument("--daemonset-layout",
+                        choices=["combined", "per-image"],
+                        help=("One DaemonSet with an init container per" +
+                              " image, or one DaemonSet per image" +
+                              " [combined]"),
+                        default="combined")
+    parser.add_argument("--pause-image",
+                        help=("Image for the DaemonSet pods' main" +
+                              " container [k8s.gcr.io/pause:3.1]"),
+                        default="k8s.gcr.io/pause:3.1")
+    parser.add_argument("--daemon", "--controller", action="store_true",
+                        help=("Keep running: watch nodes, rescan the" +
+                              " repository periodically, and pull only" +
+                              " what is missing (ignores --timeout)"))
+    parser.add_argument("--rescan-interval", type=int,
+                        help="Seconds between repository scans in" +
+                        " daemon mode [300]",
+                        default=300)
+    parser.add_argument("--sharding", choices=["off", "hash", "label"],
+                        help=("Split nodes among replicas by hashing node" +
+                              " names, or by hashing the value of" +
+                              " --shard-label [off]"),
+                        default="off")
+    parser.add_argument("--shard-label",
+                        help="Node label to shard by with --sharding label")
+    parser.add_argument("--replica-id",
+                        help=("This replica's name among the others" +
+                              " [$POD_NAME, or the host name]"))
+    parser.add_argument("--member-ttl", type=int,
+                        help=("Seconds after which a replica that has not" +
+                              " renewed its membership is taken as dead" +
+                              " [30]"),
+                        default=30)
+    parser.add_argument("--node-selector",
+                        help=("Only prepull onto nodes matching this label" +
+                              " selector, e.g. 'jupyterlab=ok' [all]"))
+    parser.add_argument("--node-field-selector",
+                        help=("Only prepull onto nodes matching this field" +
+                              " selector, e.g. 'spec.unschedulable=false'" +
+                              " [all]"))
+    parser.add_argument("--tolerations",
+                        help=("YAML or JSON file with the tolerations of" +
+                              " the lab pods; nodes with NoSchedule or" +
+                              " NoExecute taints these do not cover are" +
+                              " skipped [none]"))
+    parser.add_argument("--node-page-size", type=int,
+                        help="Nodes to list per API call [500]",
+                        default=500)
+    parser.add_argument("--disk-budget", type=float,
+                        help=("Fraction of each node's ephemeral storage" +
+                              " that images may fill; pulls that would go" +
+                              " past it are skipped, lowest priority first" +
+                              " (keep below the kubelet's image GC high" +
+                              " threshold) [no limit]"))
+    parser.add_argument("--journal", choices=["off", "file", "configmap"],
+                        help=("Keep a journal of finished pulls, so that" +
+                              " a run cut short by --timeout is resumed by" +
+                              " the next one [off]"),
+                        default="off")
+    parser.add_argument("--journal-path",
+                        help=("Journal file, or ConfigMap name, with" +
+                              " --journal [prepuller-journal.json," +
+                              " prepuller-journal]"))
+    parser.add_argument("--journal-max-failures", type=int,
+                        help=("Stop retrying a pull the journal shows has" +
+                              " failed this many runs running; 0 to" +
+                              " always retry [0]"),
+                        default=0)
+    parser.add_argument("--no-pin-digests", dest="pin_digests",
+                        action="store_false",
+                        help=("Pull by tag with imagePullPolicy Always," +
+                              " instead of by the digest found by the scan" +
+                              " with IfNotPresent"))
+    parser.add_argument("--api-write-qps", type=float,
+                        help=("Kubernetes API creates, deletes, patches and" +
+                              " replaces per second, halved while the API" +
+                              " server answers 429; 0 for no limit [20]"),
+                        default=20)
+    parser.add_argument("--api-read-qps", type=float,
+                        help=("Kubernetes API reads and lists per second;" +
+                              " 0 for no limit [50]"),
+                        default=50)
+    parser.add_argument("--api-retries", type=int,
+                        help=("Retries of a Kubernetes API call that fails" +
+                              " with 429, 5xx or a connection error [5]"),
+                        default=5)
+    parser.add_argument("--metrics-port", type=int,
+                        help="Serve Prometheus metrics on this port at" +
+                        " /metrics [off]")
+    parser.add_argument("--metrics-file",
+                        help="Write metrics to this file when done [off]")
+    parser.add_argument("--metrics-format", choices=["prom", "json"],
+                        help=("Metrics file format: Prometheus text, or" +
+                              " JSON with per-pull timings [prom]"),
+                        default="prom")
+    parser.add_argument("--plan", "--dry-run", action="store_true",
+                        help="Scan, list nodes and plan, then print the" +
+                        " plan and its estimated cost as JSON, without" +
+                        " changing anything in the cluster")
+    parser.add_argument("--plan-history", action="append",
+                        help="JSON metrics file of an earlier run, for" +
+                        " estimating pull times in --plan; may be given" +
+                        " more than once [assume 60 s a pull]")
     parser.add_argument("--namespace", help="Kubernetes namespace [namespace" +
                         " of container, or 'default' if not run inside" +
                         " kubernetes]")
     results = parser.parse_args()
-    results.path = ("/v2/repositories/" + results.owner + "/" +
-                    results.name + "/tags/")
+    if results.cache_info and not results.cache_dir:
+        parser.error("--cache-info needs --cache-dir")
+    if results.cache_info and not os.path.isdir(results.cache_dir):
+        parser.error("There is no tag cache in %s" % results.cache_dir)
+    if results.disk_budget is not None and not (
+            0 < results.disk_budget <= 1):
+        parser.error("--disk-budget must be above 0 and at most 1")
+    if results.plan:
+        if results.daemon:
+            parser.error("--plan plans a single run, not --daemon")
+        if results.backend != "pod":
+            parser.error("--plan estimates the pod backend")
+        # A plan covers every node, and joining a shard would write.
+        results.sharding = "off"
+    elif results.plan_history:
+        parser.error("--plan-history needs --plan")
+    if results.journal == "configmap" and results.engine != "thread":
+        parser.error("--journal configmap needs the thread engine")
+    if results.backend == "daemonset" and results.engine != "thread":
+        parser.error("--backend daemonset needs the thread engine")
+    if results.sharding != "off":
+        if results.engine != "thread" or results.backend != "pod":
+            parser.error("--sharding needs the thread engine and the pod" +
+                         " backend")
+        if results.sharding == "label" and not results.shard_label:
+            parser.error("--sharding label needs --shard-label")
+    if results.daemon:
+        if results.engine != "thread":
+            parser.error("--daemon needs the thread engine")
+        if results.backend != "pod":
+            parser.error("--daemon needs the pod backend")
+        # The controller runs until told to stop.
+        results.timeout = -1
+    if results.registry_api == "registry":
+        results.path = "/v2/%s/%s/tags/list" % (results.owner, results.name)
+    else:
+        results.path = ("/v2/repositories/" + results.owner + "/" +
+                        results.name + "/tags/")
     if results.list:
         results.list = list(set(results.list.split(',')))
     if results.command:
@@ -0,0 +1,300 @@
+import functools
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+class Metrics(object):
+    """Thread-safe store for counters, gauges, histograms and per-pull
+    records, renderable in the Prometheus text format or as JSON.
+
+    Prometheus gets aggregates only; per-(node, image) detail is kept
+    for the JSON dump, where label cardinality does not matter.  With
+    `max_pulls`, only that many of the latest pulls are kept, so that a
+    long-running prepuller does not keep every pull it ever made.
+    """
+    buckets = [0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600]
+    help = {
+        "prepuller_phase_duration_seconds":
+            "Duration of the last run of each prepuller phase.",
+        "prepuller_pull_duration_seconds":
+            "Time spent in each stage of a prepull pod.",
+        "prepuller_pulls_total":
+            "Prepull pods finished, by outcome.",
+        "prepuller_pulls_deferred_total":
+            "Pulls not started for lack of time.",
+        "prepuller_api_calls_total":
+            "Kubernetes API calls, by verb.",
+        "prepuller_api_call_duration_seconds":
+            "Kubernetes API call latency, by verb.",
+        "prepuller_api_errors_total":
+            "Kubernetes API calls that raised, by verb and status.",
+        "prepuller_api_retries_total":
+            "Kubernetes API calls retried, by call class and status.",
+        "prepuller_api_throttled_seconds_total":
+            "Time spent waiting on the API rate limit, by call class.",
+        "prepuller_api_rate_limit":
+            "Current API rate limit in calls a second, by call class.",
+        "prepuller_failures_total":
+            "Failures, by kind.",
+        "prepuller_expected_bytes":
+            "Bytes the planned pulls are expected to fetch.",
+        "prepuller_pulls_over_budget":
+            "Pulls left out of the plan for lack of disk.",
+    }
+    types = {
+        "prepuller_phase_duration_seconds": "gauge",
+        "prepuller_pull_duration_seconds": "histogram",
+        "prepuller_pulls_total": "counter",
+        "prepuller_pulls_deferred_total": "counter",
+        "prepuller_api_calls_total": "counter",
+        "prepuller_api_call_duration_seconds": "histogram",
+        "prepuller_api_errors_total": "counter",
+        "prepuller_api_retries_total": "counter",
+        "prepuller_api_throttled_seconds_total": "counter",
+        "prepuller_api_rate_limit": "gauge",
+        "prepuller_failures_total": "counter",
+        "prepuller_expected_bytes": "gauge",
+        "prepuller_pulls_over_budget": "gauge",
+    }
+
+    max_pulls = None
+
+    def __init__(self, max_pulls=None):
+        if max_pulls:
+            self.max_pulls = max_pulls
+        self._lock = threading.Lock()
+        self.values = {}
+        self.histograms = {}
+        self.pulls = deque(maxlen=self.max_pulls)
+        self.started = time.time()
+        self._server = None
+
+    def _key(self, name, labels):
+        return (name, tuple(sorted((labels or {}).items())))
+
+    def inc(self, name, labels=None, value=1):
+        key = self._key(name, labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, labels=None):
+        with self._lock:
+            self.values[self._key(name, labels)] = value
+
+    def observe(self, name, value, labels=None):
+        key = self._key(name, labels)
+        with self._lock:
+            hist = self.histograms.get(key)
+            if not hist:
+                hist = {"buckets": [0] * len(self.buckets), "sum": 0.0,
+                        "count": 0}
+                self.histograms[key] = hist
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    hist["buckets"][idx] += 1
+            hist["sum"] += value
+            hist["count"] += 1
+
+    @contextmanager
+    def timer(self, phase):
+        """Time a phase of the run.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.set("prepuller_phase_duration_seconds",
+                     time.time() - start, {"phase": phase})
+
+    def failure(self, kind):
+        self.inc("prepuller_failures_total", {"kind": kind})
+
+    def record_pull(self, node, image, phase, stages, digest=None):
+        """Record one finished pull.  stages maps stage name (scheduled,
+        running, completed, total) to seconds.
+        """
+        self.inc("prepuller_pulls_total", {"phase": phase})
+        for stage in stages:
+            self.observe("prepuller_pull_duration_seconds", stages[stage],
+                         {"stage": stage})
+        with self._lock:
+            self.pulls.append({"node": node, "image": image,
+                               "digest": digest, "phase": phase,
+                               "stages": stages})
+
+    def _labelstr(self, labels, extra=None):
+        labels = list(labels)
+        if extra:
+            labels.append(extra)
+        if not labels:
+            return ""
+        return "{%s}" % ",".join(['%s="%s"' % (k, self._escape(v))
+                                  for k, v in labels])
+
+    def _escape(self, value):
+        # As the text format wants label values.
+        return str(value).replace("\\", "\\\\").replace(
+            '"', '\\"').replace("\n", "\\n")
+
+    def render(self):
+        """Return the metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        with self._lock:
+            names = sorted(set([x[0] for x in self.values] +
+                               [x[0] for x in self.histograms]))
+            for name in names:
+                lines.append("# HELP %s %s" % (name, self.help.get(name,
+                                                                   name)))
+                lines.append("# TYPE %s %s" % (name, self.types.get(
+                    name, "untyped")))
+                for key in sorted(self.values):
+                    if key[0] == name:
+                        lines.append("%s%s %s" % (name,
+                                                  self._labelstr(key[1]),
+                                                  repr(self.values[key])))
+                for key in sorted(self.histograms):
+                    if key[0] != name:
+                        continue
+                    hist = self.histograms[key]
+                    for idx, bound in enumerate(self.buckets):
+                        lines.append("%s_bucket%s %d" % (
+                            name, self._labelstr(key[1], ("le", bound)),
+                            hist["buckets"][idx]))
+                    lines.append("%s_bucket%s %d" % (
+                        name, self._labelstr(key[1], ("le", "+Inf")),
+                        hist["count"]))
+                    lines.append("%s_sum%s %s" % (
+                        name, self._labelstr(key[1]), repr(hist["sum"])))
+                    lines.append("%s_count%s %d" % (
+                        name, self._labelstr(key[1]), hist["count"]))
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self):
+        """Return everything, including per-pull records, as a dict.
+        """
+        with self._lock:
+            values = [{"name": k[0], "labels": dict(k[1]), "value": v}
+                      for k, v in sorted(self.values.items())]
+            histograms = [{"name": k[0], "labels": dict(k[1]),
+                           "sum": v["sum"], "count": v["count"]}
+                          for k, v in sorted(self.histograms.items())]
+            pulls = list(self.pulls)
+        return {"started": self.started,
+                "duration": time.time() - self.started,
+                "metrics": values,
+                "histograms": histograms,
+                "pulls": pulls}
+
+    def write(self, path, fmt="prom"):
+        """Write the metrics to a file, atomically, as Prometheus text
+        (suitable for the node exporter's textfile collector) or JSON.
+        """
+        if fmt == "json":
+            data = json.dumps(self.to_dict(), sort_keys=True, indent=4)
+        else:
+            data = self.render()
+        dirname = os.path.dirname(os.path.abspath(path))
+        fd, tmpname = tempfile.mkstemp(dir=dirname, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(data)
+            os.replace(tmpname, path)
+        except BaseException:
+            os.unlink(tmpname)
+            raise
+
+    def serve(self, port, addr=""):
+        """Serve /metrics over HTTP from a daemon thread.
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type",
+                                 "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = HTTPServer((addr, port), Handler)
+        thd = threading.Thread(target=self._server.serve_forever,
+                               name="metrics")
+        thd.daemon = True
+        thd.start()
+        return self._server
+
+
+class InstrumentedApi(object):
+    """Wrap a Kubernetes API object so that every call is counted and
+    timed by verb (create, read, list, watch, delete, ...).  Calls that
+    return awaitables, as with kubernetes_asyncio, are timed when awaited.
+    """
+    verbs = ["delete_collection", "create", "read", "list", "delete",
+             "patch", "replace"]
+
+    def __init__(self, api, metrics):
+        self._api = api
+        self._metrics = metrics
+
+    def _verb(self, name, kwargs):
+        if kwargs.get("watch"):
+            return "watch"
+        for verb in self.verbs:
+            if name.startswith(verb + "_"):
+                return verb
+        return name
+
+    def __getattr__(self, name):
+        attr = getattr(self._api, name)
+        if not callable(attr) or name.startswith("_"):
+            return attr
+        metrics = self._metrics
+
+        # wraps() keeps the docstring, which kubernetes.watch reads to
+        # find the return type.
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            verb = self._verb(name, kwargs)
+            metrics.inc("prepuller_api_calls_total", {"verb": verb})
+            start = time.time()
+            try:
+                result = attr(*args, **kwargs)
+            except Exception as e:
+                self._error(verb, e)
+                raise
+            if hasattr(result, "__await__"):
+                return self._timed(verb, start, result)
+            metrics.observe("prepuller_api_call_duration_seconds",
+                            time.time() - start, {"verb": verb})
+            return result
+        return call
+
+    def _error(self, verb, exc):
+        self._metrics.inc("prepuller_api_errors_total",
+                          {"verb": verb,
+                           "status": str(getattr(exc, "status", None))})
+
+    async def _timed(self, verb, start, awaitable):
+        try:
+            result = await awaitable
+        except Exception as e:
+            self._error(verb, e)
+            raise
+        self._metrics.observe("prepuller_api_call_duration_seconds",
+                              time.time() - start, {"verb": verb})
+        return result
@@ -0,0 +1,92 @@
+import hashlib
+import re
+import threading
+
+
+class PodNamer(object):
+    """Name prepull pods, and remember what each name stands for.
+
+    A pod name is `prefix`, a readable part from the image and the node,
+    and a hash of the node name, the whole image reference and the
+    digest it is pulled by, so names are stable from run to run and do
+    not collide even where the readable parts do.  When a tag moves, the
+    pull of its new digest gets a new name, so a pod left pulling the
+    old one is not mistaken for it.  Names are valid DNS labels, no
+    longer than 63 characters.
+    Each name is worked out once, and `index` maps it back to its node,
+    image and digest.  Container names are made the same way from the
+    image alone.
+    """
+    prefix = "pp-"
+    max_length = 63
+    hash_length = 10
+    image_part = 28
+
+    def __init__(self):
+        self.names = {}
+        self.index = {}
+        self.containers = {}
+        self._lock = threading.Lock()
+
+    def _slug(self, text, length):
+        text = re.sub(r"[^a-z0-9]+", "-", text.lower())
+        return text[:length].strip("-")
+
+    def _image_slug(self, img):
+        # The repository's last component and the tag or digest.
+        return self._slug(img.split("/")[-1], self.image_part)
+
+    def _hashed(self, readable, key, taken):
+        """Join readable and a hash of key, lengthening the hash until
+        taken(name) is False.
+        """
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        for length in range(self.hash_length, len(digest) + 1):
+            room = self.max_length - len(self.prefix) - length - 1
+            head = readable[:room].strip("-")
+            if head:
+                head += "-"
+            name = self.prefix + head + digest[:length]
+            if not taken(name):
+                return name
+        raise RuntimeError("No free name for %s" % key)
+
+    def name(self, node, img, digest=None):
+        """Return the pod name for pulling an image, at digest if it is
+        known, onto a node.
+        """
+        key = (node, img, digest)
+        name = self.names.get(key)
+        if name:
+            return name
+        with self._lock:
+            name = self.names.get(key)
+            if not name:
+                readable = self._image_slug(img) + "-" + self._slug(node, 63)
+                name = self._hashed(
+                    readable, "\0".join([node, img, digest or ""]),
+                    lambda x: x in self.index and self.index[x] != key)
+                self.names[key] = name
+                self.index[name] = key
+        return name
+
+    def container_name(self, img):
+        """Return the container name for pulling an image.
+        """
+        name = self.containers.get(img)
+        if name:
+            return name
+        with self._lock:
+            name = self.containers.get(img)
+            if not name:
+                taken = set(self.containers.values())
+                name = self._hashed(self._image_slug(img), img,
+                                    lambda x: x in taken)
+                self.containers[img] = name
+        return name
+
+    def lookup(self, name):
+        """Return (node, image, digest) for a pod name, or None if it is
+        not one of ours.
+        """
+        return self.index.get(name)
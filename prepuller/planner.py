@@ -0,0 +1,280 @@
+import heapq
+import json
+import logging
+import signal
+import statistics
+import time
+from collections import deque
+
+
+class ReadOnlyApi(object):
+    """Wrap a Kubernetes API object so that any call that could change
+    the cluster fails instead, for dry runs.
+    """
+    writes = ["create_", "delete_", "patch_", "replace_"]
+
+    def __init__(self, api):
+        self._api = api
+
+    def __getattr__(self, name):
+        if any([name.startswith(x) for x in self.writes]):
+            raise RuntimeError("%s is not allowed in a dry run" % name)
+        return getattr(self._api, name)
+
+
+class PullHistory(object):
+    """How long pulls took in earlier runs, from metrics files written
+    with --metrics-format json, for estimating how long pulls will take.
+
+    A pull is estimated as the median time of the earlier successful
+    pulls of the same image, else of any image from the same repository
+    (a new daily is much like the last one), else of any image at all,
+    else as `default_seconds`.
+    """
+    default_seconds = 60.0
+
+    def __init__(self, paths=None, logger=None):
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(__name__)
+        self.by_image = {}
+        self.by_repo = {}
+        self.samples = []
+        self._medians = {}
+        for path in paths or []:
+            self.load(path)
+
+    def _repository(self, img):
+        img = img.split("@", 1)[0]
+        if ":" in img.split("/")[-1]:
+            img = img.rsplit(":", 1)[0]
+        return img
+
+    def load(self, path):
+        """Add the successful pulls in a metrics file.  A file that
+        cannot be read is logged and passed over.
+        """
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            self.logger.warning("Cannot read pull history %s: %s" % (
+                path, str(e)))
+            return
+        count = 0
+        for pull in data.get("pulls") or []:
+            total = (pull.get("stages") or {}).get("total")
+            if pull.get("phase") != "Succeeded" or total is None:
+                continue
+            img = pull["image"]
+            self.by_image.setdefault(img, []).append(total)
+            self.by_repo.setdefault(self._repository(img), []).append(total)
+            self.samples.append(total)
+            count += 1
+        self._medians = {}
+        self.logger.info("Read %d pull times from %s." % (count, path))
+
+    def _median(self, key, samples):
+        if key not in self._medians:
+            self._medians[key] = statistics.median(samples)
+        return self._medians[key]
+
+    def estimate(self, img):
+        """Return the seconds a pull of img is expected to take, and what
+        that is based on: "image", "repository", "all" or "default".
+        """
+        repo = self._repository(img)
+        for basis, key, samples in [
+                ("image", ("image", img), self.by_image.get(img)),
+                ("repository", ("repository", repo), self.by_repo.get(repo)),
+                ("all", ("all",), self.samples)]:
+            if samples:
+                return self._median(key, samples), basis
+        return self.default_seconds, "default"
+
+
+class DryRunPlanner(object):
+    """Work out what a run would do, without doing it.
+
+    Scan, list nodes and plan as a run does, through a client that
+    refuses to write, and report the plan and its expected cost as a
+    dict ready for JSON: the images in pull order, each node's pulls
+    and the pulls it skips, the bytes to fetch, the API calls to make,
+    and the time.  Pull times come from a PullHistory.  The wall time
+    comes from replaying the plan under the same rules as PullScheduler,
+    with each pull taking its estimated time, including stopping at the
+    deadline.  It is never less than the API write rate limit allows
+    for the run's writes: a create and a delete for each pod, and a
+    deletecollection for each completed phase in the cleanup.  The
+    estimates are for the pod backend.
+    """
+
+    def __init__(self, prepuller, history=None):
+        self.prepuller = prepuller
+        self.logger = prepuller.logger
+        self.history = PullHistory(history, logger=self.logger)
+
+    def run(self):
+        """Plan a run and return the report.
+        """
+        pp = self.prepuller
+        pp.client = ReadOnlyApi(pp.client)
+        try:
+            pp.update_images_from_repo()
+            pp.build_nodelist()
+            pp.build_plan()
+        finally:
+            # Nothing is left running for the run timeout to stop.
+            if pp.args.timeout >= 0:
+                signal.alarm(0)
+        budget = None
+        if pp.deadline:
+            budget = max(0.0, pp.deadline - time.time())
+        return self.report(budget)
+
+    def report(self, budget=None):
+        """Report on the prepuller's plan, for a run with budget seconds
+        left for pulling, or no limit.
+        """
+        pp = self.prepuller
+        args = pp.args
+        images = []
+        for img in pp.ordered_images():
+            entry = pp.scan_entries.get(img) or {}
+            images.append({"image": img,
+                           "reference": pp._pull_reference(img),
+                           "digest": pp.digests.get(img),
+                           "score": round(pp.priority.score(img), 4),
+                           "size": entry.get("full_size")})
+        nodes = {}
+        durations = {}
+        basis = {}
+        for node in pp.nodes:
+            pulls = pp.plan.get(node, [])
+            seconds = []
+            for img in pulls:
+                estimate, why = self.history.estimate(img)
+                seconds.append(estimate)
+                basis[why] = basis.get(why, 0) + 1
+            durations[node] = seconds
+            nodes[node] = {"pulls": pulls,
+                           "skipped": pp.skipped.get(node, []),
+                           "over_budget": pp.over_budget.get(node, []),
+                           "given_up": pp.given_up.get(node, []),
+                           "bytes": self._node_bytes(node, pulls),
+                           "pull_seconds": round(sum(seconds), 1)}
+        wall, deferred = self._simulate(durations, budget)
+        pods = sum([len(nodes[x]["pulls"]) for x in nodes]) - deferred
+        writes = 2 * pods + len(pp.completed_phases)
+        floor = 0.0
+        if args.api_write_qps and args.api_write_qps > 0:
+            floor = writes / float(args.api_write_qps)
+        listed = len(pp.nodes) + len(pp.excluded)
+        # The node list, a page at a time, the pod watch, and a read of
+        # each pod when we first wait on it.  That read is skipped if the
+        # watch has already reported the pod, so this is an upper bound.
+        reads = -(-listed // args.node_page_size) + 1 + pods
+
+        def total(key):
+            return sum([len(nodes[x][key]) for x in nodes])
+        bytes_basis = "registry size"
+        if pp.expected_bytes:
+            bytes_basis = "layers"
+        return {"version": 1,
+                "generated": round(time.time()),
+                "settings": {"node_concurrency": args.node_concurrency,
+                             "max_in_flight": args.max_in_flight,
+                             "timeout": args.timeout,
+                             "api_write_qps": args.api_write_qps,
+                             "dailies": args.dailies,
+                             "weeklies": args.weeklies,
+                             "releases": args.releases,
+                             "pull_order": args.pull_order,
+                             "disk_budget": args.disk_budget,
+                             "repull": args.repull},
+                "images": images,
+                "nodes": nodes,
+                "excluded_nodes": pp.excluded,
+                "totals": {"images": len(images),
+                           "nodes": len(nodes),
+                           "excluded_nodes": len(pp.excluded),
+                           "pods": pods,
+                           "skipped": total("skipped"),
+                           "over_budget": total("over_budget"),
+                           "given_up": total("given_up"),
+                           "deferred": deferred,
+                           "bytes": sum([nodes[x]["bytes"] for x in nodes]),
+                           "bytes_basis": bytes_basis,
+                           "api_writes": writes,
+                           "api_reads": reads,
+                           "pull_seconds": round(sum(
+                               [sum(durations[x]) for x in durations]), 1),
+                           "wall_seconds": round(max(wall, floor), 1),
+                           "api_floor_seconds": round(floor, 1)},
+                "estimates": {"history_pulls": len(self.history.samples),
+                              "basis": basis}}
+
+    def _node_bytes(self, node, pulls):
+        """Return the bytes a node is expected to fetch: from the layers
+        it lacks, if they are known, else from the registry sizes of
+        its images, which counts shared layers more than once.
+        """
+        pp = self.prepuller
+        if node in pp.expected_bytes:
+            return pp.expected_bytes[node]
+        return sum([(pp.scan_entries.get(x) or {}).get("full_size") or 0
+                    for x in pulls])
+
+    def _simulate(self, durations, budget=None):
+        """Replay pulls, a dict of node to the estimated seconds of each
+        of its pulls in order, as PullScheduler runs them: a pool of
+        max_in_flight workers taking pulls first come first served, each
+        node having up to node_concurrency pulls queued or running, and
+        no pull started once the mean pull time says it would end after
+        budget seconds.  Return the seconds until the last pull ends and
+        the number of pulls deferred.
+        """
+        args = self.prepuller.args
+        per_node = args.node_concurrency
+        nodes = [x for x in durations if durations[x]]
+        if not nodes:
+            return 0.0, 0
+        workers = min(per_node * len(nodes), args.max_in_flight)
+        queues = dict([(x, deque(durations[x])) for x in nodes])
+        active = dict([(x, 0) for x in nodes])
+        submitted = deque()
+        running = []
+        state = {"now": 0.0, "time": 0.0, "done": 0, "deferred": 0}
+
+        def fill(node, limit):
+            queue = queues[node]
+            while queue and active[node] < limit:
+                if (budget is not None and state["done"] and
+                        state["now"] + state["time"] / state["done"] >
+                        budget):
+                    state["deferred"] += len(queue)
+                    queue.clear()
+                    break
+                submitted.append((node, queue.popleft()))
+                active[node] += 1
+
+        for slot in range(1, per_node + 1):
+            for node in nodes:
+                fill(node, slot)
+        seq = 0
+        while True:
+            while submitted and len(running) < workers:
+                node, seconds = submitted.popleft()
+                heapq.heappush(running, (state["now"] + seconds, seq, node,
+                                         seconds))
+                seq += 1
+            if not running:
+                break
+            end, _, node, seconds = heapq.heappop(running)
+            state["now"] = end
+            state["time"] += seconds
+            state["done"] += 1
+            active[node] -= 1
+            fill(node, per_node)
+        return state["now"], state["deferred"]
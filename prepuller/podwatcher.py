@@ -0,0 +1,341 @@
+import logging
+import threading
+import time
+from kubernetes import watch
+from kubernetes.client.rest import ApiException
+
+
+class PodPhases(object):
+    """The phases of prepuller pods, as a watch on the namespace reports
+    them, and the rules for reading list and watch results into them.
+    PodWatcher and the async engine's watcher share these, and differ
+    only in how they do the I/O and wake up whoever is waiting.
+
+    `ours`, if given, is called with a pod name and says whether the
+    pod is one we may wait on; news of other pods the label selector
+    lets through, such as those of other replicas, is not kept.
+    """
+    client = None
+    namespace = "default"
+    label_selector = None
+    ours = None
+    watch_timeout = 300
+    relist_limit = 500
+    retry_delay = 5
+    logger = None
+    terminal = ["Succeeded", "Failed", "Deleted"]
+
+    def __init__(self, client, namespace, label_selector=None,
+                 watch_timeout=None, relist_limit=None, ours=None,
+                 logger=None):
+        self.client = client
+        self.namespace = namespace
+        if label_selector:
+            self.label_selector = label_selector
+        if ours:
+            self.ours = ours
+        if watch_timeout:
+            self.watch_timeout = watch_timeout
+        if relist_limit:
+            self.relist_limit = relist_limit
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(__name__)
+        self.phases = {}
+        self.final = {}
+        self.waiters = set()
+        self.replaced_uids = set()
+        self.resource_version = None
+
+    def _forget(self, podname, uid=None):
+        self.phases.pop(podname, None)
+        self.final.pop(podname, None)
+        if uid:
+            self.replaced_uids.add(uid)
+
+    def _record(self, podname, phase, deleted=False, pod=None):
+        """Record news of a pod, and return True if it has just reached
+        a terminal phase that a waiter should hear of.
+        """
+        if (self.ours and podname not in self.waiters and
+                not self.ours(podname)):
+            return False
+        if (pod is not None and self.replaced_uids and
+                pod.metadata.uid in self.replaced_uids):
+            # A pod that has been replaced by another of the same name.
+            return False
+        if deleted:
+            if podname not in self.waiters:
+                self.phases.pop(podname, None)
+                self.final.pop(podname, None)
+                return False
+            if self.phases.get(podname) in self.terminal:
+                # Finished, then deleted before the waiter woke up; it
+                # still wants the phase.
+                return False
+            phase = "Deleted"
+        self.phases[podname] = phase
+        if phase not in self.terminal:
+            return False
+        if pod is not None:
+            self.final[podname] = pod
+        return True
+
+    def _update(self, podname, phase, deleted=False, pod=None):
+        raise NotImplementedError()
+
+    def _checked(self, podname, pod):
+        """Take in the pod read for a waiter the watch has not told us
+        about, or None if there was no such pod.
+        """
+        # The watch may have got there first, with newer news.
+        if podname in self.phases:
+            return
+        self._reread(podname, pod)
+
+    def _reread(self, podname, pod):
+        """Take in a pod read again, or None if there was no such pod.
+        """
+        if pod is None:
+            self._update(podname, None, deleted=True)
+        else:
+            self._update(podname, pod.status.phase, pod=pod)
+
+    def _missing(self, seen):
+        """Return the pods being waited on that a relist did not find.
+        Each must be read again before it is taken as deleted: it may
+        have been created after the list was taken.
+        """
+        return [x for x in self.waiters if x not in seen]
+
+    def _relist_kwargs(self):
+        kwargs = {"limit": self.relist_limit}
+        if self.label_selector:
+            kwargs["label_selector"] = self.label_selector
+        return kwargs
+
+    def _relisted_page(self, podlist, kwargs, seen):
+        """Take in a page of a relist, and return True if there is
+        another, having set kwargs to ask for it.
+        """
+        for pod in podlist.items:
+            seen.add(pod.metadata.name)
+            self._update(pod.metadata.name, pod.status.phase, pod=pod)
+        cont = podlist.metadata._continue
+        if not cont:
+            return False
+        kwargs["_continue"] = cont
+        return True
+
+    def _relisted(self, podlist, seen):
+        """Finish a relist, whose last page was podlist, given the pods
+        it found.
+        """
+        self.resource_version = podlist.metadata.resource_version
+        self.logger.debug("Listed %d pods at resource version %s" % (
+            len(seen), self.resource_version))
+
+    def _watch_kwargs(self):
+        kwargs = {"resource_version": self.resource_version,
+                  "timeout_seconds": self.watch_timeout}
+        if self.label_selector:
+            kwargs["label_selector"] = self.label_selector
+        return kwargs
+
+    def _event(self, event):
+        """Take in a watch event, and return False if the watch has
+        failed and must start again from a relist.
+        """
+        etype = event["type"]
+        if etype == "ERROR":
+            raw = event["raw_object"]
+            if raw.get("code") == 410:
+                self.logger.debug("Watch expired; relisting pods.")
+            else:
+                self.logger.warning("Pod watch error: %s" %
+                                    raw.get("message"))
+            self.resource_version = None
+            return False
+        pod = event["object"]
+        self.resource_version = pod.metadata.resource_version
+        self._update(pod.metadata.name, pod.status.phase,
+                     deleted=(etype == "DELETED"), pod=pod)
+        return True
+
+
+class PodWatcher(PodPhases):
+    """Track the phases of prepuller pods through a single shared watch
+    on the namespace, so that workers waiting on individual pods do not
+    each have to poll the API server.
+    """
+    stop_timeout = 5
+
+    def __init__(self, client, namespace, label_selector=None,
+                 watch_timeout=None, relist_limit=None, ours=None,
+                 logger=None):
+        super(PodWatcher, self).__init__(client, namespace,
+                                         label_selector=label_selector,
+                                         watch_timeout=watch_timeout,
+                                         relist_limit=relist_limit,
+                                         ours=ours, logger=logger)
+        self._cond = threading.Condition()
+        self._watch = None
+        self._thread = None
+        self._generation = 0
+
+    def start(self):
+        """Start the watch thread.
+        """
+        if self._thread:
+            return
+        self._generation += 1
+        self._thread = threading.Thread(target=self._run,
+                                        args=(self._generation,),
+                                        name="pod-watcher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop the watch thread, waiting up to stop_timeout seconds for
+        it.  The watch only notices between events, so a quiet watch may
+        hold the thread until its watch_timeout; such a thread passes on
+        nothing more, and, being a daemon, does not keep us running.
+        """
+        self._generation += 1
+        if self._watch:
+            self._watch.stop()
+        thread = self._thread
+        self._thread = None
+        if thread and thread is not threading.current_thread():
+            thread.join(self.stop_timeout)
+            if thread.is_alive():
+                self.logger.debug("Pod watch thread still finishing.")
+
+    def _stopped(self, generation):
+        return generation != self._generation
+
+    def wait(self, podname, timeout=None):
+        """Block until the named pod reaches a terminal phase, and return
+        that phase.  A pod deleted out from under us reports "Deleted".
+        Return None if the timeout (in seconds) expires first.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self._cond:
+            self.waiters.add(podname)
+            known = podname in self.phases
+        try:
+            if not known:
+                self._check(podname)
+            with self._cond:
+                while self.phases.get(podname) not in self.terminal:
+                    remaining = None
+                    if deadline is not None:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            return None
+                    self._cond.wait(remaining)
+                return self.phases[podname]
+        finally:
+            with self._cond:
+                self.waiters.discard(podname)
+
+    def _check(self, podname):
+        """Read a pod the watch has not told us about, in case it
+        finished or was deleted before we began waiting on it.
+        """
+        try:
+            pod = self._read(podname)
+        except ApiException as e:
+            self.logger.debug("Cannot read pod %s: %s" % (podname, str(e)))
+            return
+        with self._cond:
+            self._checked(podname, pod)
+
+    def _read(self, podname):
+        """Return the named pod, or None if there is no such pod.
+        """
+        try:
+            return self.client.read_namespaced_pod(podname, self.namespace)
+        except ApiException as e:
+            if e.status != 404:
+                raise
+        return None
+
+    def final_pod(self, podname):
+        """Return the last pod object seen for a finished pod, or None.
+        """
+        with self._cond:
+            return self.final.get(podname)
+
+    def forget(self, podname):
+        """Drop any state held for a pod we are done with.
+        """
+        with self._cond:
+            self._forget(podname)
+
+    def replaced(self, podname, uid=None):
+        """Drop any state held for a pod that is being replaced, and
+        ignore any further news of the old pod, whose uid is given.
+        """
+        with self._cond:
+            self._forget(podname, uid)
+
+    def _update(self, podname, phase, deleted=False, pod=None):
+        with self._cond:
+            if self._record(podname, phase, deleted=deleted, pod=pod):
+                self._cond.notify_all()
+
+    def _run(self, generation):
+        while not self._stopped(generation):
+            try:
+                if self.resource_version is None:
+                    self._relist()
+                self._watch_pods(generation)
+            except ApiException as e:
+                if e.status == 410:
+                    self.logger.debug("Watch expired; relisting pods.")
+                else:
+                    self.logger.warning("Pod watch failed: %s" % str(e))
+                    time.sleep(self.retry_delay)
+                self.resource_version = None
+            except Exception as e:
+                self.logger.warning("Pod watch failed: %s" % str(e))
+                self.resource_version = None
+                time.sleep(self.retry_delay)
+
+    def _relist(self):
+        """List prepuller pods, a bounded page at a time, to establish
+        current phases and a resource version to watch from.
+        """
+        kwargs = self._relist_kwargs()
+        seen = set()
+        while True:
+            podlist = self.client.list_namespaced_pod(self.namespace,
+                                                      **kwargs)
+            if not self._relisted_page(podlist, kwargs, seen):
+                break
+        with self._cond:
+            missing = self._missing(seen)
+        for podname in missing:
+            try:
+                pod = self._read(podname)
+            except ApiException as e:
+                self.logger.debug("Cannot read pod %s: %s" % (podname,
+                                                             str(e)))
+                continue
+            self._reread(podname, pod)
+        self._relisted(podlist, seen)
+
+    def _watch_pods(self, generation):
+        self._watch = watch.Watch()
+        for event in self._watch.stream(self.client.list_namespaced_pod,
+                                        self.namespace,
+                                        **self._watch_kwargs()):
+            if self._stopped(generation):
+                self._watch.stop()
+                break
+            if not self._event(event):
+                return
@@ -1,20 +1,39 @@
 import argparse
+import copy
+import datetime
 import json
 import logging
 import os
 import signal
+import socket
 import sys
 import time
-from threading import Thread
+import yaml
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 from kubernetes import client, config
+from kubernetes.client.rest import ApiException
 from kubernetes.config.config_exception import ConfigException
+from .daemonset import DaemonSetPuller
+from .disk import DiskBudget
+from .journal import ConfigMapJournal, FileJournal
+from .layers import LayerPlan
+from .metrics import InstrumentedApi, Metrics
+from .naming import PodNamer
+from .podwatcher import PodWatcher
+from .priority import PullPriority
+from .ratelimit import RateLimitedApi, make_limits
 from .scanrepo import ScanRepo
+from .scheduler import PullScheduler
+from .shard import ShardCoordinator
 
 
 class Prepuller(object):
     """Class for generating and reaping the Pods for the prepuller.
     """
     repo = None
+    repos = []
+    image_repos = {}
     logger = None
     client = None
     args = argparse.Namespace(debug=False,
@@ -34,14 +53,87 @@ class Prepuller(object):
                                        "echo Prepuller run for $(hostname)" +
                                        "complete at $(date)."],
                               path="/v2/repositories/lsstsqre/jld-lab/tags/",
+                              registry_api="hub",
                               no_scan=False,
                               namespace=None,
-                              timeout=3300
+                              timeout=3300,
+                              node_concurrency=1,
+                              max_in_flight=50,
+                              repull=False,
+                              engine="thread",
+                              scan_workers=8,
+                              cache_dir=None,
+                              cache_ttl=0,
+                              incremental_scan=False,
+                              daemon=False,
+                              rescan_interval=300,
+                              backend="pod",
+                              daemonset_layout="combined",
+                              pause_image="k8s.gcr.io/pause:3.1",
+                              metrics_port=None,
+                              metrics_file=None,
+                              metrics_format="prom",
+                              pull_order="priority",
+                              priority_weights=None,
+                              sharding="off",
+                              shard_label=None,
+                              replica_id=None,
+                              member_ttl=30,
+                              api_write_qps=20,
+                              api_read_qps=50,
+                              api_retries=5,
+                              node_selector=None,
+                              node_field_selector=None,
+                              tolerations=None,
+                              node_page_size=500,
+                              disk_budget=None,
+                              journal="off",
+                              journal_path=None,
+                              journal_max_failures=0,
+                              pin_digests=True,
+                              repos=None,
+                              plan=False,
+                              plan_history=None
                               )
     images = []
+    list_images = []
     nodes = []
-    pod_specs = {}
+    nodes_version = None
+    excluded = {}
+    plan = {}
+    templates = {}
     created_pods = []
+    pod_labels = {"app": "prepuller"}
+    replica_label = "prepuller-replica"
+    completed_phases = ["Succeeded", "Failed"]
+    blocking_effects = ["NoSchedule", "NoExecute"]
+    tolerations = []
+    watcher = None
+    digests = {}
+    node_images = {}
+    node_labels = {}
+    node_uids = {}
+    full_image_lists = set()
+    node_status_max_images = 50
+    skipped = {}
+    mutable_tags = ["latest"]
+    deadline = None
+    budget_margin = 60
+    scan_entries = {}
+    layer_plan = None
+    given_up = {}
+    expected_bytes = {}
+    shard = None
+    api_limits = None
+    disk = None
+    over_budget = {}
+    journal = None
+    stale_pending = 600
+    daemon_pulls = 1000
+    replace_tries = 10
+    replace_delay = 1
+    journal_configmap = "prepuller-journal"
+    journal_file = "prepuller-journal.json"
 
     def __init__(self, args=None):
         logging.basicConfig()
@@ -53,22 +145,7 @@ class Prepuller(object):
             self.logger.debug("Debug logging on.")
         else:
             self.logger.setLevel(logging.INFO)
-        namespace = None
-        try:
-            config.load_incluster_config()
-            secrets = "/var/run/secrets/kubernetes.io/serviceaccount/"
-            try:
-                with open(os.path.join(secrets, "namespace"), "r") as f:
-                    namespace = f.read()
-            except OSError:
-                pass
-        except ConfigException:
-            try:
-                config.load_kube_config()
-            except Exception:
-                self.logger.critical(sys.argv[0], " must be run from a system",
-                                     " with k8s API access.")
-                raise
+        namespace = self._load_config()
         if self.args.namespace:
             namespace = self.args.namespace
         if not namespace:
@@ -77,10 +154,24 @@ class Prepuller(object):
             self.logger.warning("Using namespace 'default'")
             namespace = "default"
         self.namespace = namespace
-        self.client = client.CoreV1Api()
+        # A daemon keeps only its latest pulls for the JSON metrics.
+        max_pulls = None
+        if self.args.daemon:
+            max_pulls = self.daemon_pulls
+        self.metrics = Metrics(max_pulls=max_pulls)
+        self.namer = PodNamer()
+        self._make_client()
+        self._make_shard()
+        self._make_journal()
+        self._watcher_lock = Lock()
         self.logger.debug("Arguments: %s" % str(args))
         if self.args.command:
             self.command = self.args.command
+        if self.args.tolerations:
+            self.tolerations = self._load_tolerations(self.args.tolerations)
+        if self.args.disk_budget:
+            self.disk = DiskBudget(self.args.disk_budget)
+        list_images = []
         if self.args.list:
             for image in self.args.list:
                 # Make fully-qualified image name
@@ -90,224 +181,1093 @@ class Prepuller(object):
                 slashes = image.count('/')
                 if slashes == 0:
                     image = "library/" + image
-            self.images.append(image)
+                list_images.append(image)
         # Cheap way to deduplicate lists
-        self.images = list(set(self.images))
+        self.list_images = list(set(list_images))
+        self.images = list(self.list_images)
         if self.images:
             self.images.sort()
+        weights = None
+        if self.args.priority_weights:
+            weights = PullPriority.load_weights(self.args.priority_weights)
+        self.priority = PullPriority(weights=weights)
+        self.priority.set_images({}, self.list_images)
         # Not portable to non-Unixy systems.
         if self.args.timeout >= 0:
             self.logger.debug("Setting timeout to %d s." % self.args.timeout)
+            # Stop starting pulls in time to finish those running.
+            self.deadline = time.time() + self.args.timeout - min(
+                self.budget_margin, self.args.timeout * 0.1)
             signal.signal(signal.SIGALRM, self._timeout_handler)
             signal.alarm(self.args.timeout)
 
+    def _load_config(self):
+        """Load Kubernetes client configuration, from the service account
+        if we are in a cluster or from kubeconfig if not.  Return the
+        service account namespace, if there is one.
+        """
+        try:
+            config.load_incluster_config()
+            return self._incluster_namespace()
+        except ConfigException:
+            try:
+                config.load_kube_config()
+            except Exception:
+                self.logger.critical(sys.argv[0], " must be run from a system",
+                                     " with k8s API access.")
+                raise
+        return None
+
+    def _incluster_namespace(self):
+        secrets = "/var/run/secrets/kubernetes.io/serviceaccount/"
+        try:
+            with open(os.path.join(secrets, "namespace"), "r") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _make_client(self):
+        # Size the connection pool so that every in-flight pull can hold
+        # a connection to the API server.
+        configuration = client.Configuration()
+        configuration.connection_pool_maxsize = max(
+            configuration.connection_pool_maxsize, self.args.max_in_flight)
+        self.api_client = client.ApiClient(configuration)
+        self.client = self._rate_limited(InstrumentedApi(
+            client.CoreV1Api(self.api_client), self.metrics))
+
+    def _rate_limited(self, api, is_async=False, transient=None):
+        """Wrap an API object to retry transient failures and hold it to
+        the args.api_write_qps and args.api_read_qps budgets.  Every API
+        object wrapped here draws on the same budgets.
+        """
+        if self.api_limits is None:
+            self.api_limits = make_limits(self.args.api_write_qps,
+                                          self.args.api_read_qps,
+                                          self.metrics)
+        return RateLimitedApi(api, self.api_limits, self.metrics,
+                              retries=self.args.api_retries,
+                              is_async=is_async, transient=transient,
+                              logger=self.logger)
+
+    def _make_journal(self):
+        """With args.journal, load the record of earlier runs' pulls.
+        """
+        if self.args.journal == "configmap":
+            self.journal = ConfigMapJournal(
+                self.client, self.namespace,
+                self.args.journal_path or self.journal_configmap,
+                logger=self.logger)
+        elif self.args.journal == "file":
+            self.journal = FileJournal(
+                self.args.journal_path or self.journal_file,
+                logger=self.logger)
+        if self.journal:
+            self.journal.load()
+
+    def _make_shard(self):
+        """With args.sharding, set up coordination with the other
+        replicas, and label our pods as ours.
+        """
+        if self.args.sharding == "off":
+            return
+        identity = (self.args.replica_id or os.getenv("POD_NAME") or
+                    socket.gethostname())
+        self.shard = ShardCoordinator(self.client, self.namespace, identity,
+                                      mode=self.args.sharding,
+                                      label=self.args.shard_label,
+                                      member_ttl=self.args.member_ttl,
+                                      logger=self.logger)
+        self.pod_labels = dict(self.pod_labels)
+        self.pod_labels[self.replica_label] = self.shard.identity
+
+    def _load_tolerations(self, path):
+        """Load the tolerations for our pods from a YAML or JSON file
+        holding a list of them as in a pod spec, such as the lab pods'.
+        """
+        with open(path, "r") as f:
+            items = yaml.safe_load(f) or []
+        return [client.V1Toleration(
+            key=x.get("key"), operator=x.get("operator"),
+            value=x.get("value"), effect=x.get("effect"),
+            toleration_seconds=x.get("tolerationSeconds")) for x in items]
+
     def _timeout_handler(self, signum, frame):
         self.logger.error(
             "Did not complete in %d s.  Terminating." % self.args.timeout)
+        self.metrics.failure("run_timeout")
         raise RuntimeError("Timed out")
 
     def update_images_from_repo(self):
-        """Scan the repo looking for images.
-        """
-        if not self.repo:
-            self.repo = ScanRepo(host=self.args.repo,
-                                 path=self.args.path,
-                                 owner=self.args.owner,
-                                 name=self.args.name,
-                                 dailies=self.args.dailies,
-                                 weeklies=self.args.weeklies,
-                                 releases=self.args.releases,
-                                 json=True, insecure=self.args.insecure,
-                                 sort_field=self.args.sort,
-                                 debug=self.args.debug)
+        """Scan the repos looking for images.
+        """
+        self._make_repo()
         if not self.args.no_scan:
-            if self.args.repo:
-                self.logger.debug("Scanning '%s' for images" % self.args.repo)
-            else:
-                self.logger.debug("Scanning Docker repo for images")
-            self.repo.scan()
-            self.logger.debug("Scan Data: %s" % json.dumps(self.repo.data,
-                                                           sort_keys=True,
-                                                           indent=4))
-            scan_imgs = []
+            with self.metrics.timer("scan"):
+                self._scan_repos()
+            self._images_from_scan()
+            if self.args.pull_order == "layers":
+                self._fetch_layers()
+
+    def _scan_repos(self):
+        """Scan every repo at once.  A repo that fails keeps the results
+        of its last good scan, if it had one; only if all of them fail
+        is the error raised.
+        """
+        def scan(repo):
+            self.logger.debug("Scanning %s for images" % repo.url)
+            repo.scan()
+        with ThreadPoolExecutor(max_workers=len(self.repos)) as executor:
+            futures = [executor.submit(scan, x) for x in self.repos]
+        errors = []
+        for repo, future in zip(self.repos, futures):
+            exc = future.exception()
+            if exc:
+                self.metrics.failure("scan")
+                self.logger.error("Scan of %s failed: %s" % (repo.url,
+                                                            str(exc)))
+                errors.append(exc)
+        if errors and len(errors) == len(self.repos):
+            raise errors[0]
+
+    def _make_repo(self):
+        """Set up a ScanRepo for each repository: those in the
+        args.repos file, or else the one given by the other arguments.
+        self.repo is the first of them.
+        """
+        if self.repos:
+            return
+        if self.args.repos:
+            specs = self._load_repos(self.args.repos)
+        else:
+            specs = [{}]
+        self.repos = [self._build_repo(x) for x in specs]
+        self.repo = self.repos[0]
+
+    def _load_repos(self, path):
+        """Read a YAML or JSON file holding a list of repositories under
+        "repositories".  Each is a dict of host, port, path, owner,
+        name, dailies, weeklies, releases, sort, insecure, api ("hub" or
+        "registry"; see ScanRepo), username and password (or
+        password_env, the environment variable holding it); those left
+        out are taken from the command line.
+        """
+        with open(path, "r") as f:
+            data = yaml.safe_load(f) or {}
+        specs = data.get("repositories")
+        if not specs or not isinstance(specs, list):
+            raise ValueError("%s lists no repositories" % path)
+        for spec in specs:
+            api = spec.get("api")
+            if api is not None and api not in ScanRepo.apis:
+                raise ValueError("%s: unknown api '%s' for %s; use one of"
+                                 " %s" % (path, api, spec.get("name"),
+                                          ", ".join(ScanRepo.apis)))
+        return specs
+
+    def _build_repo(self, spec):
+        args = self.args
+        credentials = None
+        if spec.get("username"):
+            password = spec.get("password")
+            if spec.get("password_env"):
+                password = os.getenv(spec["password_env"])
+            credentials = (spec["username"], password or "")
+        port = spec.get("port", args.port)
+        if port is not None:
+            port = str(port)
+        # args.path belongs to args.owner and args.name.
+        path = spec.get("path")
+        if not args.repos:
+            path = args.path
+        return ScanRepo(host=spec.get("host", args.repo),
+                        port=port,
+                        path=path,
+                        owner=spec.get("owner", args.owner),
+                        name=spec.get("name", args.name),
+                        dailies=spec.get("dailies", args.dailies),
+                        weeklies=spec.get("weeklies", args.weeklies),
+                        releases=spec.get("releases", args.releases),
+                        json=True,
+                        insecure=spec.get("insecure", args.insecure),
+                        sort_field=spec.get("sort", args.sort),
+                        workers=args.scan_workers,
+                        cache_dir=args.cache_dir,
+                        cache_ttl=args.cache_ttl,
+                        incremental=args.incremental_scan,
+                        credentials=credentials,
+                        api=spec.get("api", args.registry_api),
+                        debug=args.debug)
+
+    def _image_prefix(self, repo):
+        """Return what goes before the tag in the names of a repo's
+        images: the registry, unless it is Docker Hub, and the
+        repository.
+        """
+        exhost = ''
+        if repo.host != ScanRepo.host:
+            exhost = repo.host
+            if repo.port:
+                exhost += ":" + str(repo.port)
+            exhost += "/"
+        return exhost + repo.owner + "/" + repo.name + ":"
+
+    def _images_from_scan(self):
+        """Merge the images found by the repo scans into self.images.
+        """
+        scan_imgs = []
+        digests = {}
+        entries = {}
+        image_repos = {}
+        scans = []
+        for repo in self.repos:
+            self.logger.debug("Scan Data for %s: %s" % (
+                repo.url, json.dumps(repo.data, sort_keys=True, indent=4)))
+            prefix = self._image_prefix(repo)
+            by_section = {}
             for section in ["daily", "weekly", "release"]:
-                for entry in self.repo.data[section]:
-                    exhost = ''
-                    if self.args.repo:
-                        exhost = self.args.repo
-                        if self.args.port:
-                            exhost += ":" + self.args.port + "/"
-                    scan_imgs.append(exhost + self.args.owner + "/" +
-                                     self.args.name + ":" +
-                                     entry["name"])
-            current_imgs = [x for x in self.images]
-            # Dedupe by running the list through a set.
-            current_imgs.extend(scan_imgs)
-            current_imgs = list(set(current_imgs))
-            if current_imgs:
-                current_imgs.sort()
-            self.images = current_imgs
+                by_section[section] = []
+                for entry in repo.data.get(section, []):
+                    img = prefix + entry["name"]
+                    scan_imgs.append(img)
+                    by_section[section].append(img)
+                    entries[img] = entry
+                    image_repos[img] = repo
+                    digest = repo.get_digest(entry)
+                    if digest:
+                        digests[img] = digest
+            scans.append(by_section)
+        self.digests = digests
+        self.scan_entries = entries
+        self.image_repos = image_repos
+        # Start again from the supplied list, so that images which have
+        # dropped out of the scan are dropped here too.
+        current_imgs = [x for x in self.list_images]
+        # Dedupe by running the list through a set.
+        current_imgs.extend(scan_imgs)
+        current_imgs = list(set(current_imgs))
+        if current_imgs:
+            current_imgs.sort()
+        self.images = current_imgs
+        self.priority.set_images(scans, self.list_images)
+
+    def _fetch_layers(self):
+        """Get the layers of the scanned images from their manifests,
+        for layer-aware pull ordering, from every repo at once.
+        """
+        entries = self.scan_entries
+        by_repo = {}
+        for img in sorted(entries):
+            by_repo.setdefault(self.image_repos[img], []).append(img)
+        with self.metrics.timer("layers"):
+            with ThreadPoolExecutor(max_workers=len(self.repos)) as executor:
+                found = dict([(repo, executor.submit(
+                    repo.get_layers, [entries[x] for x in by_repo[repo]]))
+                              for repo in by_repo])
+        layers = {}
+        for repo in by_repo:
+            by_tag = found[repo].result()
+            for img in by_repo[repo]:
+                if entries[img]["name"] in by_tag:
+                    layers[img] = by_tag[entries[img]["name"]]
+        self.logger.debug("Found layers for %d of %d images" % (
+            len(layers), len(entries)))
+        self.layer_plan = LayerPlan(layers)
+
+    def ordered_images(self):
+        """Return self.images in the order to pull them: by priority
+        (see PullPriority), or by name with args.pull_order "name".
+        With "layers", this is the priority order, which
+        _order_for_node() then rearranges for each node.
+        """
+        if self.args.pull_order == "name":
+            return list(self.images)
+        return self.priority.order(self.images)
 
     def build_nodelist(self):
         """Make a list of all schedulable nodes.
         """
         v1 = self.client
         logger = self.logger
+        if self.shard:
+            self.shard.join()
         logger.debug("Getting schedulable node list.")
-        v1nodelist = v1.list_node()
+        with self.metrics.timer("nodelist"):
+            self._select_nodes(self._list_nodes(v1))
+
+    def _node_list_kwargs(self):
+        """Return the selectors to list and watch nodes with.
+        """
+        kwargs = {}
+        if self.args.node_selector:
+            kwargs["label_selector"] = self.args.node_selector
+        if self.args.node_field_selector:
+            kwargs["field_selector"] = self.args.node_field_selector
+        return kwargs
+
+    def _list_nodes(self, v1):
+        """List the selected nodes, args.node_page_size at a time, and
+        keep the list's resource version, to watch nodes from.
+        """
+        kwargs = self._node_list_kwargs()
+        kwargs["limit"] = self.args.node_page_size
+        items = []
+        while True:
+            try:
+                nodelist = v1.list_node(**kwargs)
+            except ApiException as e:
+                if not self._restart_list(kwargs, e):
+                    raise
+                items = []
+                continue
+            items.extend(nodelist.items)
+            if not self._next_page(kwargs, nodelist):
+                self.nodes_version = nodelist.metadata.resource_version
+                return items
+
+    def _next_page(self, kwargs, listing):
+        """Set kwargs to ask for the page after listing, a page of a
+        list call, and return True, or return False if it was the last.
+        """
+        cont = listing.metadata._continue
+        if not cont:
+            return False
+        kwargs["_continue"] = cont
+        return True
+
+    def _restart_list(self, kwargs, e):
+        """Return True if e, an error from a list call made with kwargs,
+        says its continue token expired, having dropped the token so
+        that the list starts over.
+        """
+        if e.status != 410 or "_continue" not in kwargs:
+            return False
+        self.logger.debug("List expired; listing again.")
+        del kwargs["_continue"]
+        return True
+
+    def _select_nodes(self, items):
+        """Set self.nodes to the schedulable nodes among the node objects
+        in items, and record which images each already has, and why
+        each of the others is left out in self.excluded.
+        """
         nodes = []
-        for thing in v1nodelist.items:
-            spec = thing.spec
-            if spec.unschedulable:
+        excluded = {}
+        node_images = {}
+        node_labels = {}
+        node_uids = {}
+        full_image_lists = set()
+        disk = self.disk
+        others = 0
+        for thing in items:
+            reason = self._unschedulable_reason(thing)
+            if reason:
+                self.logger.debug("Skipping node %s: %s" % (
+                    thing.metadata.name, reason))
+                excluded[thing.metadata.name] = reason
+                continue
+            if self.shard and not self.shard.owns(thing):
+                others += 1
                 continue
-            if spec.taints:
-                taints = [x.effect for x in spec.taints]
-                if "NoSchedule" in taints:
-                    continue
-            nodes.append(thing.metadata.name)
-        logger.debug("Schedulable list: %s" % str(nodes))
+            name = thing.metadata.name
+            nodes.append(name)
+            node_images[name] = self._images_on_node(thing)
+            node_labels[name] = thing.metadata.labels or {}
+            node_uids[name] = thing.metadata.uid
+            if self._lists_all_images(thing):
+                full_image_lists.add(name)
+            if disk:
+                disk.add_node(thing, self._normalize_image)
+        if disk:
+            for name in [x for x in disk.limits if x not in node_images]:
+                disk.drop_node(name)
+        self.logger.debug("Schedulable list: %s" % str(nodes))
+        if self.shard:
+            self.logger.info("Replica %s has %d of %d nodes" % (
+                self.shard.identity, len(nodes), len(nodes) + others))
         self.nodes = nodes
+        self.excluded = excluded
+        self.node_images = node_images
+        self.node_labels = node_labels
+        self.node_uids = node_uids
+        self.full_image_lists = full_image_lists
 
-    def build_pod_specs(self):
-        """Build a dict of Pod specs by node, each node having a list of
-        specs.
-        """
-        specs = {}
-        for node in self.nodes:
-            specs[node] = []
-            for img in self.images:
-                specs[node].append(self._build_pod_spec(img, node))
-        self.pod_specs = specs
-        self.logger.debug("Specs: %s" % str(self.pod_specs))
-
-    def _build_pod_spec(self, img, node):
-        spec = client.V1PodSpec(
-            containers=[
-                client.V1Container(
-                    command=self.command,
-                    image=img,
-                    image_pull_policy="Always",
-                    name=self._podname_from_image(img)
-                )
-            ],
-            restart_policy="Never",
-            node_name=node
-        )
+    def _node_is_schedulable(self, node):
+        """Decide whether prepuller pods can run on a node.
+        """
+        return self._unschedulable_reason(node) is None
+
+    def _unschedulable_reason(self, node):
+        """Return why prepuller pods should not run on a node, or None
+        if they can: it is cordoned, has a taint our tolerations do not
+        cover, is not Ready, or is short of disk.
+        """
+        spec = node.spec
+        if spec.unschedulable:
+            return "cordoned"
+        for taint in spec.taints or []:
+            if (taint.effect in self.blocking_effects and
+                    not self._tolerates(taint)):
+                return "taint %s:%s" % (taint.key, taint.effect)
+        conditions = {}
+        if node.status and node.status.conditions:
+            conditions = dict([(x.type, x.status)
+                               for x in node.status.conditions])
+        if conditions.get("Ready") != "True":
+            return "not Ready"
+        if conditions.get("DiskPressure") == "True":
+            return "DiskPressure"
+        return None
+
+    def _tolerates(self, taint):
+        """Decide whether our tolerations cover a taint, by the same
+        rules as the scheduler.
+        """
+        for tol in self.tolerations:
+            if tol.effect and tol.effect != taint.effect:
+                continue
+            if tol.operator == "Exists":
+                if not tol.key or tol.key == taint.key:
+                    return True
+            elif (tol.key == taint.key and
+                  (tol.value or "") == (taint.value or "")):
+                return True
+        return False
+
+    def _images_on_node(self, node):
+        """Return the set of normalized image references (by tag and by
+        digest) that the kubelet reports as present on a node.
+        """
+        present = set()
+        if node.status and node.status.images:
+            for image in node.status.images:
+                for name in (image.names or []):
+                    present.add(self._normalize_image(name))
+        return present
+
+    def _lists_all_images(self, node):
+        """Decide whether a node's status lists every image it holds:
+        the kubelet lists only node_status_max_images (its
+        --node-status-max-images), the largest first.
+        """
+        images = (node.status and node.status.images) or []
+        return len(images) < self.node_status_max_images
+
+    def _normalize_image(self, img):
+        """Put an image reference into the fully-qualified form the
+        kubelet uses: registry/path:tag or registry/path@digest.
+        """
+        digest = None
+        if '@' in img:
+            img, digest = img.split('@', 1)
+        tag = None
+        lastpart = img.split('/')[-1]
+        if ':' in lastpart:
+            img, tag = img.rsplit(':', 1)
+        parts = img.split('/')
+        first = parts[0]
+        if (len(parts) > 1 and
+                ('.' in first or ':' in first or first == "localhost")):
+            registry = first
+            parts = parts[1:]
+        else:
+            registry = "docker.io"
+        if registry == "index.docker.io":
+            registry = "docker.io"
+        if registry == "docker.io" and len(parts) == 1:
+            parts = ["library"] + parts
+        ref = registry + "/" + '/'.join(parts)
+        if digest:
+            return ref + "@" + digest
+        if not tag:
+            tag = "latest"
+        return ref + ":" + tag
+
+    def _node_has_image(self, node, img):
+        """Decide whether a node already holds an image.  If we know the
+        digest the tag points to, only that digest counts, so a moved tag
+        is pulled again.  Otherwise a mutable tag is never trusted.
+        """
+        present = self.node_images.get(node)
+        if not present:
+            return False
+        ref = self._normalize_image(img)
+        digest = self.digests.get(img)
+        if digest:
+            return (ref.rsplit(':', 1)[0] + "@" + digest) in present
+        if ref.rsplit(':', 1)[1] in self.mutable_tags:
+            return False
+        return ref in present
+
+    def build_plan(self):
+        """Build the plan, a dict of node to the images to pull onto it,
+        in pull order.  Images the node already has are left out (unless
+        args.repull is set) and recorded in self.skipped, as are those
+        the journal has pulled in an earlier run.  Pulls that have failed
+        args.journal_max_failures times running are left out and
+        recorded in self.given_up, and with args.disk_budget those the
+        node has no room for are left out and recorded in
+        self.over_budget.  Pods are built from one template per image
+        only as they are created.
+        """
+        plan = {}
+        skipped = {}
+        given_up = {}
+        over_budget = {}
+        journaled = 0
+        with self.metrics.timer("plan"):
+            images = self.ordered_images()
+            self.templates = {}
+            for node in self.nodes:
+                skipped[node] = []
+                missing = []
+                for img in images:
+                    if (not self.args.repull and
+                            self._node_has_image(node, img)):
+                        skipped[node].append(img)
+                        continue
+                    reason = self._journal_skip(node, img)
+                    if reason == "done":
+                        skipped[node].append(img)
+                        journaled += 1
+                        continue
+                    if reason:
+                        given_up.setdefault(node, []).append(img)
+                        continue
+                    missing.append(img)
+                if self.disk:
+                    missing, over = self._fit_disk(node, missing)
+                    if over:
+                        over_budget[node] = over
+                plan[node] = self._order_for_node(node, missing)
+        self.plan = plan
+        self.skipped = skipped
+        self.given_up = given_up
+        self.over_budget = over_budget
+        nskip = sum([len(skipped[x]) for x in skipped])
+        if nskip:
+            self.logger.info("Skipping %d images already present" % nskip +
+                             " (%d of them by the journal)." % journaled)
+        ngiven = sum([len(given_up[x]) for x in given_up])
+        if ngiven:
+            self.logger.warning(
+                "Giving up on %d pulls that failed %d runs running." % (
+                    ngiven, self.args.journal_max_failures))
+        if self.disk:
+            self._report_over_budget()
+        if self.layer_plan:
+            self._estimate_bytes()
+        self.logger.info("Plan: %d pulls on %d nodes." % (
+            sum([len(plan[x]) for x in plan]), len(plan)))
+
+    def _journal_skip(self, node, img):
+        """Return why the journal says not to pull an image onto a
+        node: "done" if an earlier run did, or "failing" if it has
+        failed too often.  Return None to pull it.  As with the node's
+        own image list, a mutable tag whose digest we do not know is
+        always pulled.  The node's own image list wins over the
+        journal: a pull is only taken as done if that list, being cut
+        short, may have left the image out.
+        """
+        journal = self.journal
+        if not journal or self.args.repull:
+            return None
+        digest = self.digests.get(img)
+        if not digest and img.rsplit(':', 1)[-1] in self.mutable_tags:
+            return None
+        key = self._journal_node(node)
+        if (node not in self.full_image_lists and
+                journal.done(key, img, digest)):
+            return "done"
+        limit = self.args.journal_max_failures
+        if limit and journal.failures(key, img, digest) >= limit:
+            return "failing"
+        return None
+
+    def _journal_node(self, node):
+        """Return the journal's name for a node: its name and uid, so
+        that a node made again under the same name is a new node.
+        """
+        uid = self.node_uids.get(node)
+        if not uid:
+            return node
+        return "%s/%s" % (node, uid)
+
+    def _journal_pull(self, podname, phase):
+        """Record the outcome of a pod in the journal.
+        """
+        entry = self.namer.lookup(podname)
+        if self.journal and entry:
+            self.journal.record(self._journal_node(entry[0]), entry[1],
+                                entry[2], phase)
+
+    def _node_layers(self, node):
+        """Return the layers a node is known to hold, from the images
+        with known layers that it has.
+        """
+        plan = self.layer_plan
+        return plan.present_layers([x for x in plan.layers
+                                    if self._node_has_image(node, x)])
+
+    def _order_for_node(self, node, images):
+        """Put a node's images, given in priority order, in the order to
+        pull them onto it.
+        """
+        if self.args.pull_order != "layers" or not self.layer_plan:
+            return images
+        return self.layer_plan.order(images, self._node_layers(node))
+
+    def _fit_disk(self, node, images, pending=()):
+        """Split a node's images, in priority order, into those that fit
+        its disk budget, after the images in pending that it is still
+        pulling, and those that do not.
+        """
+        present = None
+        if self.layer_plan:
+            present = self._node_layers(node)
+
+        def cost(chosen, img):
+            return self._disk_cost(img, chosen, present)
+        waiting = sum([cost([], x) for x in pending])
+        return self.disk.fit(node, images, cost, waiting)
+
+    def _disk_cost(self, img, chosen, present=None):
+        """Guess the bytes of disk an image takes on a node with the
+        given layers present, on top of the images in chosen: from the
+        sizes of the layers it does not share, else from its size on
+        other nodes, else from its registry size.  Unknown images cost
+        nothing.
+        """
+        disk = self.disk
+        plan = self.layer_plan
+        if plan and img in plan.layers:
+            return disk.unpack_ratio * (
+                plan.expected_bytes(chosen + [img], present) -
+                plan.expected_bytes(chosen, present))
+        ref = self._normalize_image(img)
+        digest = self.digests.get(img)
+        if digest:
+            ref = ref.rsplit(':', 1)[0] + "@" + digest
+        if ref in disk.sizes:
+            return disk.sizes[ref]
+        entry = self.scan_entries.get(img)
+        if entry and entry.get("full_size"):
+            return disk.unpack_ratio * entry["full_size"]
+        return 0
+
+    def _report_over_budget(self):
+        over = self.over_budget
+        count = sum([len(over[x]) for x in over])
+        self.metrics.set("prepuller_pulls_over_budget", count)
+        if not count:
+            return
+        self.logger.warning(
+            "Skipping %d pulls on %d nodes to keep within %d%% of disk." % (
+                count, len(over), self.args.disk_budget * 100))
+        for node in sorted(over):
+            free = self.disk.free(node)
+            self.logger.info(
+                "Node '%s' (%.1f GiB free before pulling): no room for %s" % (
+                    node, free / float(1 << 30), ", ".join(over[node])))
+
+    def _estimate_bytes(self):
+        """Work out, and report, the bytes each node has to fetch.
+        """
+        expected = {}
+        for node in self.plan:
+            expected[node] = self.layer_plan.expected_bytes(
+                self.plan[node], self._node_layers(node))
+        self.expected_bytes = expected
+        total = sum(expected.values())
+        self.metrics.set("prepuller_expected_bytes", total)
+        if expected:
+            self.logger.info(
+                "Expect to fetch %.1f GiB across %d nodes" % (
+                    total / float(1 << 30), len(expected)) +
+                " (at most %.1f GiB on one node)." % (
+                    max(expected.values()) / float(1 << 30)))
+        for node in sorted(expected):
+            self.logger.debug("Node '%s': expect %d bytes" % (
+                node, expected[node]))
+
+    def _pod_template(self, img):
+        """Return the pod spec for an image, less the node, shared by
+        every pod that pulls it.  Templates are kept by the reference
+        pulled, so a tag that moves gets a new one.
+        """
+        ref = self._pull_reference(img)
+        spec = self.templates.get(ref)
+        if spec is None:
+            spec = client.V1PodSpec(
+                containers=[
+                    self._build_container(img,
+                                          self.namer.container_name(img))
+                ],
+                restart_policy="Never",
+                tolerations=self.tolerations or None
+            )
+            self.templates[ref] = spec
         return spec
 
-    def _podname_from_image(self, img):
-        iname = '-'.join(img.split('/')[-2:])
-        iname = iname.replace(':', '-')
-        return iname
+    def _pull_reference(self, img):
+        """Return the reference to pull an image by: with
+        args.pin_digests, the digest the scan found the tag pointing to,
+        if it found one; else the tag.
+        """
+        digest = self.digests.get(img)
+        if not self.args.pin_digests or not digest:
+            return img
+        if ':' in img.split('/')[-1]:
+            img = img.rsplit(':', 1)[0]
+        return img + "@" + digest
+
+    def _build_container(self, img, name):
+        """Build the container that pulls an image.  A digest never
+        changes what it points to, so a pull by digest need not ask the
+        registry when the node has the image; a pull by tag must.
+        """
+        ref = self._pull_reference(img)
+        policy = "Always"
+        if '@' in ref:
+            policy = "IfNotPresent"
+        return client.V1Container(
+            command=self.command,
+            image=ref,
+            image_pull_policy=policy,
+            name=name
+        )
 
     def clean_completed_pods(self):
-        """Get a pod list and delete any that are in the speclist and have
-        already run to completion.  This is useful for pods that are
-        left stranded by a timeout.
+        """Delete prepuller pods that have already run to completion.
+        This is useful for pods that are left stranded by a timeout.
+        Pods are found by label, and deleted with one deletecollection
+        call per completed phase.  Without permission to do that, fall
+        back to a filtered list and parallel deletes.
         """
         v1 = self.client
         self.logger.debug("Looking for completed pods to delete.")
+        selector = self._any_replica_selector()
+        with self.metrics.timer("cleanup"):
+            try:
+                for phase in self.completed_phases:
+                    v1.delete_collection_namespaced_pod(
+                        self.namespace, label_selector=selector,
+                        field_selector="status.phase=%s" % phase)
+            except ApiException as e:
+                if e.status != 403:
+                    raise
+                self.logger.debug("Cannot delete pods in bulk; deleting" +
+                                  " them one at a time.")
+                self._clean_completed_pods_individually(selector)
+
+    def _any_replica_selector(self):
+        """Return the label selector for every replica's pods.  Cleanup
+        uses it so that pods left by a replica that died are cleaned up
+        too, and the pod watcher so that it sees the pods we adopt from
+        other replicas.
+        """
+        return self._label_selector(type(self).pod_labels)
+
+    def _clean_completed_pods_individually(self, selector):
+        v1 = self.client
+        kwargs = {"label_selector": selector, "limit": 500}
         cleanup = []
-        speclist = []
-        for x in self.pod_specs:
-            speclist.extend(self.pod_specs[x])
-        specnames = [self._derive_pod_name(x) for x in speclist]
-        podlist = v1.list_namespaced_pod(self.namespace)
-        for pod in podlist.items:
+        while True:
+            podlist = v1.list_namespaced_pod(self.namespace, **kwargs)
+            cleanup.extend(self._completed_pods(podlist.items))
+            if not self._next_page(kwargs, podlist):
+                break
+        if not cleanup:
+            return
+        workers = min(len(cleanup), self.args.max_in_flight)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(self.delete_pod, cleanup))
+
+    def _completed_pods(self, pods):
+        """Return the names of the pods that have run to completion.
+        """
+        cleanup = []
+        for pod in pods:
             podname = pod.metadata.name
             phase = pod.status.phase
-            if (podname in specnames and
-                    (phase == "Succeeded" or phase == "Failed")):
+            if phase in self.completed_phases:
                 self.logger.debug(
                     "Pod '%s' %s; adding to cleanup." % (podname, phase))
                 cleanup.append(podname)
-        for podname in cleanup:
-            self.delete_pod(podname)
+        return cleanup
 
-    def start_single_pod(self, spec):
+    def start_single_pod(self, node, img):
         """Run a pod, with a single container, on a particular node.
-        (Assuming that the pod is itself tied to a node in the pod spec.)
         This has the effect of pulling the image for that pod onto that
         node.  The run itself is unimportant.  It returns the name of the
         created pod.
+
+        If the pod is there already, from a retried create whose first
+        attempt got through or from an earlier run or another replica,
+        wait for that one, unless it is no use to us, in which case it
+        is replaced.
         """
         v1 = self.client
-        name = self._derive_pod_name(spec)
-        pod = client.V1Pod(spec=spec,
-                           metadata=client.V1ObjectMeta(
-                               name=name)
-                           )
-        name = spec.containers[0].name
+        pod = self._build_pod(node, img)
+        name = pod.metadata.name
         self.logger.debug("Running pod %s" % name)
-        made_pod = v1.create_namespaced_pod(self.namespace, pod)
-        podname = made_pod.metadata.name
-        return podname
+        for attempt in range(self.replace_tries):
+            try:
+                made_pod = v1.create_namespaced_pod(self.namespace, pod)
+                return made_pod.metadata.name
+            except ApiException as e:
+                if e.status != 409:
+                    raise
+            try:
+                existing = v1.read_namespaced_pod(name, self.namespace)
+            except ApiException as e:
+                if e.status != 404:
+                    raise
+                existing = None
+            reason = self._stale_reason(existing, pod)
+            if not reason:
+                self.logger.debug("Pod %s already exists" % name)
+                return name
+            self._replacing(name, existing, reason, self._get_watcher())
+            if existing:
+                self.delete_pod(name, now=True)
+            if attempt:
+                time.sleep(self.replace_delay)
+        raise RuntimeError("Could not replace pod '%s'" % name)
+
+    def _stale_reason(self, existing, pod):
+        """Return why an existing pod, found in the way of pod, should be
+        replaced rather than waited on, or None if it should not.  It is
+        no use if it is gone or going, pulls another image (the tag has
+        moved on since it was made), has failed, or has been Pending
+        for more than stale_pending seconds.
+        """
+        if existing is None:
+            return "gone"
+        if existing.metadata.deletion_timestamp:
+            return "being deleted"
+        image = existing.spec.containers[0].image
+        if image != pod.spec.containers[0].image:
+            return "pulls %s" % image
+        phase = existing.status and existing.status.phase
+        if phase == "Failed":
+            return "failed"
+        created = existing.metadata.creation_timestamp
+        if phase == "Pending" and created:
+            age = (datetime.datetime.now(datetime.timezone.utc) -
+                   created).total_seconds()
+            if age > self.stale_pending:
+                return "Pending for %d s" % age
+        return None
+
+    def _replacing(self, name, existing, reason, watcher):
+        """Note that the pod named name is to be replaced, so that the
+        watcher does not take news of the old pod for news of the new.
+        """
+        if reason != "gone":
+            self.logger.info("Replacing pod %s: %s" % (name, reason))
+        uid = None
+        if existing:
+            uid = existing.metadata.uid
+        watcher.replaced(name, uid)
+
+    def _build_pod(self, node, img):
+        """Build the pod to pull an image onto a node, from the image's
+        template.
+        """
+        spec = copy.copy(self._pod_template(img))
+        spec.node_name = node
+        name = self._derive_pod_name(node, img)
+        return client.V1Pod(spec=spec,
+                            metadata=client.V1ObjectMeta(
+                                name=name,
+                                labels=dict(self.pod_labels))
+                            )
 
-    def _derive_pod_name(self, spec):
-        """Pod name is based on image and node.
+    def _derive_pod_name(self, node, img):
+        """Pod name is based on image and node, and indexed by the
+        namer.
         """
-        return ("pp-" + self._podname_from_image(spec.containers[0].image) +
-                "-" + spec.node_name.split('-')[-1])
+        return self.namer.name(node, img, self.digests.get(img))
 
     def run_pods(self):
-        """Run pods for all nodes.  Parallelize across nodes.
-        """
-        tlist = []
-        for node in self.pod_specs:
-            speclist = list(self.pod_specs[node])
-            thd = Thread(target=self.run_pods_for_node, args=(node, speclist))
-            tlist.append(thd)
-            thd.start()
-        # Wait for all threads to return
-        for thd in tlist:
-            self.logger.debug("Wait for thread '%s' to complete" % thd.name)
-            thd.join()
-
-    def run_pods_for_node(self, node, speclist):
-        """Execute pods one at a time, so we don't overwhelm I/O.
-        Execute this method in parallel across all nodes for best
-        results.  Each node should have its own I/O, so they should all be
-        busy at once.
+        """Run pods for all nodes on a bounded pool of workers.
+        Each node runs up to args.node_concurrency pulls at once, and no
+        more than args.max_in_flight pods run across the cluster.
+        With args.backend "daemonset", pull through DaemonSets instead.
+        """
+        with self.metrics.timer("run"):
+            if self.args.backend == "daemonset":
+                return DaemonSetPuller(self).run()
+            return self._run_work(self.plan)
+
+    def run_pods_for_node(self, node, images):
+        """Pull the images onto a single node, honoring the per-node
+        concurrency limit.
         """
         self.logger.debug("Running pods for node %s" % node)
-        for spec in speclist:
-            name = spec.containers[0].name
-            self.logger.debug("Running pod '%s' for node '%s'" % (name,
-                                                                  node))
-            podname = self.start_single_pod(spec)
-            self.wait_for_pod(podname)
+        self._run_work({node: images})
+
+    def _run_work(self, work):
+        scheduler = PullScheduler(self.run_single_pod,
+                                  per_node=self.args.node_concurrency,
+                                  max_in_flight=self.args.max_in_flight,
+                                  deadline=self.deadline,
+                                  logger=self.logger)
+        self._get_watcher()
+        try:
+            failures = scheduler.run(work)
+        finally:
+            self._stop_watcher()
+        self._report_deferred(scheduler.deferred)
+        if failures:
+            self.logger.error("%d pulls failed." % len(failures))
+            self.metrics.inc("prepuller_failures_total", {"kind": "pull"},
+                             value=len(failures))
+        return failures
+
+    def _report_deferred(self, deferred):
+        """Log and count the pulls left undone for lack of time.
+        """
+        if not deferred:
+            return
+        self.logger.warning("Out of time: deferred %d lower-priority" %
+                            len(deferred) + " pulls to the next run.")
+        self.metrics.inc("prepuller_pulls_deferred_total",
+                         value=len(deferred))
+
+    def run_single_pod(self, node, img):
+        """Start a pod to pull an image on a node, wait for it to
+        finish, and return its final phase, as wait_for_pod() does.
+        """
+        self.logger.debug("Pulling '%s' on node '%s'" % (img, node))
+        podname = self.start_single_pod(node, img)
+        return self.wait_for_pod(podname)
+
+    def _label_selector(self, labels=None):
+        if labels is None:
+            labels = self.pod_labels
+        return ",".join(["%s=%s" % (k, v) for k, v in
+                         sorted(labels.items())])
+
+    def _get_watcher(self):
+        """Return the shared pod watcher, starting it if need be.
+        """
+        with self._watcher_lock:
+            if not self.watcher:
+                selector = self._any_replica_selector()
+                self.watcher = PodWatcher(self.client, self.namespace,
+                                          label_selector=selector,
+                                          ours=self.namer.lookup,
+                                          logger=self.logger)
+                self.watcher.start()
+            return self.watcher
+
+    def _stop_watcher(self):
+        with self._watcher_lock:
+            if self.watcher:
+                self.watcher.stop()
+                self.watcher = None
 
     def wait_for_pod(self, podname, delay=1, max_tries=3600):
         """Wait for a particular pod to go into phase "Succeeded" or
-        "Failed", and then delete the pod.
-        Raise an exception if the delay timer expires.
+        "Failed", and then delete the pod.  Phase changes come from the
+        shared pod watcher rather than from polling each pod.
+        Return the final phase: "Succeeded", "Failed" or "Deleted".
+        Raise an exception if the pod does not finish within
+        delay * max_tries seconds.
         """
-        v1 = self.client
-        namespace = self.namespace
-        tries = 1
-        while True:
-            pod = v1.read_namespaced_pod(podname, namespace)
-            phase = pod.status.phase
-            if phase in ["Failed", "Succeeded"]:
-                if phase == "Failed":
-                    self.logger.error("Pod '%s' failed" % podname)
-                self.delete_pod(podname)
-                return
-            if tries >= max_tries:
-                errstr = ("Pod '%s' did not complete after " % podname +
-                          "%d %d s iterations." % (max_tries, delay))
-                self.logger.error(errstr)
-                raise RuntimeError(errstr)
-            pstr = "Wait %d s [%d/%d]for pod '%s' [%s]" % (
-                delay, tries, max_tries, podname, phase)
-            self.logger.debug(pstr)
-            time.sleep(delay)
-            tries = tries + 1
-
-    def delete_pod(self, podname):
-        """Delete a named pod.
+        watcher = self._get_watcher()
+        timeout = delay * max_tries
+        self.logger.debug("Wait up to %d s for pod '%s'" % (timeout,
+                                                            podname))
+        phase = watcher.wait(podname, timeout=timeout)
+        pod = watcher.final_pod(podname)
+        watcher.forget(podname)
+        if phase is None:
+            errstr = ("Pod '%s' did not complete after " % podname +
+                      "%d %d s iterations." % (max_tries, delay))
+            self.logger.error(errstr)
+            self.metrics.failure("pod_timeout")
+            self._journal_pull(podname, "Timeout")
+            # Left behind, it would be waited on again by the next run.
+            try:
+                self.delete_pod(podname, now=True)
+            except Exception as e:
+                self.logger.warning("Cannot delete pod '%s': %s" % (
+                    podname, str(e)))
+            raise RuntimeError(errstr)
+        self._record_pull(podname, phase, pod)
+        if phase == "Deleted":
+            self.logger.warning("Pod '%s' was deleted before completing" %
+                                podname)
+            return phase
+        if phase == "Failed":
+            self.logger.error("Pod '%s' failed%s" % (
+                podname, self._describe_pod(podname)))
+        self.delete_pod(podname)
+        return phase
+
+    def _describe_pod(self, podname):
+        entry = self.namer.lookup(podname)
+        if not entry:
+            return ""
+        return " pulling '%s' on node '%s'" % (entry[1], entry[0])
+
+    def _record_pull(self, podname, phase, pod):
+        """Record a finished pod, and how long it spent in each stage,
+        in the metrics.
+        """
+        if phase != "Succeeded":
+            self.metrics.failure("pod_" + phase.lower())
+        self._journal_pull(podname, phase)
+        entry = self.namer.lookup(podname)
+        if entry is None and pod is not None:
+            entry = (pod.spec.node_name, pod.spec.containers[0].image, None)
+        if entry is None:
+            self.metrics.inc("prepuller_pulls_total", {"phase": phase})
+            return
+        stages = {}
+        if pod is not None:
+            stages = self._pull_stages(pod)
+        node, img, digest = entry
+        self.metrics.record_pull(node, img, phase, stages, digest=digest)
+
+    def _pull_stages(self, pod):
+        """Work out from a finished pod how long it waited to be
+        scheduled, to start its container (which is mostly the image
+        pull), and to complete.  Return a dict of stage to seconds.
+        """
+        created = pod.metadata.creation_timestamp
+        scheduled = started = finished = None
+        for cond in (pod.status.conditions or []):
+            if cond.type == "PodScheduled" and cond.status == "True":
+                scheduled = cond.last_transition_time
+        statuses = pod.status.container_statuses or []
+        if statuses and statuses[0].state and statuses[0].state.terminated:
+            started = statuses[0].state.terminated.started_at
+            finished = statuses[0].state.terminated.finished_at
+        stages = {}
+        for stage, begin, end in [("scheduled", created, scheduled),
+                                  ("running", scheduled, started),
+                                  ("completed", started, finished),
+                                  ("total", created, finished)]:
+            if begin and end:
+                stages[stage] = max(0.0, (end - begin).total_seconds())
+        return stages
+
+    def delete_pod(self, podname, now=False):
+        """Delete a named pod; with now, without a grace period.
         """
         v1 = self.client
         self.logger.debug("Deleting pod %s" % podname)
-        v1.delete_namespaced_pod(
-            podname, self.namespace, client.V1DeleteOptions())
+        options = client.V1DeleteOptions()
+        if now:
+            options.grace_period_seconds = 0
+        try:
+            v1.delete_namespaced_pod(podname, self.namespace, options)
+        except ApiException as e:
+            # Another replica's cleanup may have got there first.
+            if e.status != 404:
+                raise
+            self.logger.debug("Pod %s was already gone" % podname)
@@ -0,0 +1,71 @@
+import json
+
+
+class PullPriority(object):
+    """Rank images by how soon users are likely to want them.
+
+    Each scanned image gets a tier from its position in its section of
+    the scan, newest first: the newest release, weekly and daily are tier
+    0, the next of each tier 1, and so on.  Images given with --list are
+    tier 0.  Optional weights, say from spawn counts, are scaled so the
+    largest is 1, and an image scores (1 + weight) / (1 + tier); higher
+    scores are pulled first.  Within a score, releases go before weeklies
+    before dailies before listed images, then by name.
+    """
+    sections = ["release", "weekly", "daily"]
+
+    def __init__(self, weights=None):
+        self.tiers = {}
+        self.weights = {}
+        if weights:
+            top = max(weights.values())
+            if top > 0:
+                self.weights = dict([(k, float(v) / top) for k, v in
+                                     weights.items() if v > 0])
+
+    @classmethod
+    def load_weights(cls, path):
+        """Read weights from a JSON object mapping image names or tags to
+        numbers.
+        """
+        with open(path, "r") as f:
+            weights = json.load(f)
+        if not isinstance(weights, dict):
+            raise ValueError("%s must hold a JSON object" % path)
+        return dict([(k, float(v)) for k, v in weights.items()])
+
+    def set_images(self, by_section, listed=None):
+        """Record tiers from a dict of section name to images, each list
+        newest first, or from a list of such dicts, one per repository,
+        and from a list of explicitly requested images.  Each
+        repository's tiers count from 0.
+        """
+        tiers = {}
+        for img in (listed or []):
+            tiers[img] = (0, len(self.sections))
+        if isinstance(by_section, dict):
+            by_section = [by_section]
+        for scan in by_section:
+            for rank, section in enumerate(self.sections):
+                for tier, img in enumerate(scan.get(section, [])):
+                    if img not in tiers or (tier, rank) < tiers[img]:
+                        tiers[img] = (tier, rank)
+        self.tiers = tiers
+
+    def weight(self, img):
+        if img in self.weights:
+            return self.weights[img]
+        tag = img.split("/")[-1].split(":")[-1]
+        return self.weights.get(tag, 0.0)
+
+    def score(self, img):
+        tier = self.tiers.get(img, (0, len(self.sections)))[0]
+        return (1.0 + self.weight(img)) / (1 + tier)
+
+    def order(self, images):
+        """Return images, highest priority first.
+        """
+        def key(img):
+            rank = self.tiers.get(img, (0, len(self.sections)))[1]
+            return (-self.score(img), rank, img)
+        return sorted(images, key=key)
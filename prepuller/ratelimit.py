@@ -0,0 +1,244 @@
+import asyncio
+import functools
+import logging
+import random
+import threading
+import time
+import urllib3
+
+
+class TokenBucket(object):
+    """A token bucket allowing `rate` calls a second with bursts of up
+    to `burst`.  The rate adapts: it is halved, down to `min_rate`, when
+    the server says we are going too fast, and climbs back to the
+    configured rate by `recovery` of it a second while calls succeed.
+
+    Calls that were already in flight when the rate was cut were sent
+    at the old rate, so a 429 for a call issued before the last cut
+    says nothing new and is not counted again.  A burst of concurrent
+    429s thus halves the rate once, not once for each of them.
+    """
+    min_rate = 0.5
+    recovery = 0.05
+
+    def __init__(self, rate, burst=None, min_rate=None):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.burst = float(burst or max(1, rate))
+        if min_rate:
+            self.min_rate = min_rate
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+        self.decreased = None
+        self.adjusted = self.stamp
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token and return how many seconds to wait before using
+        it.  Callers wait for themselves, so this works with threads and
+        coroutines alike.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def slow_down(self, issued=None):
+        """Halve the rate for a call, issued at time.monotonic() time
+        issued, that was told to slow down, unless the rate has been cut
+        since it was issued.  Return the rate.
+        """
+        with self._lock:
+            if (issued is not None and self.decreased is not None and
+                    issued <= self.decreased):
+                return self.rate
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.decreased = self.adjusted = time.monotonic()
+            return self.rate
+
+    def speed_up(self):
+        """Raise the rate by as much as the time since it was last
+        changed allows, after a call succeeded.  Return the rate.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.rate = min(self.max_rate,
+                            self.rate + self.max_rate * self.recovery *
+                            (now - self.adjusted))
+            self.adjusted = now
+            return self.rate
+
+
+class RateLimitedApi(object):
+    """Wrap a Kubernetes API object so that calls are held to per-class
+    rate limits and retried on transient failures.
+
+    Calls are classed as "write" (create, delete, patch, replace) or
+    "read" (read, list), and each class draws on its own TokenBucket
+    from `limits`; a class without one is not limited.  A call failing
+    with 429 or a 5xx status, or with a connection error, is retried up
+    to `retries` times after a jittered exponential backoff, or after
+    the server's Retry-After if that is longer; a 429 also slows its
+    class down, once for all the calls in flight when it came.  Watches
+    pass straight through, as their callers already handle
+    reconnecting.  With `is_async`, the wrapped calls return awaitables,
+    as with kubernetes_asyncio, and so do ours.
+    """
+    classes = {"create": "write", "delete": "write",
+               "delete_collection": "write", "patch": "write",
+               "replace": "write", "read": "read", "list": "read"}
+    retry_statuses = [429, 500, 502, 503, 504]
+    transient = (urllib3.exceptions.HTTPError, OSError, asyncio.TimeoutError)
+    retries = 5
+    base_delay = 0.5
+    max_delay = 30.0
+
+    def __init__(self, api, limits=None, metrics=None, retries=None,
+                 is_async=False, transient=None, logger=None):
+        self._api = api
+        self._limits = limits or {}
+        self._metrics = metrics
+        if retries is not None:
+            self.retries = retries
+        self._async = is_async
+        if transient:
+            self.transient = self.transient + tuple(transient)
+        if logger:
+            self._logger = logger
+        else:
+            self._logger = logging.getLogger(__name__)
+
+    def _class(self, name):
+        # Longest verb first, so delete_collection is not taken as delete.
+        for verb in sorted(self.classes, key=len, reverse=True):
+            if name.startswith(verb + "_"):
+                return self.classes[verb]
+        return None
+
+    def __getattr__(self, name):
+        attr = getattr(self._api, name)
+        if not callable(attr) or name.startswith("_"):
+            return attr
+        cls = self._class(name)
+
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            if kwargs.get("watch"):
+                return attr(*args, **kwargs)
+            if self._async:
+                return self._acall(name, cls, attr, args, kwargs)
+            return self._call(name, cls, attr, args, kwargs)
+        return call
+
+    def _call(self, name, cls, attr, args, kwargs):
+        attempt = 0
+        while True:
+            wait = self._reserve(cls)
+            if wait:
+                time.sleep(wait)
+            issued = time.monotonic()
+            try:
+                result = attr(*args, **kwargs)
+            except Exception as e:
+                delay = self._retry_delay(name, cls, e, attempt, issued)
+                if delay is None:
+                    raise
+                attempt += 1
+                time.sleep(delay)
+                continue
+            self._succeeded(cls)
+            return result
+
+    async def _acall(self, name, cls, attr, args, kwargs):
+        attempt = 0
+        while True:
+            wait = self._reserve(cls)
+            if wait:
+                await asyncio.sleep(wait)
+            issued = time.monotonic()
+            try:
+                result = await attr(*args, **kwargs)
+            except Exception as e:
+                delay = self._retry_delay(name, cls, e, attempt, issued)
+                if delay is None:
+                    raise
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            self._succeeded(cls)
+            return result
+
+    def _reserve(self, cls):
+        bucket = self._limits.get(cls)
+        if not bucket:
+            return 0.0
+        wait = bucket.reserve()
+        if wait and self._metrics:
+            self._metrics.inc("prepuller_api_throttled_seconds_total",
+                              {"class": cls}, value=wait)
+        return wait
+
+    def _succeeded(self, cls):
+        bucket = self._limits.get(cls)
+        if bucket and bucket.rate < bucket.max_rate:
+            self._set_rate(cls, bucket.speed_up())
+
+    def _set_rate(self, cls, rate):
+        if self._metrics:
+            self._metrics.set("prepuller_api_rate_limit", rate,
+                              {"class": cls})
+
+    def _retry_delay(self, name, cls, exc, attempt, issued=None):
+        """Return seconds to wait before retrying a failed call, issued
+        at time.monotonic() time issued, or None if it should not be
+        retried.
+        """
+        status = getattr(exc, "status", None)
+        if status is not None:
+            if status not in self.retry_statuses:
+                return None
+        elif not isinstance(exc, self.transient):
+            return None
+        if attempt >= self.retries:
+            return None
+        if status == 429 and cls in self._limits:
+            self._set_rate(cls, self._limits[cls].slow_down(issued))
+        # "Full jitter": anywhere up to the exponential backoff.
+        delay = random.uniform(0, min(self.max_delay,
+                                      self.base_delay * 2 ** attempt))
+        delay = max(delay, self._retry_after(exc))
+        self._logger.debug("%s failed (%s); retry %d in %.1f s" % (
+            name, status or type(exc).__name__, attempt + 1, delay))
+        if self._metrics:
+            self._metrics.inc("prepuller_api_retries_total",
+                              {"class": cls or "other",
+                               "status": str(status or "error")})
+        return delay
+
+    def _retry_after(self, exc):
+        headers = getattr(exc, "headers", None)
+        if not headers:
+            return 0.0
+        try:
+            return min(self.max_delay, float(headers.get("Retry-After")))
+        except (TypeError, ValueError):
+            # Absent, or an HTTP date, which we do not bother with.
+            return 0.0
+
+
+def make_limits(write_qps, read_qps, metrics=None):
+    """Return the TokenBucket for each call class with a positive rate.
+    """
+    limits = {}
+    for cls, qps in [("write", write_qps), ("read", read_qps)]:
+        if qps and qps > 0:
+            limits[cls] = TokenBucket(qps)
+            if metrics:
+                metrics.set("prepuller_api_rate_limit", float(qps),
+                            {"class": cls})
+    return limits
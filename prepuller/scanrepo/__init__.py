@@ -1,3 +1,3 @@
 from .scanrepo import ScanRepo
-__all__ = [ScanRepo]
-
+from .cache import TagCache, describe_cache
+__all__ = [ScanRepo, TagCache, describe_cache]
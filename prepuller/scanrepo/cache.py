@@ -0,0 +1,244 @@
+import fcntl
+import glob
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+
+class TagCache(object):
+    """On-disk cache of the tag pages and scan results for one repository
+    URL.
+
+    Each page is stored with the ETag and Last-Modified validators the
+    registry sent, so it can be revalidated with a conditional request.
+    The full result list is stored with the time of the scan, so that
+    within `ttl` seconds a scan needs no request at all.  Layer lists are
+    stored by manifest digest, which never changes what it points to.
+    Pages and layer lists not fetched or used for `max_age` seconds are
+    dropped when the cache is saved.  The file is replaced atomically and
+    guarded by a lock file, so concurrent runs may share a cache
+    directory.
+    """
+    cache_dir = None
+    url = None
+    ttl = 0
+    max_age = 7 * 86400
+    logger = None
+
+    def __init__(self, cache_dir, url, ttl=0, logger=None):
+        self.cache_dir = cache_dir
+        self.url = url
+        if ttl:
+            self.ttl = ttl
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(__name__)
+        key = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        self.filename = os.path.join(cache_dir, key + ".json")
+        self.lockname = os.path.join(cache_dir, key + ".lock")
+        self.entry = self._empty()
+        self._lock = threading.Lock()
+        self.load()
+
+    def _empty(self):
+        return {"url": self.url, "scanned": None, "results": None,
+                "pages": {}, "layers": {}}
+
+    @contextmanager
+    def _file_lock(self, mode):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(self.lockname, "a") as lockf:
+            fcntl.flock(lockf, mode)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockf, fcntl.LOCK_UN)
+
+    def _read(self):
+        try:
+            with open(self.filename, "r") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get("url") != self.url:
+            return None
+        return entry
+
+    def load(self):
+        """Read the cache file, if there is one.
+        """
+        try:
+            with self._file_lock(fcntl.LOCK_SH):
+                entry = self._read()
+        except OSError as e:
+            self.logger.warning("Cannot read tag cache %s: %s" % (
+                self.filename, str(e)))
+            entry = None
+        if entry:
+            entry.setdefault("layers", {})
+            self.entry = entry
+
+    def save(self):
+        """Merge our entries into the cache file and replace it
+        atomically.  Failure to write is logged, not raised.
+        """
+        try:
+            with self._file_lock(fcntl.LOCK_EX):
+                ondisk = self._read() or self._empty()
+                with self._lock:
+                    ondisk["pages"].update(self.entry["pages"])
+                    ondisk.setdefault("layers", {}).update(
+                        self.entry["layers"])
+                    if (self.entry["scanned"] and
+                            self.entry["scanned"] > (ondisk["scanned"] or 0)):
+                        ondisk["scanned"] = self.entry["scanned"]
+                        ondisk["results"] = self.entry["results"]
+                        ondisk["kept"] = self.entry.get("kept")
+                    self._prune(ondisk)
+                    data = json.dumps(ondisk)
+                fd, tmpname = tempfile.mkstemp(dir=self.cache_dir,
+                                               prefix=".tmp-")
+                try:
+                    with os.fdopen(fd, "w") as f:
+                        f.write(data)
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.replace(tmpname, self.filename)
+                except BaseException:
+                    os.unlink(tmpname)
+                    raise
+        except OSError as e:
+            self.logger.warning("Cannot write tag cache %s: %s" % (
+                self.filename, str(e)))
+
+    def _prune(self, entry):
+        """Drop the pages and layer lists of entry that have not been
+        fetched or used for max_age seconds.
+        """
+        cutoff = time.time() - self.max_age
+        entry["pages"] = dict([(k, v) for k, v in entry["pages"].items()
+                               if (v.get("fetched") or 0) >= cutoff])
+        # Layer lists used to be stored bare, with no time.
+        entry["layers"] = dict([(k, v) for k, v in entry["layers"].items()
+                                if isinstance(v, dict) and
+                                v.get("used", 0) >= cutoff])
+
+    def fresh_results(self, kept=None):
+        """Return the cached scan results if they are younger than the
+        TTL, or None.  Results that are only the tags a scan kept are
+        returned only to a scan that would keep the same ones, as given
+        by kept.
+        """
+        scanned = self.entry["scanned"]
+        stored = self.entry.get("kept")
+        if stored is not None and stored != kept:
+            return None
+        if (self.ttl > 0 and scanned and self.entry["results"] is not None
+                and time.time() - scanned < self.ttl):
+            return self.entry["results"]
+        return None
+
+    def put_results(self, results, kept=None):
+        """Remember a scan's results: every tag, or, with kept, a list
+        saying which tags were kept, only those.
+        """
+        with self._lock:
+            self.entry["scanned"] = time.time()
+            self.entry["results"] = results
+            self.entry["kept"] = kept
+
+    def validators(self, key):
+        """Return conditional request headers for a cached page.
+        """
+        headers = {}
+        with self._lock:
+            page = self.entry["pages"].get(key)
+        if page:
+            if page.get("etag"):
+                headers["If-None-Match"] = page["etag"]
+            if page.get("last_modified"):
+                headers["If-Modified-Since"] = page["last_modified"]
+        return headers
+
+    def get_page(self, key):
+        """Return the cached body for a page the registry has just said
+        is unchanged, or None.
+        """
+        with self._lock:
+            page = self.entry["pages"].get(key)
+            if not page:
+                return None
+            page["fetched"] = time.time()
+            return page["body"]
+
+    def put_page(self, key, body, etag=None, last_modified=None):
+        """Remember a page body.  Pages without validators are not
+        worth keeping.
+        """
+        if not etag and not last_modified:
+            return
+        with self._lock:
+            self.entry["pages"][key] = {"etag": etag,
+                                        "last_modified": last_modified,
+                                        "fetched": time.time(),
+                                        "body": body}
+
+    def get_layers(self, digest):
+        """Return the cached layers, as (digest, size) tuples, of the
+        manifest with the given digest, or None.
+        """
+        with self._lock:
+            cached = self.entry["layers"].get(digest)
+            if not isinstance(cached, dict):
+                return None
+            cached["used"] = time.time()
+            return [tuple(x) for x in cached["layers"]]
+
+    def put_layers(self, digest, layers):
+        with self._lock:
+            self.entry["layers"][digest] = {
+                "layers": [list(x) for x in layers], "used": time.time()}
+
+    def summary(self):
+        """Describe the cache contents without the page bodies.
+        """
+        return _summarize(self.entry, self.filename)
+
+
+def _summarize(entry, filename):
+    now = time.time()
+    scanned = entry["scanned"]
+    pages = entry.get("pages") or {}
+    results = entry.get("results") or []
+    return {"url": entry["url"],
+            "file": filename,
+            "scanned": scanned,
+            "age": (now - scanned) if scanned else None,
+            "tags": len(results),
+            "pages": len(pages),
+            "manifests": len(entry.get("layers") or {}),
+            "etags": len([x for x in pages.values() if x.get("etag")])}
+
+
+def describe_cache(cache_dir):
+    """Return summaries of every repository cached in cache_dir.  The
+    cache files are only read, without taking the lock: a file being
+    written is replaced whole, so what is read is always complete.
+    """
+    summaries = []
+    for filename in sorted(glob.glob(os.path.join(cache_dir, "*.json"))):
+        try:
+            with open(filename, "r") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if isinstance(entry, dict) and entry.get("url"):
+            entry.setdefault("scanned", None)
+            summaries.append(_summarize(entry, filename))
+    return summaries
@@ -1,13 +1,27 @@
-import datetime
+import heapq
 import json
 import logging
-import urllib.parse
-import urllib.request
+import re
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+from urllib.parse import urljoin
+from .cache import TagCache
+from .tags import Tag, time_key
 
 
 class ScanRepo(object):
     """Class to scan repository and create results.
 
+       Tags are listed through one of two APIs.  "hub" is Docker Hub's
+       /v2/repositories/<owner>/<name>/tags/, which gives each tag's
+       times and digests; with credentials, we log in for a JWT first.
+       "registry" is the Docker Registry HTTP API's
+       /v2/<owner>/<name>/tags/list, which any registry serves but which
+       gives tag names alone, so tags are sorted by name and digests
+       come from the manifests; credentials are used as the registry's
+       authentication challenge asks.
+
        Based on:
        https://github.com/shangteus/py-dockerhub/blob/master/dockerhub.py"""
 
@@ -24,12 +38,33 @@ class ScanRepo(object):
     dailies = 3
     weeklies = 2
     releases = 1
+    page_size = 100
+    workers = 8
+    incremental = False
+    ordering = "last_updated"
+    time_fields = ["comp_ts", "last_updated"]
+    manifest_types = [
+        "application/vnd.docker.distribution.manifest.v2+json",
+        "application/vnd.docker.distribution.manifest.list.v2+json",
+        "application/vnd.oci.image.manifest.v1+json",
+        "application/vnd.oci.image.index.v1+json"]
+    platform = {"os": "linux", "architecture": "amd64"}
+    api = "hub"
+    apis = ["hub", "registry"]
+    registry_url = None
+    cache = None
+    credentials = None
     logger = None
+    _session = None
+    _token = None
+    _jwt = None
 
     def __init__(self, host='', path='', owner='', name='',
                  dailies=3, weeklies=2, releases=1,
                  json=False, port=None,
-                 insecure=False, sort_field="", debug=False):
+                 insecure=False, sort_field="", debug=False,
+                 page_size=0, workers=0, cache_dir=None, cache_ttl=0,
+                 incremental=False, credentials=None, api=None):
         logging.basicConfig()
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(logging.INFO)
@@ -42,12 +77,22 @@ class ScanRepo(object):
             self.owner = owner
         if name:
             self.name = name
-        if dailies:
+        # Zero is a valid retention count.
+        if dailies is not None:
             self.dailies = dailies
-        if weeklies:
+        if weeklies is not None:
             self.weeklies = weeklies
-        if releases:
+        if releases is not None:
             self.releases = releases
+        if port:
+            self.port = port
+        if api:
+            if api not in self.apis:
+                raise ValueError("Unknown tag API '%s'; use one of %s" % (
+                    api, ", ".join(self.apis)))
+            self.api = api
+        if credentials:
+            self.credentials = tuple(credentials)
         if json:
             self.json = json
         protocol = "https"
@@ -56,6 +101,16 @@ class ScanRepo(object):
             protocol = "http"
         if sort_field:
             self.sort_field = sort_field
+        if self.api == "registry" and self.sort_field != "name":
+            self.logger.info("The registry API gives no tag times;" +
+                             " sorting tags by name.")
+            self.sort_field = "name"
+        if page_size:
+            self.page_size = page_size
+        if workers:
+            self.workers = workers
+        if incremental:
+            self.incremental = incremental
         if debug:
             self.debug = debug
             self.logger.setLevel(logging.DEBUG)
@@ -63,11 +118,28 @@ class ScanRepo(object):
         exthost = self.host
         if port:
             exthost += ":" + str(port)
-        if not self.path:
-            self.path = ("/v2/repositories/" + self.owner + "/" +
-                         self.name + "/tags/")
-        self.url = protocol + "://" + exthost + self.path
+        self.base_url = protocol + "://" + exthost
+        # Docker Hub serves its tag listing and its registry API from
+        # different hosts.
+        if self.host == 'hub.docker.com':
+            self.registry_url = "https://registry-1.docker.io"
+        else:
+            self.registry_url = self.base_url
+        if self.api == "registry":
+            if not self.path:
+                self.path = "/v2/%s/%s/tags/list" % (self.owner, self.name)
+            self.url = self.registry_url + self.path
+        else:
+            if not self.path:
+                self.path = ("/v2/repositories/" + self.owner + "/" +
+                             self.name + "/tags/")
+            self.url = self.base_url + self.path
         self.logger.debug("URL %s" % self.url)
+        self._known_layers = {}
+        self.tags = {}
+        if cache_dir:
+            self.cache = TagCache(cache_dir, self.url, ttl=cache_ttl,
+                                  logger=self.logger)
 
     def __enter__(self):
         return self
@@ -79,6 +151,20 @@ class ScanRepo(object):
         """Close the session"""
         if self._session:
             self._session.close()
+            self._session = None
+
+    def _get_session(self):
+        """Return a session whose keep-alive connection pool is big enough
+        for every scan worker"""
+        if not self._session:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=self.workers)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers.update({"Accept": "application/json"})
+            self._session = session
+        return self._session
 
     def extract_image_info(self):
         """Build image name list and image description list"""
@@ -87,21 +173,9 @@ class ScanRepo(object):
             cs.extend(self.data[k])
         ldescs = []
         for c in cs:
-            tag = c["name"].split(":")[-1]
-            if tag[0] == "r":
-                rmaj = tag[1:3]
-                rmin = tag[3:]
-                ld = "Release %s.%s" % (rmaj, rmin)
-            elif tag[0] == "w":
-                year = tag[1:5]
-                week = tag[5:]
-                ld = "Weekly %s_%s" % (year, week)
-            elif tag[0] == "d":
-                year = tag[1:5]
-                month = tag[5:7]
-                day = tag[7:]
-                ld = "Daily %s_%s_%s" % (year, month, day)
-            ldescs.append(ld)
+            name = c["name"].split(":")[-1]
+            tag = self.tags.get(name) or Tag(name)
+            ldescs.append(tag.describe())
         ls = [self.owner + "/" + self.name + ":" + x["name"] for x in cs]
         return ls, ldescs
 
@@ -122,72 +196,408 @@ class ScanRepo(object):
         """Return the tag data"""
         return self.data
 
-    def _get_url(self, **kwargs):
-        params = None
-        resp = None
-        url = self.url
-        if kwargs:
-            params = urllib.parse.urlencode(kwargs)
-            url += "?%s" % params
-        headers = {"Accept": "application/json"}
-        req = urllib.request.Request(url, None, headers)
-        resp = urllib.request.urlopen(req)
-        page = resp.read()
-        return page
+    def get_digest(self, entry):
+        """Return the manifest digest for a tag entry, or None if the
+        registry did not tell us one we can use.  The registry API lists
+        no digests, so there it is asked for the tag's manifest digest,
+        which is then kept in the entry."""
+        digest = entry.get("digest")
+        if not digest:
+            images = entry.get("images") or []
+            # A per-platform digest is only the one the kubelet records
+            # if there is no manifest list, i.e. a single image.
+            if len(images) == 1:
+                digest = images[0].get("digest")
+        if not digest and self.api == "registry":
+            digest = self._manifest_digest(entry["name"])
+            if digest:
+                entry["digest"] = digest
+        return digest
+
+    def get_layers(self, entries):
+        """Fetch the image manifests for tag entries, several at once,
+        and return a dict of tag name to a list of (layer digest, size)
+        tuples.  Tags whose manifests cannot be had are left out."""
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            found = list(executor.map(self._layers_for, entries))
+        layers = {}
+        for entry, entry_layers in zip(entries, found):
+            if entry_layers is not None:
+                layers[entry["name"]] = entry_layers
+        if self.cache:
+            self.cache.save()
+        return layers
+
+    def _layers_for(self, entry):
+        digest = self.get_digest(entry)
+        if digest in self._known_layers:
+            return self._known_layers[digest]
+        if digest and self.cache:
+            cached = self.cache.get_layers(digest)
+            if cached is not None:
+                self._known_layers[digest] = cached
+                return cached
+        try:
+            manifest = self._get_manifest(digest or entry["name"])
+            if "manifests" in manifest:
+                ref = self._pick_platform(manifest["manifests"])
+                if not ref:
+                    self.logger.warning("No %s/%s image for %s" % (
+                        self.platform["os"], self.platform["architecture"],
+                        entry["name"]))
+                    return None
+                manifest = self._get_manifest(ref)
+        except Exception as e:
+            self.logger.warning("Cannot get manifest for %s: %s" % (
+                entry["name"], str(e)))
+            return None
+        layers = [(x["digest"], x.get("size", 0))
+                  for x in manifest.get("layers", [])]
+        if digest:
+            self._known_layers[digest] = layers
+            if self.cache:
+                self.cache.put_layers(digest, layers)
+        return layers
+
+    def _pick_platform(self, manifests):
+        for item in manifests:
+            platform = item.get("platform", {})
+            if all([platform.get(k) == v for k, v in self.platform.items()]):
+                return item["digest"]
+        return None
+
+    def _manifest_url(self, ref):
+        return "%s/v2/%s/%s/manifests/%s" % (self.registry_url, self.owner,
+                                             self.name, ref)
+
+    def _get_manifest(self, ref):
+        """Fetch a manifest by tag or digest from the registry API."""
+        headers = {"Accept": ", ".join(self.manifest_types)}
+        resp = self._registry_request("get", self._manifest_url(ref),
+                                      headers=headers)
+        resp.raise_for_status()
+        return resp.json()
+
+    def _manifest_digest(self, ref):
+        """Return the digest of the manifest for a tag, as the registry
+        reports it, or None if it cannot be had."""
+        headers = {"Accept": ", ".join(self.manifest_types)}
+        try:
+            resp = self._registry_request("head", self._manifest_url(ref),
+                                          headers=headers)
+            resp.raise_for_status()
+        except Exception as e:
+            self.logger.warning("Cannot get digest for %s: %s" % (
+                ref, str(e)))
+            return None
+        return resp.headers.get("Docker-Content-Digest")
+
+    def _registry_request(self, method, url, headers=None, params=None):
+        """Make a request of the registry API, answering its challenge
+        if it asks for authentication: with a bearer token, got
+        anonymously or with the credentials, or with the credentials
+        themselves if it asks for basic authentication."""
+        headers = dict(headers or {})
+        auth = None
+        for attempt in range(2):
+            if self._token:
+                headers["Authorization"] = "Bearer " + self._token
+            resp = self._get_session().request(method, url, headers=headers,
+                                               params=params, auth=auth)
+            if resp.status_code != 401 or attempt:
+                break
+            challenge = resp.headers.get("WWW-Authenticate", "")
+            if challenge.lower().startswith("basic"):
+                if not self.credentials:
+                    break
+                auth = self.credentials
+            else:
+                self._token = self._get_token(challenge)
+        return resp
+
+    def _get_token(self, challenge):
+        params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+        realm = params.pop("realm", None)
+        if not realm:
+            raise ValueError("Cannot authenticate to %s: '%s'" % (
+                self.registry_url, challenge))
+        resp = self._get_session().get(realm, params=params,
+                                       auth=self.credentials)
+        resp.raise_for_status()
+        j = resp.json()
+        return j.get("token") or j.get("access_token")
+
+    def _get_url(self, headers=None, **kwargs):
+        headers = dict(headers or {})
+        if self.credentials:
+            headers["Authorization"] = "JWT " + self._hub_login()
+        return self._get_session().get(self.url, params=kwargs,
+                                       headers=headers)
+
+    def _hub_login(self):
+        """Log in to Docker Hub with the credentials and return the JWT
+        its API takes, logging in only once."""
+        if not self._jwt:
+            username, password = self.credentials
+            resp = self._get_session().post(
+                self.base_url + "/v2/users/login/",
+                json={"username": username, "password": password})
+            resp.raise_for_status()
+            self._jwt = resp.json()["token"]
+        return self._jwt
+
+    def _page_key(self, page, **params):
+        key = "page=%d&page_size=%d" % (page, self.page_size)
+        for k in sorted(params):
+            key += "&%s=%s" % (k, params[k])
+        return key
+
+    def _get_page(self, page, **params):
+        key = self._page_key(page, **params)
+        headers = None
+        if self.cache:
+            headers = self.cache.validators(key)
+        try:
+            resp = self._get_url(headers=headers, page=page,
+                                 page_size=self.page_size, **params)
+            if resp.status_code == 304:
+                cached = None
+                if self.cache:
+                    cached = self.cache.get_page(key)
+                if cached is not None:
+                    self.logger.debug("Page %d not modified" % page)
+                    return cached
+                # Nothing to fall back on; ask again, unconditionally.
+                resp = self._get_url(page=page, page_size=self.page_size,
+                                     **params)
+                if resp.status_code == 304:
+                    raise ValueError("304 for an unconditional request")
+            resp.raise_for_status()
+        except Exception as e:
+            raise ValueError("Failure retrieving %s page %d: %s" %
+                             (self.url, page, str(e)))
+        j = self._decode_page(resp.content)
+        if self.cache:
+            self.cache.put_page(key, j, etag=resp.headers.get("ETag"),
+                                last_modified=resp.headers.get(
+                                    "Last-Modified"))
+        return j
+
+    def _remaining_pages(self, first):
+        """Work out from the first page which further pages there are.
+        The registry may return fewer results per page than we asked
+        for, so go by what it actually sent."""
+        if "next" not in first or not first["next"]:
+            return []
+        per_page = len(first["results"])
+        count = first.get("count")
+        if not count or not per_page:
+            return None
+        return list(range(2, (count + per_page - 1) // per_page + 1))
 
     def scan(self):
+        """Fetch every tag page and reduce the results.  After the first
+        page, the rest are fetched concurrently; results are kept in page
+        order, so they match a serial scan.  With a cache, results younger
+        than its TTL are used as they are.  In incremental mode, see
+        scan_incremental(); with the registry API, scan_registry()."""
+        if self.cache:
+            cached = self.cache.fresh_results(kept=self._kept())
+            if cached is not None:
+                self.logger.debug("Using cached scan of %s" % self.url)
+                self._reduce_results(cached)
+                return
+        if self.api == "registry":
+            self.scan_registry()
+            return
+        if self.can_scan_incremental():
+            self.scan_incremental()
+            return
+        first = self._get_page(1)
+        results = list(first["results"])
+        pages = self._remaining_pages(first)
+        j = first
+        if pages:
+            self.logger.debug("Fetching %d more pages" % len(pages))
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for j in executor.map(self._get_page, pages):
+                    results.extend(j["results"])
+        page = 1
+        if pages:
+            page = pages[-1]
+        # Without a count, or if tags were added while we scanned, follow
+        # the next links serially.
+        while "next" in j and j["next"]:
+            page = page + 1
+            j = self._get_page(page)
+            results.extend(j["results"])
+        self._save_cache(results)
+        self._reduce_results(results)
+
+    def scan_registry(self):
+        """List the tags through the registry API, following its Link
+        headers a page at a time, and reduce the results.  Each result
+        is a dict holding only the tag's name."""
         url = self.url
+        params = {"n": self.page_size}
         results = []
-        page = 1
-        resp_bytes = None
-        while True:
+        while url:
             try:
-                resp_bytes = self._get_url(page=page)
+                resp = self._registry_request("get", url, params=params)
+                resp.raise_for_status()
             except Exception as e:
-                raise ValueError("Failure retrieving %s: %s [ data: %s ]" %
-                                 (url, str(e),
-                                  str(resp_bytes.decode("utf-8"))))
-            resp_text = resp_bytes.decode("utf-8")
-            try:
-                j = json.loads(resp_text)
-            except ValueError:
-                raise ValueError("Could not decode '%s' -> '%s' as JSON" %
-                                 (url, str(resp_text)))
-            results.extend(j["results"])
+                raise ValueError("Failure retrieving %s: %s" % (url,
+                                                               str(e)))
+            j = self._decode_page(resp.content)
+            results.extend([{"name": x} for x in j.get("tags") or []])
+            url = resp.links.get("next", {}).get("url")
+            if url:
+                # The link carries the query, and may be relative.
+                url = urljoin(resp.url, url)
+                params = None
+        self._save_cache(results)
+        self._reduce_results(results)
+
+    def can_scan_incremental(self):
+        """Incremental scans only work when we keep the newest tags, and
+        the API can list them newest first."""
+        return (self.incremental and self.api == "hub" and
+                self.sort_field in self.time_fields)
+
+    def _limits(self):
+        # Tag prefix to (section name, number to keep).
+        return {"d": ("daily", self.dailies),
+                "w": ("weekly", self.weeklies),
+                "r": ("release", self.releases)}
+
+    def _sort_key(self):
+        # Time fields compare as times, not as strings that may differ
+        # in form.
+        if self.sort_field in self.time_fields:
+            return lambda x: time_key(x["last_updated"])
+        return itemgetter(self.sort_field)
+
+    def _new_heaps(self):
+        return TagHeaps(self._limits(),
+                        lambda x: time_key(x["last_updated"]))
+
+    def scan_incremental(self):
+        """Fetch tag pages newest first, keeping only the newest tags of
+        each class, and stop as soon as no older page could change the
+        result.  Gives the same data as a full scan."""
+        heaps = self._new_heaps()
+        page = 1
+        while True:
+            j = self._get_page(page, ordering=self.ordering)
+            oldest = heaps.add(j["results"])
+            if heaps.settled(oldest):
+                break
             if "next" not in j or not j["next"]:
                 break
             page = page + 1
-        self._reduce_results(results)
+        self.logger.debug("Incremental scan stopped after %d pages" % page)
+        data = heaps.result()
+        # Only the tags kept are known, so only a scan keeping the same
+        # ones may use them.
+        self._save_cache([x for section in sorted(data)
+                          for x in data[section]], kept=self._kept())
+        self._set_data(data)
+
+    def _kept(self):
+        return [self.sort_field, self.dailies, self.weeklies, self.releases]
+
+    def _save_cache(self, results, kept=None):
+        if self.cache:
+            self.cache.put_results(results, kept=kept)
+            self.cache.save()
+
+    def _decode_page(self, resp_bytes):
+        resp_text = resp_bytes.decode("utf-8")
+        try:
+            return json.loads(resp_text)
+        except ValueError:
+            raise ValueError("Could not decode '%s' -> '%s' as JSON" %
+                             (self.url, str(resp_text)))
 
     def _reduce_results(self, results):
-        sort_field = self.sort_field
-        r_candidates = []
-        w_candidates = []
-        d_candidates = []
+        """Keep the newest tags of each class.  Each tag is looked at
+        once, only the kept ones are ever ordered, and the result dicts
+        are left as they are, so a 100,000-tag history reduces in well
+        under a second; see benchmarks/reduce.py.
+        """
+        limits = self._limits()
+        candidates = dict([(x, []) for x in limits])
+        for res in results:
+            bucket = candidates.get(res["name"][:1])
+            if bucket is not None:
+                bucket.append(res)
+        key = self._sort_key()
+        r = {}
+        for prefix in limits:
+            section, count = limits[prefix]
+            # Same as a stable sort, newest first, cut to count.
+            r[section] = heapq.nlargest(count, candidates[prefix], key=key)
+        self._set_data(r)
+
+    def _set_data(self, data):
+        self.data = data
+        self.tags = {}
+        for section in data:
+            for res in data[section]:
+                self.tags[res["name"]] = Tag(res["name"])
+
+
+class TagHeaps(object):
+    """Bounded min-heaps holding the newest tags of each class seen so
+    far, for scans that see tags newest first and want to stop early."""
+
+    def __init__(self, limits, key):
+        # limits maps tag prefix to (section name, number to keep)
+        self.limits = limits
+        self.key = key
+        self.heaps = {}
+        for prefix in limits:
+            self.heaps[prefix] = []
+        self.seq = 0
+
+    def add(self, results):
+        """Add a page of results and return the oldest key on it."""
+        oldest = None
         for res in results:
-            vname = res["name"]
-            fc = vname[0]
-            res["comp_ts"] = self._convert_time(res["last_updated"])
-            if fc == "r":
-                r_candidates.append(res)
-            if fc == "w":
-                w_candidates.append(res)
-            if fc == "d":
-                d_candidates.append(res)
-        r_candidates.sort(key=lambda x: x[sort_field], reverse=True)
-        w_candidates.sort(key=lambda x: x[sort_field], reverse=True)
-        d_candidates.sort(key=lambda x: x[sort_field], reverse=True)
+            key = self.key(res)
+            if oldest is None or key < oldest:
+                oldest = key
+            prefix = res["name"][:1]
+            if prefix not in self.heaps:
+                continue
+            # On equal keys the tag seen first wins, as in a stable sort.
+            self.seq += 1
+            item = (key, -self.seq, res)
+            heap = self.heaps[prefix]
+            if len(heap) < self.limits[prefix][1]:
+                heapq.heappush(heap, item)
+            elif heap and item > heap[0]:
+                heapq.heapreplace(heap, item)
+        return oldest
+
+    def settled(self, oldest):
+        """True if no tag with a key at or below oldest could get into
+        any heap."""
+        if oldest is None:
+            return False
+        for prefix in self.heaps:
+            heap = self.heaps[prefix]
+            if len(heap) < self.limits[prefix][1]:
+                return False
+            if heap and heap[0][0] < oldest:
+                return False
+        return True
+
+    def result(self):
+        """Return the kept tags as scan data, newest first."""
         r = {}
-        r["daily"] = d_candidates[:self.dailies]
-        r["weekly"] = w_candidates[:self.weeklies]
-        r["release"] = r_candidates[:self.releases]
-        for tp in r:
-            for v in r[tp]:
-                del(v["comp_ts"])
-        self.data = r
-
-    def _convert_time(self, ts):
-        f = '%Y-%m-%dT%H:%M:%S.%f%Z'
-        if ts[-1] == "Z":
-            ts = ts[:-1] + "UTC"
-        return datetime.datetime.strptime(ts, f)
+        for prefix in self.heaps:
+            section = self.limits[prefix][0]
+            r[section] = [x[2] for x in sorted(self.heaps[prefix],
+                                               reverse=True)]
+        return r
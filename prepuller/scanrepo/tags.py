@@ -0,0 +1,90 @@
+import datetime
+import re
+
+# The form Docker Hub gives last_updated in, which already sorts as
+# time does.
+CANONICAL_TIME = re.compile(r"\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d\.\d{6}Z\Z")
+
+
+def parse_time(ts):
+    """Turn an ISO 8601 timestamp, as the registry gives last_updated,
+    into a naive datetime in UTC, more quickly than strptime() does.
+    The fraction of a second may have any number of digits, and the
+    zone may be "Z" or an offset; a missing zone is taken as UTC.
+    """
+    try:
+        if (ts[4] != "-" or ts[7] != "-" or ts[10] not in "Tt " or
+                ts[13] != ":" or ts[16] != ":"):
+            raise ValueError()
+        when = datetime.datetime(int(ts[0:4]), int(ts[5:7]), int(ts[8:10]),
+                                 int(ts[11:13]), int(ts[14:16]),
+                                 int(ts[17:19]))
+        rest = ts[19:]
+        if rest[:1] == ".":
+            end = 1
+            while end < len(rest) and rest[end].isdigit():
+                end += 1
+            if end == 1:
+                raise ValueError()
+            when = when.replace(microsecond=int(rest[1:end][:6].ljust(6,
+                                                                      "0")))
+            rest = rest[end:]
+        if rest in ("", "Z", "z"):
+            return when
+        if rest[0] not in "+-" or len(rest.replace(":", "")) != 5:
+            raise ValueError()
+        offset = datetime.timedelta(hours=int(rest[1:3]),
+                                    minutes=int(rest[-2:]))
+        if rest[0] == "+":
+            return when - offset
+        return when + offset
+    except (IndexError, TypeError, ValueError):
+        raise ValueError("Cannot parse time '%s'" % ts)
+
+
+def time_key(ts):
+    """Return a string for an ISO 8601 timestamp that sorts as the time
+    does: the time in UTC as YYYY-MM-DDTHH:MM:SS.ffffff.  Timestamps
+    already in that form, which is nearly all of them, are only checked
+    and sliced, which is far quicker than parsing them.
+    """
+    if isinstance(ts, str) and CANONICAL_TIME.match(ts):
+        return ts[:26]
+    when = parse_time(ts)
+    return "%04d-%02d-%02dT%02d:%02d:%02d.%06d" % (
+        when.year, when.month, when.day, when.hour, when.minute,
+        when.second, when.microsecond)
+
+
+class Tag(object):
+    """A daily, weekly or release tag name, taken apart once.
+
+    Dailies are dYYYYMMDD, weeklies wYYYYWW and releases rMMmm, any of
+    them possibly followed by more; `fields` holds the parts, as
+    strings so that their zero padding is kept, and `kind` the first
+    letter.  Tags of any other kind are not ours to keep.
+    """
+    __slots__ = ("name", "kind", "fields")
+    sections = {"d": "daily", "w": "weekly", "r": "release"}
+    splits = {"d": (1, 5, 7), "w": (1, 5), "r": (1, 3)}
+    formats = {"d": "Daily %s_%s_%s", "w": "Weekly %s_%s",
+               "r": "Release %s.%s"}
+
+    def __init__(self, name):
+        kind = name[:1]
+        if kind not in self.splits:
+            raise ValueError("'%s' is not a d, w or r tag" % name)
+        self.name = name
+        self.kind = kind
+        cuts = self.splits[kind] + (None,)
+        self.fields = tuple([name[cuts[x]:cuts[x + 1]]
+                             for x in range(len(cuts) - 1)])
+
+    @property
+    def section(self):
+        return self.sections[self.kind]
+
+    def describe(self):
+        """Return a description, such as "Weekly 2018_22".
+        """
+        return self.formats[self.kind] % self.fields
@@ -0,0 +1,189 @@
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition, RLock
+
+
+class PullScheduler(object):
+    """Run per-node pull work on a bounded pool of worker threads.
+
+    At most `per_node` pulls run on any one node at a time, and at most
+    `max_in_flight` run across the whole cluster.  `pull` is called as
+    pull(node, item) for every item submitted for a node.
+
+    Use run() for a single batch of work.  A long-running caller can
+    instead start() the scheduler, submit() work as it appears, take()
+    the failures now and then so that they do not pile up, and stop() it
+    at the end.
+
+    Items are pulled in the order submitted, so callers should put the
+    most important first.  Given a deadline (in time.time() terms), the
+    scheduler stops starting pulls once the mean time of those finished
+    so far says a new one would not end in time; what is left is
+    recorded in `deferred` as (node, item) tuples.
+    """
+    per_node = 1
+    max_in_flight = 50
+    deadline = None
+    logger = None
+
+    def __init__(self, pull, per_node=None, max_in_flight=None,
+                 deadline=None, logger=None):
+        self.pull = pull
+        if per_node:
+            self.per_node = per_node
+        if max_in_flight:
+            self.max_in_flight = max_in_flight
+        if deadline:
+            self.deadline = deadline
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(__name__)
+        # Reentrant, because a future that is already done runs its
+        # callback as soon as it is added, in the submitting thread.
+        self._lock = RLock()
+        self._idle = Condition(self._lock)
+        self._queues = {}
+        self._active = {}
+        self._running = {}
+        self._executor = None
+        self._stopping = False
+        self._pull_time = 0.0
+        self._pulls = 0
+        self.failures = []
+        self.deferred = []
+
+    def start(self, workers=None):
+        """Start the worker pool, of at most max_in_flight threads.
+        """
+        if not workers:
+            workers = self.max_in_flight
+        workers = min(workers, self.max_in_flight)
+        self.logger.debug("Starting %d pull workers" % workers)
+        self._stopping = False
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    def submit(self, node, items):
+        """Queue items to pull on a node, behind any already queued.
+        """
+        with self._lock:
+            self._queues.setdefault(node, deque()).extend(items)
+            self._fill(node)
+
+    def pending(self, node):
+        """Return the number of items queued or running on a node.
+        """
+        with self._lock:
+            return (len(self._queues.get(node, [])) +
+                    self._active.get(node, 0))
+
+    def drop(self, node):
+        """Forget the work queued, but not yet started, for a node.
+        """
+        with self._lock:
+            self._queues.pop(node, None)
+
+    def wait(self):
+        """Block until no work is queued or running.
+        """
+        with self._lock:
+            while self._running:
+                self._idle.wait()
+
+    def take(self):
+        """Return the failures and deferred pulls recorded so far, and
+        forget them.
+        """
+        with self._lock:
+            failures, self.failures = self.failures, []
+            deferred, self.deferred = self.deferred, []
+        return failures, deferred
+
+    def stop(self):
+        """Drop queued work and shut the pool down without waiting for
+        the pulls that are already running.
+        """
+        with self._lock:
+            self._stopping = True
+            self._queues = {}
+            for fut in list(self._running):
+                fut.cancel()
+        if self._executor:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def run(self, work):
+        """Run all the work, a dict of lists of items keyed by node.
+        Return a list of (node, item, exception) tuples for the pulls
+        that raised; a failed pull does not stop the rest of that node's
+        work.
+        """
+        nodes = [x for x in work if work[x]]
+        if not nodes:
+            return []
+        self.start(self.per_node * len(nodes))
+        try:
+            with self._lock:
+                for node in nodes:
+                    self._queues[node] = deque(work[node])
+                # Go breadth-first so that every node has a pull queued
+                # before any node gets a second slot.
+                for slot in range(1, self.per_node + 1):
+                    for node in nodes:
+                        self._fill(node, limit=slot)
+            self.wait()
+        finally:
+            self.stop()
+        return self.failures
+
+    def _fill(self, node, limit=None):
+        # Call with the lock held.
+        if self._stopping or not self._executor:
+            return
+        if limit is None:
+            limit = self.per_node
+        queue = self._queues.get(node)
+        while queue and self._active.get(node, 0) < limit:
+            if self._out_of_time():
+                self.logger.debug("Out of time; deferring %d pulls on" %
+                                  len(queue) + " node '%s'" % node)
+                self.deferred.extend([(node, x) for x in queue])
+                queue.clear()
+                break
+            item = queue.popleft()
+            self._active[node] = self._active.get(node, 0) + 1
+            fut = self._executor.submit(self._timed_pull, node, item)
+            self._running[fut] = (node, item)
+            fut.add_done_callback(self._done)
+        if queue is not None and not queue:
+            self._queues.pop(node, None)
+
+    def _out_of_time(self):
+        # Call with the lock held.
+        if not self.deadline or not self._pulls:
+            return False
+        return time.time() + self._pull_time / self._pulls > self.deadline
+
+    def _timed_pull(self, node, item):
+        start = time.time()
+        self.pull(node, item)
+        with self._lock:
+            self._pull_time += time.time() - start
+            self._pulls += 1
+
+    def _done(self, fut):
+        with self._lock:
+            node, item = self._running.pop(fut)
+            self._active[node] -= 1
+            if not self._active[node]:
+                del self._active[node]
+            if not fut.cancelled() and fut.exception():
+                exc = fut.exception()
+                self.logger.error("Pull on node '%s' failed: %s" % (
+                    node, str(exc)))
+                self.failures.append((node, item, exc))
+            self._fill(node)
+            if not self._running:
+                self._idle.notify_all()
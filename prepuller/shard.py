@@ -0,0 +1,181 @@
+import hashlib
+import logging
+import re
+import threading
+import time
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+
+
+class ShardCoordinator(object):
+    """Split the nodes among several prepuller replicas.
+
+    Replicas find each other through a ConfigMap in which each one keeps
+    an entry, its identity mapped to the time it last renewed it.
+    Entries not renewed within `member_ttl` seconds are ignored and
+    pruned, so when a replica dies its nodes move to the survivors.
+    Writes replace the ConfigMap at the resource version read, so
+    concurrent renewals cannot lose each other's entries.
+
+    A node belongs to the live replica with the highest hash of replica
+    and shard key (rendezvous hashing), so a change in membership only
+    moves the nodes of the replicas that came or went.  The shard key is
+    the node name or, in "label" mode, the value of a node label, so
+    that a whole node pool goes to one replica; nodes without the label
+    fall back to their name.
+    """
+    configmap = "prepuller-members"
+    member_ttl = 30
+    retries = 5
+    logger = None
+
+    def __init__(self, client, namespace, identity, mode="hash",
+                 label=None, member_ttl=None, on_change=None, logger=None):
+        self.client = client
+        self.namespace = namespace
+        # ConfigMap keys and label values allow only these characters.
+        self.identity = re.sub(r"[^-._a-zA-Z0-9]", "-", identity)[:63]
+        self.mode = mode
+        self.label = label
+        if member_ttl:
+            self.member_ttl = member_ttl
+        self.on_change = on_change
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(__name__)
+        self.renew_interval = self.member_ttl / 3.0
+        self._members = [self.identity]
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def join(self):
+        """Register, give the other replicas one renewal interval to do
+        the same, and keep renewing from a background thread.
+        """
+        if self._thread:
+            return
+        self.renew()
+        self._stopping.wait(self.renew_interval)
+        self.renew()
+        self.logger.info("Replica %s is one of %d: %s" % (
+            self.identity, len(self._members), ", ".join(self._members)))
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name="shard-coordinator")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def leave(self):
+        """Stop renewing and remove our entry, so that the others take
+        over our nodes at once rather than after member_ttl.  A renewal
+        under way is let finish first, lest it put the entry back.
+        """
+        self._stopping.set()
+        thread = self._thread
+        self._thread = None
+        if thread and thread is not threading.current_thread():
+            thread.join()
+        try:
+            self._update(remove=True)
+        except Exception as e:
+            self.logger.warning("Could not leave %s: %s" % (self.configmap,
+                                                            str(e)))
+
+    def members(self):
+        with self._lock:
+            return list(self._members)
+
+    def shard_key(self, node):
+        if self.mode == "label" and self.label:
+            value = (node.metadata.labels or {}).get(self.label)
+            if value:
+                return "label:" + value
+        return "node:" + node.metadata.name
+
+    def owner(self, node):
+        """Return the identity of the replica that owns a node.
+        """
+        key = self.shard_key(node)
+        return max(self.members(), key=lambda x: hashlib.sha1(
+            (x + "/" + key).encode("utf-8")).hexdigest())
+
+    def owns(self, node):
+        return self.owner(node) == self.identity
+
+    def renew(self):
+        """Renew our entry and refresh the member list.  Return True if
+        the members changed.
+        """
+        members = self._update()
+        with self._lock:
+            changed = members != self._members
+            self._members = members
+        if changed:
+            self.logger.info("Prepuller replicas now: %s" %
+                             ", ".join(members))
+        return changed
+
+    def _run(self):
+        while not self._stopping.wait(self.renew_interval):
+            try:
+                changed = self.renew()
+            except Exception as e:
+                self.logger.warning("Could not renew membership: %s" %
+                                    str(e))
+                continue
+            if changed and self.on_change:
+                try:
+                    self.on_change()
+                except Exception as e:
+                    self.logger.error("Resharding failed: %s" % str(e))
+
+    def _update(self, remove=False):
+        """Read, amend and replace the ConfigMap, retrying on conflicts.
+        Return the live members, ourselves included unless removing.
+        """
+        v1 = self.client
+        for attempt in range(self.retries):
+            now = time.time()
+            try:
+                cm = v1.read_namespaced_config_map(self.configmap,
+                                                   self.namespace)
+            except ApiException as e:
+                if e.status != 404:
+                    raise
+                cm = None
+            data = {}
+            if cm and cm.data:
+                data = dict(cm.data)
+            live = {}
+            for member in data:
+                try:
+                    renewed = float(data[member])
+                except ValueError:
+                    continue
+                if now - renewed < self.member_ttl:
+                    live[member] = data[member]
+            if remove:
+                live.pop(self.identity, None)
+            else:
+                live[self.identity] = "%.3f" % now
+            try:
+                if cm is None:
+                    v1.create_namespaced_config_map(
+                        self.namespace, client.V1ConfigMap(
+                            metadata=client.V1ObjectMeta(
+                                name=self.configmap),
+                            data=live))
+                else:
+                    cm.data = live
+                    v1.replace_namespaced_config_map(self.configmap,
+                                                     self.namespace, cm)
+            except ApiException as e:
+                # 409: someone else wrote first; read it again.
+                if e.status != 409:
+                    raise
+                continue
+            return sorted(live)
+        raise RuntimeError("Could not update %s after %d attempts" % (
+            self.configmap, self.retries))
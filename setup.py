@@ -43,8 +43,12 @@ setup(
     packages=find_packages(exclude=['docs', 'tests*']),
     install_requires=[
         'requests>=2.0.0,<3.0.0',
-        'kubernetes>=5.0.0b1,<6.0.0'
+        'kubernetes>=5.0.0b1,<6.0.0',
+        'PyYAML>=3.12'
     ],
+    extras_require={
+        'async': ['aiohttp', 'kubernetes_asyncio']
+    },
     tests_require=['pytest', 'pytest-flake8', 'pytest-cov'],
     entry_points={
         'console_scripts': [
@@ -0,0 +1,64 @@
+import asyncio
+from types import SimpleNamespace
+from kubernetes import client
+from kubernetes_asyncio.client.rest import ApiException
+from prepuller.aioprepuller import AsyncPodWatcher
+
+
+class FakeClient(object):
+    """Answers reads of single pods from a dict of name to phase."""
+
+    def __init__(self, phases):
+        self.phases = phases
+
+    async def list_namespaced_pod(self, namespace, **kwargs):
+        # A snapshot taken before any of the pods were created.
+        return SimpleNamespace(items=[], metadata=SimpleNamespace(
+            _continue=None, resource_version="7"))
+
+    async def read_namespaced_pod(self, name, namespace):
+        if name not in self.phases:
+            raise ApiException(status=404)
+        return SimpleNamespace(status=SimpleNamespace(
+            phase=self.phases[name]))
+
+
+def wait(watcher, podname, timeout=1):
+    return asyncio.run(watcher.wait(podname, timeout=timeout))
+
+
+def test_pod_finished_before_wait():
+    watcher = AsyncPodWatcher(FakeClient({"pp-done": "Failed"}), "default")
+    assert wait(watcher, "pp-done") == "Failed"
+    assert not watcher.waiters
+
+
+def test_pod_gone_before_wait():
+    watcher = AsyncPodWatcher(FakeClient({}), "default")
+    assert wait(watcher, "pp-gone") == "Deleted"
+
+
+def test_wait_times_out():
+    watcher = AsyncPodWatcher(FakeClient({"pp-slow": "Running"}), "default")
+    assert wait(watcher, "pp-slow", timeout=0.1) is None
+
+
+def test_relist_rereads_missing_waiters():
+    watcher = AsyncPodWatcher(FakeClient({"pp-new": "Pending"}), "default")
+    watcher.waiters.update({"pp-new": None, "pp-gone": None})
+    asyncio.run(watcher._relist())
+    # Created after the list was taken, so not in it, but not gone.
+    assert watcher.phases == {"pp-new": "Pending", "pp-gone": "Deleted"}
+
+
+def test_pod_body_serializes():
+    pod = client.V1Pod(metadata=client.V1ObjectMeta(
+        name="pp-x", labels={"app": "prepuller"}),
+        spec=client.V1PodSpec(node_name="node-1", containers=[
+            client.V1Container(name="prepull", image="img:1",
+                               image_pull_policy="Always")]))
+    body = client.ApiClient().sanitize_for_serialization(pod)
+    assert body["metadata"] == {"name": "pp-x",
+                                "labels": {"app": "prepuller"}}
+    assert body["spec"]["nodeName"] == "node-1"
+    assert body["spec"]["containers"][0]["imagePullPolicy"] == "Always"
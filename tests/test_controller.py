@@ -0,0 +1,127 @@
+import logging
+import threading
+from kubernetes import client
+from prepuller.controller import PrepullController
+from prepuller.metrics import Metrics
+from prepuller.priority import PullPriority
+from prepuller.prepuller import Prepuller
+
+
+class FakePrepuller(Prepuller):
+    """Pulls by recording them, with the phase given for each image, and
+    lists the nodes given."""
+
+    def __init__(self, images, nodes):
+        self.logger = logging.getLogger(__name__)
+        self.metrics = Metrics()
+        self.priority = PullPriority()
+        self.images = list(images)
+        self.listed = list(nodes)
+        self.nodes = []
+        self.node_images = {}
+        self.node_uids = {}
+        self.full_image_lists = set()
+        self.phases = {}
+        self.pulled = []
+        self._lock = threading.Lock()
+        self._watcher_lock = threading.Lock()
+
+    def update_images_from_repo(self):
+        pass
+
+    def _list_nodes(self, v1):
+        self.nodes_version = "3"
+        return [make_node(x) for x in self.listed]
+
+    def run_single_pod(self, node, img):
+        with self._lock:
+            self.pulled.append((node, img))
+        phase = self.phases.get(img, "Succeeded")
+        if phase == "raise":
+            raise RuntimeError("timed out")
+        return phase
+
+
+def make_node(name):
+    return client.V1Node(
+        metadata=client.V1ObjectMeta(name=name),
+        spec=client.V1NodeSpec(),
+        status=client.V1NodeStatus(conditions=[
+            client.V1NodeCondition(type="Ready", status="True")]))
+
+
+def controller(images, nodes):
+    pp = FakePrepuller(images, nodes)
+    ctl = PrepullController(pp)
+    ctl.scheduler.start()
+    return pp, ctl
+
+
+def settle(ctl):
+    ctl.scheduler.wait()
+
+
+def test_new_node_gets_every_image():
+    pp, ctl = controller(["a:1", "b:1"], [])
+    ctl._node_event("ADDED", make_node("node-1"))
+    settle(ctl)
+    assert sorted(pp.pulled) == [("node-1", "a:1"), ("node-1", "b:1")]
+    assert pp.nodes == ["node-1"]
+    assert ctl.wanted == {"node-1": {"a:1", "b:1"}}
+    # Seeing it again queues nothing more.
+    ctl._node_event("MODIFIED", make_node("node-1"))
+    settle(ctl)
+    assert len(pp.pulled) == 2
+    ctl.stop()
+
+
+def test_removed_node_is_dropped():
+    pp, ctl = controller(["a:1"], ["node-1", "node-2"])
+    ctl._relist_nodes()
+    settle(ctl)
+    assert sorted(ctl.wanted) == ["node-1", "node-2"]
+    assert ctl.resource_version == "3"
+    ctl._node_event("DELETED", make_node("node-1"))
+    assert list(ctl.wanted) == ["node-2"]
+    assert pp.nodes == ["node-2"]
+    # A relist that no longer finds a node drops it too.
+    pp.listed = []
+    ctl._relist_nodes()
+    assert ctl.wanted == {}
+    assert pp.nodes == []
+    ctl.stop()
+
+
+def test_rescan_queues_only_new_images():
+    pp, ctl = controller(["a:1"], [])
+    ctl._node_event("ADDED", make_node("node-1"))
+    settle(ctl)
+    pp.images = ["a:1", "b:1"]
+    ctl.rescan()
+    settle(ctl)
+    assert pp.pulled == [("node-1", "a:1"), ("node-1", "b:1")]
+    # Images no longer in the set are forgotten.
+    pp.images = ["b:1"]
+    ctl.rescan()
+    assert ctl.wanted == {"node-1": {"b:1"}}
+    ctl.stop()
+
+
+def test_failed_pulls_are_retried_on_rescan():
+    pp, ctl = controller(["a:1", "b:1", "c:1"], [])
+    pp.phases = {"a:1": "Failed", "b:1": "raise", "c:1": "Deleted"}
+    ctl._node_event("ADDED", make_node("node-1"))
+    settle(ctl)
+    assert ctl.wanted == {"node-1": set()}
+    assert len(ctl.scheduler.failures) == 1
+    pp.phases = {}
+    ctl.rescan()
+    settle(ctl)
+    assert sorted(pp.pulled) == sorted(
+        [("node-1", x) for x in ["a:1", "b:1", "c:1"]] * 2)
+    assert ctl.wanted == {"node-1": {"a:1", "b:1", "c:1"}}
+    # The failures were reported and forgotten.
+    assert ctl.scheduler.failures == []
+    assert pp.metrics.values[("prepuller_failures_total",
+                              (("kind", "pull"),))] == 1
+    ctl.stop()
@@ -0,0 +1,120 @@
+import argparse
+import logging
+import time
+from types import SimpleNamespace
+from prepuller.daemonset import DaemonSetPuller
+from prepuller.metrics import Metrics
+from prepuller.priority import PullPriority
+from prepuller.prepuller import Prepuller
+
+
+class FakeAppsApi(object):
+    """Keeps DaemonSets by name, and lists them as rolled out or not."""
+
+    def __init__(self, rolled_out=True):
+        self.daemonsets = {}
+        self.created = []
+        self.deleted = []
+        self.rolled_out = rolled_out
+
+    def create_namespaced_daemon_set(self, namespace, body):
+        self.daemonsets[body.metadata.name] = body
+        self.created.append(body.metadata.name)
+        return body
+
+    def delete_namespaced_daemon_set(self, name, namespace, body):
+        self.daemonsets.pop(name, None)
+        self.deleted.append(name)
+
+    def list_namespaced_daemon_set(self, namespace, label_selector=None,
+                                   **kwargs):
+        ready = 0
+        if self.rolled_out:
+            ready = 2
+        items = [SimpleNamespace(
+            metadata=SimpleNamespace(name=x, generation=1,
+                                     resource_version="5"),
+            status=SimpleNamespace(observed_generation=1,
+                                   desired_number_scheduled=2,
+                                   number_ready=ready,
+                                   updated_number_scheduled=2))
+            for x in sorted(self.daemonsets)]
+        return SimpleNamespace(items=items, metadata=SimpleNamespace(
+            resource_version="5"))
+
+
+def puller(plan, layout="combined", deadline=None, rolled_out=True):
+    pp = Prepuller.__new__(Prepuller)
+    pp.args = argparse.Namespace(pull_order="name", pin_digests=True,
+                                 pause_image="pause:3.1")
+    pp.logger = logging.getLogger("test")
+    pp.metrics = Metrics()
+    pp.priority = PullPriority()
+    pp.plan = plan
+    pp.images = sorted(set([x for y in plan.values() for x in y]))
+    pp.digests = {"img:a": "sha256:aa"}
+    pp.command = ["true"]
+    pp.tolerations = []
+    pp.node_labels = {"node-1": {"kubernetes.io/hostname": "host-1"}}
+    pp.journal = None
+    pp.deadline = deadline
+    ds = DaemonSetPuller.__new__(DaemonSetPuller)
+    ds.prepuller = pp
+    ds.logger = pp.logger
+    ds.namespace = "default"
+    ds.api = FakeAppsApi(rolled_out=rolled_out)
+    ds.layout = layout
+    return ds
+
+
+def test_combined_pulls_only_planned_images():
+    # node-3 has no room for img:c, and node-4 has everything.
+    ds = puller({"node-1": ["img:b", "img:a", "img:c"],
+                 "node-2": ["img:c", "img:a", "img:b"],
+                 "node-3": ["img:a", "img:b"],
+                 "node-4": []})
+    assert ds.build_plan() == {
+        "pp-ds-0": (["img:a", "img:b"], ["node-3"]),
+        "pp-ds-1": (["img:a", "img:b", "img:c"], ["node-1", "node-2"])}
+
+
+def test_per_image_layout():
+    ds = puller({"node-1": ["img:a", "img:b"], "node-2": ["img:b"]},
+                layout="per-image")
+    assert ds.build_plan() == {"pp-ds-0": (["img:a"], ["node-1"]),
+                               "pp-ds-1": (["img:b"], ["node-1", "node-2"])}
+
+
+def test_daemonset_spec():
+    ds = puller({"node-1": ["img:a", "img:b"]})
+    body = ds._build_daemonset("pp-ds-0", ["img:a", "img:b"],
+                               ["node-1", "node-2"])
+    spec = body.spec.template.spec
+    assert [(x.name, x.image, x.image_pull_policy)
+            for x in spec.init_containers] == [
+        ("pull-0", "img@sha256:aa", "IfNotPresent"),
+        ("pull-1", "img:b", "Always")]
+    assert spec.containers[0].image == "pause:3.1"
+    required = (spec.affinity.node_affinity.
+                required_during_scheduling_ignored_during_execution)
+    term = required.node_selector_terms[0]
+    # Nodes without a hostname label go by their names.
+    assert term.match_expressions[0].values == ["host-1", "node-2"]
+    assert body.spec.selector.match_labels == body.metadata.labels
+
+
+def test_run_creates_waits_and_deletes():
+    ds = puller({"node-1": ["img:a"], "node-2": ["img:b"]})
+    assert ds.run() == []
+    assert ds.api.created == ["pp-ds-0", "pp-ds-1"]
+    assert sorted(ds.api.deleted) == ["pp-ds-0", "pp-ds-1"]
+    assert ds.api.daemonsets == {}
+
+
+def test_rollout_stops_at_run_deadline():
+    ds = puller({"node-1": ["img:a"]}, deadline=time.time() - 1,
+                rolled_out=False)
+    start = time.time()
+    assert ds.run() == [("pp-ds-0", ["img:a"])]
+    assert time.time() - start < 5
+    assert ds.api.deleted == ["pp-ds-0"]
@@ -0,0 +1,66 @@
+from kubernetes import client
+from prepuller.disk import DiskBudget, parse_quantity
+
+GI = 1 << 30
+
+
+def node(name, capacity=None, allocatable=None, images=()):
+    return client.V1Node(
+        metadata=client.V1ObjectMeta(name=name),
+        status=client.V1NodeStatus(
+            capacity=capacity and {"ephemeral-storage": capacity},
+            allocatable=allocatable and {"ephemeral-storage": allocatable},
+            images=[client.V1ContainerImage(names=[x], size_bytes=y)
+                    for x, y in images]))
+
+
+def test_parse_quantity():
+    assert parse_quantity("100Gi") == 100 * GI
+    assert parse_quantity("2G") == 2e9
+    assert parse_quantity("1e9") == 1e9
+    assert parse_quantity("500m") == 0.5
+    assert parse_quantity("12Qi") is None
+    assert parse_quantity(None) is None
+
+
+def test_limit_is_share_of_capacity_within_allocatable():
+    disk = DiskBudget(0.5)
+    disk.add_node(node("big", "100Gi", "90Gi"), str)
+    disk.add_node(node("tight", "100Gi", "30Gi"), str)
+    disk.add_node(node("unknown"), str)
+    assert disk.limits["big"] == 50 * GI
+    assert disk.limits["tight"] == 30 * GI
+    assert disk.free("unknown") is None
+
+
+def test_free_takes_off_images_present():
+    disk = DiskBudget(0.5)
+    disk.add_node(node("n", "100Gi", images=[("a:1", 10 * GI),
+                                             ("b:1", 5 * GI)]), str)
+    assert disk.free("n") == 35 * GI
+    assert disk.sizes == {"a:1": 10 * GI, "b:1": 5 * GI}
+    disk.drop_node("n")
+    assert disk.free("n") is None
+
+
+def test_fit_keeps_priority_order_and_passes_over_big_images():
+    disk = DiskBudget(0.1)
+    disk.add_node(node("n", "100Gi"), str)
+    sizes = {"first": 4 * GI, "huge": 8 * GI, "second": 5 * GI,
+             "third": 2 * GI}
+    chosen, over = disk.fit("n", ["first", "huge", "second", "third"],
+                            lambda chosen, img: sizes[img])
+    assert chosen == ["first", "second"]
+    assert over == ["huge", "third"]
+    chosen, over = disk.fit("n", ["third", "first"],
+                            lambda chosen, img: sizes[img],
+                            pending=5 * GI)
+    assert chosen == ["third"]
+    assert over == ["first"]
+
+
+def test_fit_without_capacity_takes_everything():
+    disk = DiskBudget(0.1)
+    disk.add_node(node("n"), str)
+    assert disk.fit("n", ["a", "b"], lambda chosen, img: GI) == (
+        ["a", "b"], [])
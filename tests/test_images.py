@@ -0,0 +1,104 @@
+import argparse
+from kubernetes import client
+from prepuller.prepuller import Prepuller
+
+
+def prepuller(digests=None, pin_digests=True):
+    # Image references need no cluster.
+    pp = Prepuller.__new__(Prepuller)
+    pp.args = argparse.Namespace(pin_digests=pin_digests)
+    pp.digests = dict(digests or {})
+    pp.node_images = {}
+    pp.command = ["true"]
+    return pp
+
+
+def test_normalize_docker_hub_references():
+    pp = prepuller()
+    for img, want in [
+            ("ubuntu", "docker.io/library/ubuntu:latest"),
+            ("library/ubuntu:18.04", "docker.io/library/ubuntu:18.04"),
+            ("docker.io/ubuntu:18.04", "docker.io/library/ubuntu:18.04"),
+            ("index.docker.io/lsstsqre/lab:d1", "docker.io/lsstsqre/lab:d1"),
+            ("lsstsqre/lab@sha256:ab", "docker.io/lsstsqre/lab@sha256:ab")]:
+        assert pp._normalize_image(img) == want, img
+
+
+def test_normalize_other_registries():
+    pp = prepuller()
+    for img, want in [
+            ("registry.example:5000/owner/name:tag",
+             "registry.example:5000/owner/name:tag"),
+            ("registry.example:5000/owner/name",
+             "registry.example:5000/owner/name:latest"),
+            ("localhost/name:1", "localhost/name:1"),
+            ("quay.io/owner/name@sha256:ab", "quay.io/owner/name@sha256:ab")]:
+        assert pp._normalize_image(img) == want, img
+
+
+def node_with(pp, *names):
+    node = client.V1Node(status=client.V1NodeStatus(images=[
+        client.V1ContainerImage(names=list(names))]))
+    pp.node_images["node-1"] = pp._images_on_node(node)
+
+
+def test_node_has_image_by_tag():
+    pp = prepuller()
+    node_with(pp, "lsstsqre/lab:d1", "lsstsqre/lab@sha256:aa")
+    assert pp._node_has_image("node-1", "lsstsqre/lab:d1")
+    assert pp._node_has_image("node-1", "docker.io/lsstsqre/lab:d1")
+    assert not pp._node_has_image("node-1", "lsstsqre/lab:d2")
+    assert not pp._node_has_image("node-2", "lsstsqre/lab:d1")
+
+
+def test_node_has_image_by_digest():
+    pp = prepuller({"lsstsqre/lab:d1": "sha256:aa",
+                    "lsstsqre/lab:d2": "sha256:bb"})
+    # The node has d2's tag, but from before the tag moved.
+    node_with(pp, "lsstsqre/lab:d1", "lsstsqre/lab@sha256:aa",
+              "lsstsqre/lab:d2")
+    assert pp._node_has_image("node-1", "lsstsqre/lab:d1")
+    assert not pp._node_has_image("node-1", "lsstsqre/lab:d2")
+
+
+def test_mutable_tag_is_not_trusted():
+    pp = prepuller()
+    node_with(pp, "lsstsqre/lab:latest", "lsstsqre/lab@sha256:aa")
+    assert not pp._node_has_image("node-1", "lsstsqre/lab:latest")
+    assert not pp._node_has_image("node-1", "lsstsqre/lab")
+    # Unless the scan says what it points to.
+    pp.digests["lsstsqre/lab:latest"] = "sha256:aa"
+    assert pp._node_has_image("node-1", "lsstsqre/lab:latest")
+
+
+def test_pull_reference_pins_digest():
+    pp = prepuller({"lsstsqre/lab:d1": "sha256:aa",
+                    "registry.example:5000/owner/name:r1": "sha256:bb",
+                    "registry.example:5000/name": "sha256:cc"})
+    assert pp._pull_reference("lsstsqre/lab:d1") == "lsstsqre/lab@sha256:aa"
+    # The port is not mistaken for a tag.
+    assert (pp._pull_reference("registry.example:5000/owner/name:r1") ==
+            "registry.example:5000/owner/name@sha256:bb")
+    assert (pp._pull_reference("registry.example:5000/name") ==
+            "registry.example:5000/name@sha256:cc")
+    # With no digest known, the tag is all there is.
+    assert pp._pull_reference("lsstsqre/lab:d2") == "lsstsqre/lab:d2"
+
+
+def test_pull_reference_without_pinning():
+    pp = prepuller({"lsstsqre/lab:d1": "sha256:aa"}, pin_digests=False)
+    assert pp._pull_reference("lsstsqre/lab:d1") == "lsstsqre/lab:d1"
+
+
+def test_pull_policy_follows_reference():
+    pp = prepuller({"lsstsqre/lab:d1": "sha256:aa"})
+    pinned = pp._build_container("lsstsqre/lab:d1", "pull")
+    assert pinned.image == "lsstsqre/lab@sha256:aa"
+    assert pinned.image_pull_policy == "IfNotPresent"
+    assert pinned.command == ["true"]
+    by_tag = pp._build_container("lsstsqre/lab:d2", "pull")
+    assert by_tag.image == "lsstsqre/lab:d2"
+    assert by_tag.image_pull_policy == "Always"
+    pp.args.pin_digests = False
+    assert pp._build_container("lsstsqre/lab:d1",
+                               "pull").image_pull_policy == "Always"
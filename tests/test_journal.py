@@ -0,0 +1,111 @@
+import argparse
+import json
+import time
+from kubernetes import client
+from prepuller.journal import FileJournal
+from prepuller.prepuller import Prepuller
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / "journal.json")
+    journal = FileJournal(path)
+    journal.load()
+    journal.record("node-1", "img:d1", "sha256:aa", "Succeeded")
+    journal.record("node-1", "img:d2", None, "Failed")
+    journal.record("node-1", "img:d2", None, "Timeout")
+    journal.save()
+    again = FileJournal(path)
+    again.load()
+    assert again.done("node-1", "img:d1", "sha256:aa")
+    # The same tag at another digest is another pull.
+    assert not again.done("node-1", "img:d1", "sha256:bb")
+    assert not again.done("node-1", "img:d2", None)
+    assert again.failures("node-1", "img:d2", None) == 2
+    with open(path) as f:
+        data = json.load(f)
+    assert set(data["pulls"]) == {"img:d1@sha256:aa", "img:d2"}
+
+
+def test_success_resets_failures(tmp_path):
+    journal = FileJournal(str(tmp_path / "journal.json"))
+    journal.record("n", "img", None, "Failed")
+    journal.record("n", "img", None, "Succeeded")
+    assert journal.failures("n", "img", None) == 0
+
+
+def test_save_merges_other_writers(tmp_path):
+    path = str(tmp_path / "journal.json")
+    first = FileJournal(path)
+    second = FileJournal(path)
+    first.record("node-1", "img", None, "Succeeded")
+    second.record("node-2", "img", None, "Succeeded")
+    first.save()
+    second.save()
+    merged = FileJournal(path)
+    merged.load()
+    assert merged.done("node-1", "img", None)
+    assert merged.done("node-2", "img", None)
+    # The second writer has picked up the first one's entries too.
+    assert second.done("node-1", "img", None)
+
+
+def test_old_entries_are_dropped(tmp_path):
+    path = str(tmp_path / "journal.json")
+    journal = FileJournal(path)
+    journal.record("n", "old", None, "Succeeded")
+    journal.entries[("n", "old", None)][1] = time.time() - 30 * 86400
+    journal.record("n", "new", None, "Succeeded")
+    journal.save()
+    again = FileJournal(path)
+    again.load()
+    assert not again.done("n", "old", None)
+    assert again.done("n", "new", None)
+
+
+def test_unreadable_journal_is_empty(tmp_path):
+    path = tmp_path / "journal.json"
+    path.write_text("not json")
+    journal = FileJournal(str(path))
+    journal.load()
+    assert journal.entries == {}
+
+
+def journaled_prepuller(tmp_path, images):
+    pp = Prepuller.__new__(Prepuller)
+    pp.args = argparse.Namespace(repull=False, journal_max_failures=2)
+    pp.digests = {"img:d1": "sha256:aa"}
+    pp.journal = FileJournal(str(tmp_path / "journal.json"))
+    pp.node_images = {}
+    pp.node_uids = {}
+    pp.full_image_lists = set()
+    node = client.V1Node(
+        metadata=client.V1ObjectMeta(name="node-1", uid="uid-1"),
+        status=client.V1NodeStatus(images=[
+            client.V1ContainerImage(names=["other:%d" % x])
+            for x in range(images)]))
+    pp.node_uids["node-1"] = node.metadata.uid
+    if pp._lists_all_images(node):
+        pp.full_image_lists.add("node-1")
+    return pp
+
+
+def test_journal_keys_nodes_by_uid(tmp_path):
+    pp = journaled_prepuller(tmp_path, 50)
+    pp.journal.record(pp._journal_node("node-1"), "img:d1", "sha256:aa",
+                      "Succeeded")
+    assert pp._journal_skip("node-1", "img:d1") == "done"
+    # The same name, made again.
+    pp.node_uids["node-1"] = "uid-2"
+    assert pp._journal_skip("node-1", "img:d1") is None
+
+
+def test_full_image_list_wins_over_journal(tmp_path):
+    # The kubelet lists every image it has, and this is not one.
+    pp = journaled_prepuller(tmp_path, 3)
+    key = pp._journal_node("node-1")
+    pp.journal.record(key, "img:d1", "sha256:aa", "Succeeded")
+    assert pp._journal_skip("node-1", "img:d1") is None
+    # Failures still count.
+    pp.journal.record(key, "img:d1", "sha256:aa", "Failed")
+    pp.journal.record(key, "img:d1", "sha256:aa", "Failed")
+    assert pp._journal_skip("node-1", "img:d1") == "failing"
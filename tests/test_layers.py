@@ -0,0 +1,35 @@
+from prepuller.layers import LayerPlan
+
+LAYERS = {"big": [("base", 100), ("big-top", 50)],
+          "small": [("base", 100), ("small-top", 5)],
+          "alone": [("other", 30)],
+          "mid": [("base", 100), ("mid-top", 20)]}
+
+
+def test_expected_bytes_counts_shared_layers_once():
+    plan = LayerPlan(LAYERS)
+    assert plan.expected_bytes(["big", "small"]) == 155
+    assert plan.expected_bytes(["big", "small"], present={"base"}) == 55
+    assert plan.expected_bytes(["unknown"]) == 0
+
+
+def test_order_brings_shared_base_first_then_cheapest():
+    plan = LayerPlan(LAYERS)
+    order = plan.order(["alone", "big", "small", "mid"])
+    # "big" shares the most bytes with the others, so it brings the
+    # base down; then the cheapest to finish come next.
+    assert order == ["big", "small", "mid", "alone"]
+
+
+def test_order_uses_present_layers_and_keeps_unknown_last():
+    plan = LayerPlan(LAYERS)
+    order = plan.order(["unknown", "alone", "big"], present={"base"})
+    assert order[-1] == "unknown"
+    assert order[:2] == ["alone", "big"]
+    assert plan.present_layers(["small"]) == {"base", "small-top"}
+
+
+def test_ties_keep_priority_order():
+    plan = LayerPlan({"a": [("x", 10)], "b": [("y", 10)]})
+    assert plan.order(["b", "a"]) == ["b", "a"]
+    assert plan.order(["a", "b"]) == ["a", "b"]
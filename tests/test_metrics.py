@@ -0,0 +1,104 @@
+import asyncio
+import pytest
+from prepuller.metrics import InstrumentedApi, Metrics
+
+
+class FakeError(Exception):
+    status = 404
+
+
+class FakeApi(object):
+    """Answers list and read calls, and fails reads of "missing"."""
+    version = "v1"
+
+    def list_node(self, **kwargs):
+        return ["node-1"]
+
+    def read_namespaced_pod(self, name, namespace):
+        if name == "missing":
+            raise FakeError()
+        return name
+
+    async def list_namespaced_pod(self, namespace, **kwargs):
+        return []
+
+
+def test_render():
+    metrics = Metrics()
+    metrics.inc("prepuller_pulls_total", {"phase": "Succeeded"}, value=2)
+    metrics.observe("prepuller_pull_duration_seconds", 3.0,
+                    {"stage": "total"})
+    lines = metrics.render().splitlines()
+    assert "# TYPE prepuller_pulls_total counter" in lines
+    assert 'prepuller_pulls_total{phase="Succeeded"} 2' in lines
+    assert ("# TYPE prepuller_pull_duration_seconds histogram" in lines)
+    assert ('prepuller_pull_duration_seconds_bucket{stage="total",le="2.5"}'
+            ' 0' in lines)
+    assert ('prepuller_pull_duration_seconds_bucket{stage="total",le="5"}'
+            ' 1' in lines)
+    assert ('prepuller_pull_duration_seconds_bucket{stage="total",'
+            'le="+Inf"} 1' in lines)
+    assert 'prepuller_pull_duration_seconds_sum{stage="total"} 3.0' in lines
+    assert 'prepuller_pull_duration_seconds_count{stage="total"} 1' in lines
+
+
+def test_render_escapes_labels():
+    metrics = Metrics()
+    metrics.inc("prepuller_failures_total", {"kind": 'a\\b"c\nd'})
+    assert ('prepuller_failures_total{kind="a\\\\b\\"c\\nd"} 1' in
+            metrics.render().splitlines())
+
+
+def test_to_dict():
+    metrics = Metrics()
+    metrics.record_pull("node-1", "img:1", "Succeeded", {"total": 4.0},
+                        digest="sha256:abc")
+    data = metrics.to_dict()
+    assert data["pulls"] == [{"node": "node-1", "image": "img:1",
+                              "digest": "sha256:abc", "phase": "Succeeded",
+                              "stages": {"total": 4.0}}]
+    assert {"name": "prepuller_pulls_total",
+            "labels": {"phase": "Succeeded"}, "value": 1} in data["metrics"]
+    assert data["histograms"] == [{"name": "prepuller_pull_duration_seconds",
+                                   "labels": {"stage": "total"},
+                                   "sum": 4.0, "count": 1}]
+
+
+def test_pulls_kept_are_bounded():
+    metrics = Metrics(max_pulls=2)
+    for idx in range(5):
+        metrics.record_pull("node-1", "img:%d" % idx, "Succeeded", {})
+    assert [x["image"] for x in metrics.to_dict()["pulls"]] == ["img:3",
+                                                                "img:4"]
+    assert metrics.values[("prepuller_pulls_total",
+                           (("phase", "Succeeded"),))] == 5
+
+
+def test_instrumented_api_counts_by_verb():
+    metrics = Metrics()
+    api = InstrumentedApi(FakeApi(), metrics)
+    assert api.version == "v1"
+    assert api.list_node() == ["node-1"]
+    api.list_node(watch=True)
+    assert api.read_namespaced_pod("pp-1", "default") == "pp-1"
+    with pytest.raises(FakeError):
+        api.read_namespaced_pod("missing", "default")
+    calls = dict([(dict(k[1])["verb"], v) for k, v in metrics.values.items()
+                  if k[0] == "prepuller_api_calls_total"])
+    assert calls == {"list": 1, "watch": 1, "read": 2}
+    assert metrics.values[("prepuller_api_errors_total",
+                           (("status", "404"), ("verb", "read")))] == 1
+    # Only the calls that returned are timed.
+    timed = dict([(dict(k[1])["verb"], v["count"])
+                  for k, v in metrics.histograms.items()])
+    assert timed == {"list": 1, "watch": 1, "read": 1}
+
+
+def test_instrumented_api_times_awaited_calls():
+    metrics = Metrics()
+    api = InstrumentedApi(FakeApi(), metrics)
+    assert asyncio.run(api.list_namespaced_pod("default")) == []
+    [(key, hist)] = metrics.histograms.items()
+    assert key == ("prepuller_api_call_duration_seconds",
+                   (("verb", "list"),))
+    assert hist["count"] == 1
@@ -0,0 +1,50 @@
+import re
+from prepuller.naming import PodNamer
+
+DNS_LABEL = re.compile(r"^[a-z0-9]([-a-z0-9]*[a-z0-9])?$")
+
+
+def test_names_are_stable_and_valid():
+    img = "registry.example.com:5000/lsstsqre/sciplat-lab:w_2018_22"
+    name = PodNamer().name("node-1", img)
+    assert name == PodNamer().name("node-1", img)
+    assert name.startswith("pp-sciplat-lab-w-2018-22-node-1-")
+    assert DNS_LABEL.match(name)
+
+
+def test_long_names_are_cut_to_63():
+    namer = PodNamer()
+    node = "gke-" + "very-long-node-pool-name-" * 5 + "abcd"
+    img = "lsstsqre/" + "x" * 100 + ":" + "r" * 120
+    name = namer.name(node, img, "sha256:" + "0" * 64)
+    assert len(name) <= 63
+    assert DNS_LABEL.match(name)
+    assert len(namer.container_name(img)) <= 63
+
+
+def test_readable_collisions_differ_by_hash():
+    namer = PodNamer()
+    # Both slug to the same readable part.
+    first = namer.name("node.1", "lsstsqre/lab:d_1")
+    second = namer.name("node-1", "lsstsqre/lab:d.1")
+    assert first != second
+    assert first[:-10] == second[:-10]
+
+
+def test_hash_lengthens_until_free():
+    namer = PodNamer()
+    taken = set()
+    first = namer._hashed("lab", "key", lambda x: False)
+    taken.add(first)
+    longer = namer._hashed("lab", "key", lambda x: x in taken)
+    assert longer.startswith(first) and len(longer) == len(first) + 1
+
+
+def test_new_digest_gets_new_name():
+    namer = PodNamer()
+    old = namer.name("node-1", "lab:latest", "sha256:aa")
+    new = namer.name("node-1", "lab:latest", "sha256:bb")
+    assert old != new
+    assert namer.lookup(old) == ("node-1", "lab:latest", "sha256:aa")
+    assert namer.lookup(new) == ("node-1", "lab:latest", "sha256:bb")
+    assert namer.lookup("pp-unknown") is None
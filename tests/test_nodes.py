@@ -0,0 +1,70 @@
+from kubernetes import client
+from prepuller.prepuller import Prepuller
+
+
+def prepuller(tolerations=()):
+    # Node selection needs no cluster, so skip the setup that does.
+    pp = Prepuller.__new__(Prepuller)
+    pp.tolerations = list(tolerations)
+    return pp
+
+
+def toleration(key=None, operator="Equal", value=None, effect=None):
+    return client.V1Toleration(key=key, operator=operator, value=value,
+                               effect=effect)
+
+
+def taint(key, value=None, effect="NoSchedule"):
+    return client.V1Taint(key=key, value=value, effect=effect)
+
+
+def node(taints=None, unschedulable=False, ready="True", disk="False"):
+    return client.V1Node(
+        metadata=client.V1ObjectMeta(name="node-1"),
+        spec=client.V1NodeSpec(taints=taints, unschedulable=unschedulable),
+        status=client.V1NodeStatus(conditions=[
+            client.V1NodeCondition(type="Ready", status=ready),
+            client.V1NodeCondition(type="DiskPressure", status=disk)]))
+
+
+def test_equal_needs_key_and_value():
+    pp = prepuller([toleration("gpu", value="yes")])
+    assert pp._tolerates(taint("gpu", "yes"))
+    assert not pp._tolerates(taint("gpu", "no"))
+    assert not pp._tolerates(taint("other", "yes"))
+
+
+def test_exists_matches_any_value():
+    pp = prepuller([toleration("gpu", operator="Exists")])
+    assert pp._tolerates(taint("gpu", "anything"))
+    assert pp._tolerates(taint("gpu"))
+    assert not pp._tolerates(taint("other"))
+
+
+def test_exists_without_key_matches_everything():
+    pp = prepuller([toleration(operator="Exists")])
+    assert pp._tolerates(taint("any", "thing", effect="NoExecute"))
+
+
+def test_effect_must_match_if_given():
+    pp = prepuller([toleration("gpu", operator="Exists",
+                               effect="NoExecute")])
+    assert pp._tolerates(taint("gpu", effect="NoExecute"))
+    assert not pp._tolerates(taint("gpu", effect="NoSchedule"))
+
+
+def test_no_tolerations_tolerate_nothing():
+    assert not prepuller()._tolerates(taint("gpu"))
+
+
+def test_unschedulable_reasons():
+    pp = prepuller()
+    assert pp._unschedulable_reason(node()) is None
+    assert pp._unschedulable_reason(node(unschedulable=True)) == "cordoned"
+    assert (pp._unschedulable_reason(node(taints=[taint("gpu", "yes")])) ==
+            "taint gpu:NoSchedule")
+    # PreferNoSchedule does not keep our pods off.
+    assert pp._unschedulable_reason(node(taints=[
+        taint("gpu", effect="PreferNoSchedule")])) is None
+    assert pp._unschedulable_reason(node(ready="Unknown")) == "not Ready"
+    assert pp._unschedulable_reason(node(disk="True")) == "DiskPressure"
@@ -0,0 +1,102 @@
+import argparse
+import logging
+from kubernetes import client
+from prepuller.disk import DiskBudget
+from prepuller.journal import FileJournal
+from prepuller.metrics import Metrics
+from prepuller.naming import PodNamer
+from prepuller.prepuller import Prepuller
+
+GI = 1 << 30
+
+
+def node(name, capacity=None, images=()):
+    return client.V1Node(
+        metadata=client.V1ObjectMeta(name=name, uid=name + "-uid"),
+        status=client.V1NodeStatus(
+            capacity=capacity and {"ephemeral-storage": capacity},
+            images=[client.V1ContainerImage(names=[x], size_bytes=GI)
+                    for x in images]))
+
+
+def prepuller(tmp_path, images, nodes, repull=False, disk_budget=None):
+    # Planning needs the nodes and images, but no cluster.
+    pp = Prepuller.__new__(Prepuller)
+    pp.args = argparse.Namespace(repull=repull, pull_order="name",
+                                 pin_digests=True, journal_max_failures=2,
+                                 disk_budget=disk_budget)
+    pp.logger = logging.getLogger("test")
+    pp.metrics = Metrics()
+    pp.namer = PodNamer()
+    pp.command = ["true"]
+    pp.images = list(images)
+    pp.digests = {"img:d1": "sha256:aa"}
+    pp.scan_entries = {}
+    pp.journal = FileJournal(str(tmp_path / "journal.json"))
+    pp.nodes = [x.metadata.name for x in nodes]
+    pp.node_images = {}
+    pp.node_uids = {}
+    pp.full_image_lists = set()
+    if disk_budget:
+        pp.disk = DiskBudget(disk_budget)
+    for x in nodes:
+        name = x.metadata.name
+        pp.node_images[name] = pp._images_on_node(x)
+        pp.node_uids[name] = x.metadata.uid
+        if pp.disk:
+            pp.disk.add_node(x, pp._normalize_image)
+    return pp
+
+
+def test_images_present_are_skipped(tmp_path):
+    pp = prepuller(tmp_path, ["img:d1", "img:d2"],
+                   [node("node-1", images=["img:d2"]), node("node-2")])
+    pp.build_plan()
+    assert pp.plan == {"node-1": ["img:d1"], "node-2": ["img:d1", "img:d2"]}
+    assert pp.skipped == {"node-1": ["img:d2"], "node-2": []}
+    # Unless asked to pull them again.
+    pp.args.repull = True
+    pp.build_plan()
+    assert pp.plan["node-1"] == ["img:d1", "img:d2"]
+
+
+def test_journaled_and_failing_pulls_are_left_out(tmp_path):
+    pp = prepuller(tmp_path, ["img:d1", "img:d2", "img:d3"],
+                   [node("node-1")])
+    key = pp._journal_node("node-1")
+    pp.journal.record(key, "img:d1", "sha256:aa", "Succeeded")
+    pp.journal.record(key, "img:d2", None, "Failed")
+    pp.journal.record(key, "img:d2", None, "Failed")
+    pp.build_plan()
+    assert pp.plan == {"node-1": ["img:d3"]}
+    assert pp.skipped == {"node-1": ["img:d1"]}
+    assert pp.given_up == {"node-1": ["img:d2"]}
+
+
+def test_over_budget_images_are_left_out(tmp_path):
+    pp = prepuller(tmp_path, ["img:big", "img:small"],
+                   [node("node-1", "100Gi", images=["other:1"])],
+                   disk_budget=0.1)
+    pp.scan_entries = {"img:big": {"full_size": 5 * GI},
+                       "img:small": {"full_size": GI}}
+    pp.build_plan()
+    # 10 GiB allowed, less 1 GiB present: 10 GiB unpacked is too much.
+    assert pp.plan == {"node-1": ["img:small"]}
+    assert pp.over_budget == {"node-1": ["img:big"]}
+    assert pp.metrics.values[("prepuller_pulls_over_budget", ())] == 1
+
+
+def test_pods_are_built_as_needed(tmp_path):
+    pp = prepuller(tmp_path, ["img:d1", "img:d2"],
+                   [node("node-1"), node("node-2")])
+    pp.build_plan()
+    assert pp.templates == {}
+    first = pp._build_pod("node-1", "img:d1")
+    second = pp._build_pod("node-2", "img:d1")
+    assert list(pp.templates) == ["img@sha256:aa"]
+    assert (first.spec.node_name, second.spec.node_name) == ("node-1",
+                                                             "node-2")
+    # The pods share their image's template, not each other's node.
+    assert first.spec.containers is second.spec.containers
+    assert pp.templates["img@sha256:aa"].node_name is None
+    assert first.metadata.name != second.metadata.name
@@ -0,0 +1,109 @@
+import argparse
+import json
+import logging
+import pytest
+from prepuller.metrics import Metrics
+from prepuller.planner import DryRunPlanner, PullHistory, ReadOnlyApi
+from prepuller.priority import PullPriority
+from prepuller.prepuller import Prepuller
+
+
+class FakeApi(object):
+    """Lists nodes, and would create pods if allowed to."""
+
+    def list_node(self, **kwargs):
+        return ["node-1"]
+
+    def create_namespaced_pod(self, namespace, body):
+        raise AssertionError("created a pod in a dry run")
+
+
+def test_read_only_api_refuses_writes():
+    api = ReadOnlyApi(FakeApi())
+    assert api.list_node() == ["node-1"]
+    for name in ["create_namespaced_pod", "delete_namespaced_pod",
+                 "patch_node", "replace_namespaced_config_map"]:
+        with pytest.raises(RuntimeError):
+            getattr(api, name)
+
+
+def test_history_estimates(tmp_path):
+    path = tmp_path / "metrics.json"
+    path.write_text(json.dumps({"pulls": [
+        {"image": "lab:d1", "phase": "Succeeded", "stages": {"total": 10}},
+        {"image": "lab:d1", "phase": "Succeeded", "stages": {"total": 30}},
+        {"image": "lab:d1", "phase": "Failed", "stages": {"total": 99}},
+        {"image": "other:1", "phase": "Succeeded", "stages": {"total": 2}}
+    ]}))
+    history = PullHistory([str(path), str(tmp_path / "missing.json")])
+    assert history.estimate("lab:d1") == (20, "image")
+    assert history.estimate("lab:d2") == (20, "repository")
+    assert history.estimate("new:1") == (10, "all")
+    assert PullHistory().estimate("new:1") == (60.0, "default")
+
+
+def planner(node_concurrency=1, max_in_flight=10, plan=None):
+    pp = Prepuller.__new__(Prepuller)
+    pp.args = argparse.Namespace(
+        node_concurrency=node_concurrency, max_in_flight=max_in_flight,
+        timeout=-1, api_write_qps=1, node_page_size=2, dailies=1,
+        weeklies=0, releases=0, pull_order="name", disk_budget=None,
+        repull=False, pin_digests=True)
+    pp.logger = logging.getLogger("test")
+    pp.metrics = Metrics()
+    pp.priority = PullPriority()
+    pp.plan = dict(plan or {})
+    pp.nodes = sorted(pp.plan)
+    pp.images = sorted(set([x for y in pp.plan.values() for x in y]))
+    pp.excluded = {"node-x": "unschedulable"}
+    pp.digests = {"lab:d1": "sha256:aa"}
+    pp.scan_entries = {"lab:d1": {"full_size": 100}}
+    pp.skipped = {}
+    pp.over_budget = {}
+    pp.given_up = {}
+    pp.expected_bytes = {}
+    return DryRunPlanner(pp)
+
+
+def test_simulate_shares_workers():
+    durations = {"node-1": [10, 10], "node-2": [5]}
+    assert planner()._simulate(durations) == (20, 0)
+    # One worker takes the pulls in turn.
+    assert planner(max_in_flight=1)._simulate(durations) == (25, 0)
+    assert planner(node_concurrency=2)._simulate(durations) == (10, 0)
+    assert planner()._simulate({"node-1": []}) == (0.0, 0)
+
+
+def test_simulate_defers_pulls_past_budget():
+    dry = planner()
+    # After the first pull, another would end at 20 seconds.
+    assert dry._simulate({"node-1": [10, 10, 10]}, budget=15) == (10, 2)
+    assert dry._simulate({"node-1": [10, 10, 10]}, budget=30) == (30, 0)
+
+
+def test_report_totals():
+    dry = planner(plan={"node-1": ["lab:d1", "lab:d2"],
+                        "node-2": ["lab:d1"]})
+    report = dry.report()
+    assert [x["reference"] for x in report["images"]] == [
+        "lab@sha256:aa", "lab:d2"]
+    assert report["nodes"]["node-1"]["bytes"] == 100
+    totals = report["totals"]
+    assert totals["pods"] == 3
+    # A create and a delete for each pod, and a cleanup per phase.
+    assert totals["api_writes"] == 8
+    # Two pages of nodes, the watch, and a read of each pod.
+    assert totals["api_reads"] == 6
+    assert totals["api_floor_seconds"] == 8
+    # Each pull takes the default 60 seconds, one at a time per node.
+    assert totals["wall_seconds"] == 120
+    assert report["estimates"]["basis"] == {"default": 3}
+
+
+def test_report_leaves_deferred_pulls_out():
+    dry = planner(plan={"node-1": ["lab:d1", "lab:d2", "lab:d3"]})
+    totals = dry.report(budget=90)["totals"]
+    assert totals["deferred"] == 2
+    assert totals["pods"] == 1
+    assert totals["api_writes"] == 4
+    assert totals["api_reads"] == 3
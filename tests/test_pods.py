@@ -0,0 +1,173 @@
+import argparse
+import datetime
+import logging
+import threading
+import pytest
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+from prepuller.metrics import Metrics
+from prepuller.naming import PodNamer
+from prepuller.podwatcher import PodWatcher
+from prepuller.prepuller import Prepuller
+
+
+class FakeClient(object):
+    """Holds pods by name, and refuses to create one that exists."""
+
+    def __init__(self, pods=()):
+        self.pods = dict([(x.metadata.name, x) for x in pods])
+        self.created = []
+        self.deleted = []
+
+    def create_namespaced_pod(self, namespace, body):
+        if body.metadata.name in self.pods:
+            raise ApiException(status=409)
+        self.pods[body.metadata.name] = body
+        self.created.append(body.metadata.name)
+        return body
+
+    def read_namespaced_pod(self, name, namespace):
+        if name not in self.pods:
+            raise ApiException(status=404)
+        return self.pods[name]
+
+    def delete_namespaced_pod(self, name, namespace, body):
+        if name not in self.pods:
+            raise ApiException(status=404)
+        del self.pods[name]
+        self.deleted.append((name, body.grace_period_seconds))
+
+
+def pod(image, phase="Running", uid="old", age=0):
+    created = (datetime.datetime.now(datetime.timezone.utc) -
+               datetime.timedelta(seconds=age))
+    return client.V1Pod(
+        metadata=client.V1ObjectMeta(name="pp-x", uid=uid,
+                                     creation_timestamp=created),
+        spec=client.V1PodSpec(containers=[
+            client.V1Container(name="prepull", image=image)]),
+        status=client.V1PodStatus(phase=phase))
+
+
+def prepuller(existing=()):
+    # Starting pods needs no cluster setup beyond the client.
+    pp = Prepuller.__new__(Prepuller)
+    pp.client = FakeClient(existing)
+    pp.namespace = "default"
+    pp.logger = logging.getLogger("test")
+    pp.metrics = Metrics()
+    pp.namer = PodNamer()
+    pp.watcher = PodWatcher(pp.client, "default")
+    pp._watcher_lock = threading.Lock()
+    pp._build_pod = lambda node, img: pod(img, phase=None, uid=None)
+    return pp
+
+
+def test_existing_pod_for_same_image_is_adopted():
+    pp = prepuller([pod("img@sha256:1")])
+    assert pp.start_single_pod("node-1", "img@sha256:1") == "pp-x"
+    assert pp.client.created == []
+    assert pp.client.deleted == []
+
+
+def test_existing_pod_for_other_image_is_replaced():
+    pp = prepuller([pod("img@sha256:old")])
+    pp.watcher.phases["pp-x"] = "Running"
+    assert pp.start_single_pod("node-1", "img@sha256:new") == "pp-x"
+    assert pp.client.deleted == [("pp-x", 0)]
+    assert pp.client.pods["pp-x"].spec.containers[0].image == (
+        "img@sha256:new")
+    # News of the old pod no longer counts.
+    assert "pp-x" not in pp.watcher.phases
+    pp.watcher.waiters.add("pp-x")
+    pp.watcher._update("pp-x", None, deleted=True, pod=pod("img:1"))
+    assert "pp-x" not in pp.watcher.phases
+
+
+def test_failed_and_stuck_pods_are_replaced():
+    for stale in [pod("img:1", phase="Failed"),
+                  pod("img:1", phase="Pending", age=3600)]:
+        pp = prepuller([stale])
+        pp.start_single_pod("node-1", "img:1")
+        assert pp.client.created == ["pp-x"]
+
+
+def test_recent_pending_pod_is_waited_on():
+    pp = prepuller([pod("img:1", phase="Pending", age=10)])
+    pp.start_single_pod("node-1", "img:1")
+    assert pp.client.created == []
+
+
+def test_timed_out_pod_is_deleted():
+    pp = prepuller([pod("img:1", phase="Pending")])
+    pp.journal = None
+    with pytest.raises(RuntimeError):
+        pp.wait_for_pod("pp-x", delay=0.05, max_tries=1)
+    assert pp.client.deleted == [("pp-x", 0)]
+
+
+class CleanupClient(FakeClient):
+    """Deletes pods by phase in bulk, unless forbidden to, and lists
+    them two at a time."""
+
+    def __init__(self, pods=(), bulk=True):
+        super(CleanupClient, self).__init__(pods)
+        self.bulk = bulk
+        self.collections = []
+        self.lists = []
+
+    def delete_collection_namespaced_pod(self, namespace, label_selector,
+                                         field_selector):
+        if not self.bulk:
+            raise ApiException(status=403)
+        self.collections.append((label_selector, field_selector))
+        phase = field_selector.split("=")[1]
+        for name in [x for x in self.pods
+                     if self.pods[x].status.phase == phase]:
+            del self.pods[name]
+
+    def list_namespaced_pod(self, namespace, label_selector, limit,
+                            _continue=None):
+        self.lists.append(label_selector)
+        names = sorted(self.pods)
+        start = int(_continue or 0)
+        more = None
+        if start + 2 < len(names):
+            more = str(start + 2)
+        return client.V1PodList(
+            items=[self.pods[x] for x in names[start:start + 2]],
+            metadata=client.V1ListMeta(_continue=more))
+
+
+def cleanup_prepuller(bulk=True):
+    pods = []
+    for name, phase in [("pp-a", "Succeeded"), ("pp-b", "Running"),
+                        ("pp-c", "Failed"), ("pp-d", "Succeeded"),
+                        ("pp-e", "Pending")]:
+        pods.append(pod("img:1", phase=phase))
+        pods[-1].metadata.name = name
+    pp = prepuller()
+    pp.client = CleanupClient(pods, bulk=bulk)
+    pp.args = argparse.Namespace(max_in_flight=4)
+    return pp
+
+
+def test_completed_pods_are_deleted_by_phase():
+    pp = cleanup_prepuller()
+    pp.clean_completed_pods()
+    assert pp.client.collections == [
+        ("app=prepuller", "status.phase=Succeeded"),
+        ("app=prepuller", "status.phase=Failed")]
+    assert sorted(pp.client.pods) == ["pp-b", "pp-e"]
+    assert pp.client.lists == []
+
+
+def test_cleanup_without_bulk_delete_deletes_each_pod():
+    pp = cleanup_prepuller(bulk=False)
+    pp.clean_completed_pods()
+    assert pp.client.collections == []
+    # Every page was read.
+    assert pp.client.lists == ["app=prepuller"] * 3
+    assert sorted([x[0] for x in pp.client.deleted]) == ["pp-a", "pp-c",
+                                                         "pp-d"]
+    assert sorted(pp.client.pods) == ["pp-b", "pp-e"]
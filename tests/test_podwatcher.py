@@ -0,0 +1,83 @@
+from types import SimpleNamespace
+from kubernetes.client.rest import ApiException
+from prepuller.podwatcher import PodWatcher
+
+
+class FakeClient(object):
+    """Answers reads of single pods from a dict of name to phase."""
+
+    def __init__(self, phases):
+        self.phases = phases
+
+    def list_namespaced_pod(self, namespace, **kwargs):
+        # A snapshot taken before any of the pods were created.
+        return SimpleNamespace(items=[], metadata=SimpleNamespace(
+            _continue=None, resource_version="7"))
+
+    def read_namespaced_pod(self, name, namespace):
+        if name not in self.phases:
+            raise ApiException(status=404)
+        return SimpleNamespace(status=SimpleNamespace(
+            phase=self.phases[name]))
+
+
+def test_pod_deleted_before_wait():
+    watcher = PodWatcher(FakeClient({}), "default")
+    # The watch saw the deletion before anyone waited on the pod.
+    watcher._update("pp-gone", None, deleted=True)
+    assert watcher.wait("pp-gone", timeout=1) == "Deleted"
+
+
+def test_pod_finished_before_wait():
+    watcher = PodWatcher(FakeClient({"pp-done": "Succeeded"}), "default")
+    assert watcher.wait("pp-done", timeout=1) == "Succeeded"
+
+
+def test_watch_news_wins_over_read():
+    watcher = PodWatcher(FakeClient({"pp-x": "Pending"}), "default")
+    watcher._update("pp-x", "Failed")
+    assert watcher.wait("pp-x", timeout=1) == "Failed"
+
+
+def test_wait_times_out():
+    watcher = PodWatcher(FakeClient({"pp-slow": "Pending"}), "default")
+    assert watcher.wait("pp-slow", timeout=0.1) is None
+    assert not watcher.waiters
+
+
+def test_stop_joins_thread():
+    watcher = PodWatcher(FakeClient({}), "default")
+    watcher.stop_timeout = 1
+    watcher._run = lambda generation: None
+    watcher.start()
+    thread = watcher._thread
+    watcher.stop()
+    assert not thread.is_alive()
+    assert watcher._thread is None
+
+
+def test_other_pods_are_not_kept():
+    watcher = PodWatcher(FakeClient({}), "default",
+                         ours=lambda x: x.startswith("pp-mine"))
+    watcher._update("pp-theirs", "Succeeded")
+    watcher._update("pp-mine", "Succeeded")
+    assert list(watcher.phases) == ["pp-mine"]
+
+
+def test_adopted_pod_is_seen():
+    # Another replica created the pod, so it carries that replica's
+    # label; the watch is on the app label alone, and we wait on it.
+    watcher = PodWatcher(FakeClient({"pp-adopted": "Pending"}), "default",
+                         ours=lambda x: False)
+    watcher.waiters.add("pp-adopted")
+    watcher._update("pp-adopted", "Succeeded")
+    assert watcher.wait("pp-adopted", timeout=1) == "Succeeded"
+
+
+def test_relist_rereads_missing_waiters():
+    watcher = PodWatcher(FakeClient({"pp-new": "Pending"}), "default")
+    watcher.waiters.update(["pp-new", "pp-gone"])
+    watcher._relist()
+    # Created after the list was taken, so not in it, but not gone.
+    assert watcher.phases == {"pp-new": "Pending", "pp-gone": "Deleted"}
+    assert watcher.resource_version == "7"
@@ -0,0 +1,81 @@
+import threading
+from prepuller.ratelimit import RateLimitedApi, TokenBucket
+
+
+class TooManyRequests(Exception):
+    status = 429
+    headers = None
+
+
+class BusyApi(object):
+    """Answers the first call from each of `callers` threads with a 429,
+    once they have all been issued, and succeeds after that.
+    """
+
+    def __init__(self, callers):
+        self.barrier = threading.Barrier(callers)
+        self.refused = set()
+        self._lock = threading.Lock()
+
+    def read_namespaced_pod(self, name, namespace):
+        with self._lock:
+            first = name not in self.refused
+            self.refused.add(name)
+        if first:
+            self.barrier.wait()
+            raise TooManyRequests()
+        return name
+
+
+def test_concurrent_429s_halve_rate_once():
+    bucket = TokenBucket(100)
+    api = RateLimitedApi(BusyApi(8), limits={"read": bucket})
+    api.base_delay = 0.001
+    results = []
+    threads = [threading.Thread(target=lambda x=x: results.append(
+        api.read_namespaced_pod("pod-%d" % x, "default")))
+        for x in range(8)]
+    for thd in threads:
+        thd.start()
+    for thd in threads:
+        thd.join()
+    assert len(results) == 8
+    # Halved once, then recovering; eight halvings would be under 1.
+    assert 50 <= bucket.rate < 60
+
+
+def test_429_after_cut_counts_again():
+    bucket = TokenBucket(100)
+    bucket.slow_down()
+    decreased = bucket.decreased
+    assert bucket.slow_down(issued=decreased - 1) == 50
+    assert bucket.slow_down(issued=decreased + 1) == 25
+    assert bucket.slow_down() == 12.5
+
+
+def test_rate_floor():
+    bucket = TokenBucket(4, min_rate=1)
+    for _ in range(5):
+        bucket.slow_down()
+    assert bucket.rate == 1
+
+
+def test_recovery_is_by_time_not_calls():
+    bucket = TokenBucket(100)
+    bucket.slow_down()
+    for _ in range(100):
+        bucket.speed_up()
+    # A hundred quick successes win back next to nothing.
+    assert bucket.rate < 60
+    # Ten seconds at 5% a second wins back half the configured rate.
+    bucket.adjusted -= 10
+    assert 99 <= bucket.speed_up() <= 100
+    bucket.adjusted -= 100
+    assert bucket.speed_up() == 100
+
+
+def test_reserve_waits_when_empty():
+    bucket = TokenBucket(10, burst=2)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert 0.05 < bucket.reserve() <= 0.1
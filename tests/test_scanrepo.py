@@ -0,0 +1,315 @@
+import datetime
+import json
+import os
+import random
+import time
+from operator import itemgetter
+from types import SimpleNamespace
+from prepuller.scanrepo import ScanRepo, TagCache, describe_cache
+from prepuller.scanrepo.scanrepo import TagHeaps
+
+
+class FakeCache(object):
+    """Has validators for every page, but has lost the bodies."""
+
+    def __init__(self):
+        self.pages = {}
+
+    def validators(self, key):
+        return {"If-None-Match": '"stale"'}
+
+    def get_page(self, key):
+        return None
+
+    def put_page(self, key, body, etag=None, last_modified=None):
+        self.pages[key] = body
+
+
+class FakeSession(object):
+    """Answers requests from a list of responses, and records them."""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.sent = []
+
+    def request(self, method, url, **kwargs):
+        self.sent.append((method, url, kwargs))
+        return self.responses.pop(0)
+
+    def get(self, url, **kwargs):
+        return self.request("get", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("post", url, **kwargs)
+
+
+def response(status, body=None, headers=None, links=None, url=None):
+    def raise_for_status():
+        if status >= 400:
+            raise ValueError("HTTP %d" % status)
+    return SimpleNamespace(status_code=status, headers=headers or {},
+                           links=links or {}, url=url,
+                           content=json.dumps(body or {}).encode(),
+                           json=lambda: body,
+                           raise_for_status=raise_for_status)
+
+
+def test_304_without_cached_body_refetches():
+    repo = ScanRepo(owner="lsstsqre", name="sciplat-lab")
+    repo.cache = FakeCache()
+    sent = []
+    page = {"results": [{"name": "d2018_06_01"}], "next": None}
+
+    def get_url(headers=None, **kwargs):
+        sent.append(headers)
+        if headers:
+            return response(304)
+        return response(200, page)
+    repo._get_url = get_url
+    assert repo._get_page(1) == page
+    assert sent == [{"If-None-Match": '"stale"'}, None]
+    assert list(repo.cache.pages.values()) == [page]
+
+
+def test_describe_cache_only_reads(tmp_path):
+    cache = TagCache(str(tmp_path), "https://hub.example/v2/x/tags/")
+    cache.put_results([{"name": "r170"}])
+    cache.save()
+    before = sorted(os.listdir(str(tmp_path)))
+    missing = os.path.join(str(tmp_path), "missing")
+    assert describe_cache(missing) == []
+    assert not os.path.exists(missing)
+    [summary] = describe_cache(str(tmp_path))
+    assert summary["tags"] == 1
+    assert summary["url"] == "https://hub.example/v2/x/tags/"
+    assert sorted(os.listdir(str(tmp_path))) == before
+
+
+def test_unknown_api_is_refused():
+    try:
+        ScanRepo(owner="lsstsqre", name="sciplat-lab", api="quay")
+    except ValueError as e:
+        assert "quay" in str(e)
+    else:
+        assert False, "no error"
+
+
+def test_hub_logs_in_for_a_jwt():
+    repo = ScanRepo(owner="lsstsqre", name="sciplat-lab",
+                    credentials=("user", "secret"))
+    repo._session = FakeSession([response(200, {"token": "jwt"}),
+                                 response(200, {}), response(200, {})])
+    repo._get_url(page=1)
+    repo._get_url(page=2)
+    login, first, second = repo._session.sent
+    assert login[:2] == ("post", "https://hub.docker.com/v2/users/login/")
+    assert login[2]["json"] == {"username": "user", "password": "secret"}
+    for sent in (first, second):
+        assert sent[2]["headers"] == {"Authorization": "JWT jwt"}
+        assert "auth" not in sent[2]
+
+
+def test_registry_api_lists_tags_by_link():
+    repo = ScanRepo(host="registry.example", owner="lsstsqre",
+                    name="sciplat-lab", api="registry", page_size=2,
+                    dailies=2, weeklies=1, releases=1)
+    assert repo.url == ("https://registry.example/v2/lsstsqre/sciplat-lab" +
+                        "/tags/list")
+    assert repo.sort_field == "name"
+    assert not repo.can_scan_incremental()
+    challenge = ('Bearer realm="https://auth.example/token",' +
+                 'service="registry.example"')
+    nxt = "/v2/lsstsqre/sciplat-lab/tags/list?n=2&last=d20180601"
+    repo._session = FakeSession([
+        response(401, headers={"WWW-Authenticate": challenge}),
+        response(200, {"token": "bearer"}),
+        response(200, {"tags": ["d20180530", "d20180601"]},
+                 links={"next": {"url": nxt}}, url=repo.url + "?n=2"),
+        response(200, {"tags": ["exp", "r170", "w201822"]}, url=nxt)])
+    repo.scan()
+    sent = repo._session.sent
+    assert sent[1][1] == "https://auth.example/token"
+    assert sent[2][2]["headers"] == {"Authorization": "Bearer bearer"}
+    assert sent[3][1] == "https://registry.example" + nxt
+    assert sent[3][2]["params"] is None
+    assert [x["name"] for x in repo.data["daily"]] == ["d20180601",
+                                                        "d20180530"]
+    assert [x["name"] for x in repo.data["weekly"]] == ["w201822"]
+    assert [x["name"] for x in repo.data["release"]] == ["r170"]
+
+
+def test_registry_api_digest_from_manifest():
+    repo = ScanRepo(host="registry.example", owner="lsstsqre",
+                    name="sciplat-lab", api="registry")
+    repo._session = FakeSession([
+        response(200, headers={"Docker-Content-Digest": "sha256:abc"})])
+    entry = {"name": "r170"}
+    assert repo.get_digest(entry) == "sha256:abc"
+    assert repo.get_digest(entry) == "sha256:abc"
+    [(method, url, kwargs)] = repo._session.sent
+    assert method == "head"
+    assert url.endswith("/v2/lsstsqre/sciplat-lab/manifests/r170")
+
+
+def test_registry_api_basic_challenge_uses_credentials():
+    repo = ScanRepo(host="registry.example", owner="lsstsqre",
+                    name="sciplat-lab", api="registry",
+                    credentials=("user", "secret"))
+    repo._session = FakeSession([
+        response(401, headers={"WWW-Authenticate": 'Basic realm="r"'}),
+        response(200, {"tags": []})])
+    repo.scan_registry()
+    first, second = repo._session.sent
+    assert first[2]["auth"] is None
+    assert second[2]["auth"] == ("user", "secret")
+
+
+def history(count, seed=0):
+    """Tags of every class, and some of none, with times in a mix of
+    forms and with ties, in no particular order."""
+    rnd = random.Random(seed)
+    forms = ["%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%S.%f+02:00",
+             "%Y-%m-%dT%H:%M:%SZ", "%Y-%m-%dT%H:%M:%S"]
+    start = datetime.datetime(2018, 1, 1)
+    results = []
+    for idx in range(count):
+        when = start + datetime.timedelta(minutes=rnd.randrange(count // 3))
+        form = rnd.choice(forms)
+        if "+02:00" in form:
+            when += datetime.timedelta(hours=2)
+        results.append({"name": rnd.choice("dwrx") + "%06d" % idx,
+                        "last_updated": when.strftime(form)})
+    return results
+
+
+def baseline_time(ts):
+    when = datetime.datetime.fromisoformat(ts.replace("Z", "+00:00"))
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    return when
+
+
+def baseline(results, sort_field, dailies, weeklies, releases):
+    """Reduce results as the scanner always used to: a full stable sort
+    of each class, newest first, cut to the number kept."""
+    def key(x):
+        if sort_field == "comp_ts":
+            return baseline_time(x["last_updated"])
+        return x[sort_field]
+    r = {}
+    for prefix, section, count in [("d", "daily", dailies),
+                                   ("w", "weekly", weeklies),
+                                   ("r", "release", releases)]:
+        r[section] = sorted([x for x in results if x["name"][0] == prefix],
+                            key=key, reverse=True)[:count]
+    return r
+
+
+def names(data):
+    return dict([(x, [y["name"] for y in data[x]]) for x in data])
+
+
+def test_reduce_matches_full_sort():
+    results = history(3000)
+    for sort_field in ["comp_ts", "name"]:
+        for kept in [(0, 0, 0), (1, 1, 1), (15, 4, 1), (3000, 3000, 3000)]:
+            repo = ScanRepo(sort_field=sort_field, dailies=kept[0],
+                            weeklies=kept[1], releases=kept[2])
+            repo._reduce_results(results)
+            assert names(repo.data) == names(
+                baseline(results, sort_field, *kept))
+
+
+def test_incremental_scan_matches_full_sort():
+    results = sorted(history(3000, seed=1),
+                     key=lambda x: baseline_time(x["last_updated"]),
+                     reverse=True)
+    for kept in [(1, 1, 1), (15, 4, 1), (400, 400, 400)]:
+        repo = ScanRepo(dailies=kept[0], weeklies=kept[1],
+                        releases=kept[2], incremental=True)
+        fetched = []
+
+        def get_page(page, ordering=None):
+            fetched.append(page)
+            start = (page - 1) * 100
+            return {"results": results[start:start + 100],
+                    "next": start + 100 < len(results)}
+        repo._get_page = get_page
+        repo.scan()
+        assert names(repo.data) == names(
+            baseline(results, "comp_ts", *kept))
+        if kept == (1, 1, 1):
+            assert len(fetched) < 30
+
+
+def test_tag_heaps_settle_only_when_full():
+    limits = {"d": ("daily", 2), "w": ("weekly", 1), "r": ("release", 0)}
+    heaps = TagHeaps(limits, itemgetter("t"))
+    assert not heaps.settled(heaps.add([{"name": "d1", "t": 9},
+                                        {"name": "x1", "t": 8}]))
+    assert not heaps.settled(heaps.add([{"name": "w1", "t": 7}]))
+    # Once full, a later tag with the same time as the oldest kept one
+    # loses to it, as in a stable sort.
+    assert heaps.settled(heaps.add([{"name": "d2", "t": 6}]))
+    heaps.add([{"name": "d3", "t": 6}])
+    assert names(heaps.result()) == {"daily": ["d1", "d2"],
+                                     "weekly": ["w1"], "release": []}
+
+
+def test_cache_drops_old_pages_and_layers(tmp_path):
+    cache = TagCache(str(tmp_path), "https://hub.example/v2/x/tags/")
+    cache.put_page("page=1", {"results": []}, etag='"1"')
+    cache.put_page("page=2", {"results": []}, etag='"2"')
+    cache.put_layers("sha256:old", [("sha256:l1", 10)])
+    cache.put_layers("sha256:new", [("sha256:l2", 20)])
+    old = time.time() - cache.max_age - 1
+    cache.entry["pages"]["page=2"]["fetched"] = old
+    cache.entry["layers"]["sha256:old"]["used"] = old
+    # Layer lists from before they carried a time.
+    cache.entry["layers"]["sha256:bare"] = [["sha256:l3", 30]]
+    cache.save()
+    again = TagCache(str(tmp_path), "https://hub.example/v2/x/tags/")
+    assert list(again.entry["pages"]) == ["page=1"]
+    assert list(again.entry["layers"]) == ["sha256:new"]
+    assert again.get_layers("sha256:new") == [("sha256:l2", 20)]
+    assert again.get_layers("sha256:bare") is None
+
+
+def test_revalidated_page_is_kept(tmp_path):
+    cache = TagCache(str(tmp_path), "https://hub.example/v2/x/tags/")
+    cache.put_page("page=1", {"results": []}, etag='"1"')
+    cache.entry["pages"]["page=1"]["fetched"] = 0
+    assert cache.get_page("page=1") == {"results": []}
+    cache.save()
+    again = TagCache(str(tmp_path), "https://hub.example/v2/x/tags/")
+    assert list(again.entry["pages"]) == ["page=1"]
+
+
+def test_incremental_scan_is_cached(tmp_path):
+    results = sorted(history(500, seed=2),
+                     key=lambda x: baseline_time(x["last_updated"]),
+                     reverse=True)
+
+    def scanned(**kwargs):
+        repo = ScanRepo(cache_dir=str(tmp_path), cache_ttl=600,
+                        incremental=True, **kwargs)
+        fetched = []
+
+        def get_page(page, ordering=None):
+            fetched.append(page)
+            start = (page - 1) * 100
+            return {"results": results[start:start + 100],
+                    "next": start + 100 < len(results)}
+        repo._get_page = get_page
+        repo.scan()
+        return names(repo.data), fetched
+
+    first, fetched = scanned(dailies=3)
+    assert fetched
+    again, fetched = scanned(dailies=3)
+    assert again == first
+    assert fetched == []
+    # Keeping more tags needs tags the first scan did not keep.
+    more, fetched = scanned(dailies=30)
+    assert fetched
+    assert more == names(baseline(results, "comp_ts", 30, 2, 1))
@@ -0,0 +1,71 @@
+import threading
+import time
+from prepuller.scheduler import PullScheduler
+
+
+def test_runs_all_work_within_limits():
+    lock = threading.Lock()
+    running = {}
+    peak = {}
+    done = []
+
+    def pull(node, item):
+        with lock:
+            running[node] = running.get(node, 0) + 1
+            peak[node] = max(peak.get(node, 0), running[node])
+        time.sleep(0.01)
+        with lock:
+            running[node] -= 1
+            done.append((node, item))
+
+    work = {"a": [1, 2, 3, 4], "b": [1, 2], "c": []}
+    failures = PullScheduler(pull, per_node=2).run(work)
+    assert failures == []
+    assert sorted(done) == sorted([(x, y) for x in work for y in work[x]])
+    assert max(peak.values()) == 2
+
+
+def test_failure_does_not_stop_node():
+    def pull(node, item):
+        if item == 2:
+            raise ValueError("bad pull")
+
+    scheduler = PullScheduler(pull)
+    failures = scheduler.run({"a": [1, 2, 3]})
+    assert [(x[0], x[1]) for x in failures] == [("a", 2)]
+
+
+def test_deadline_defers_remaining_pulls():
+    done = []
+
+    def pull(node, item):
+        time.sleep(0.2)
+        done.append((node, item))
+
+    # The first pull takes 0.2 s, so with 0.3 s left no second pull
+    # can be expected to finish.
+    scheduler = PullScheduler(pull, deadline=time.time() + 0.3)
+    scheduler.run({"a": ["first", "second", "third"]})
+    assert done == [("a", "first")]
+    assert scheduler.deferred == [("a", "second"), ("a", "third")]
+
+
+def test_no_deadline_defers_nothing():
+    scheduler = PullScheduler(lambda node, item: None)
+    scheduler.run({"a": [1, 2, 3]})
+    assert scheduler.deferred == []
+
+
+def test_take_forgets_failures():
+    def pull(node, item):
+        raise ValueError("bad pull")
+
+    scheduler = PullScheduler(pull)
+    scheduler.start()
+    scheduler.submit("a", [1, 2])
+    scheduler.wait()
+    failures, deferred = scheduler.take()
+    assert sorted([x[1] for x in failures]) == [1, 2]
+    assert deferred == []
+    assert scheduler.take() == ([], [])
+    scheduler.stop()
@@ -0,0 +1,104 @@
+import copy
+import threading
+from types import SimpleNamespace
+from kubernetes.client.rest import ApiException
+from prepuller.shard import ShardCoordinator
+
+
+def node(name, labels=None):
+    return SimpleNamespace(metadata=SimpleNamespace(name=name,
+                                                    labels=labels))
+
+
+def coordinator(members, identity="a", **kwargs):
+    shard = ShardCoordinator(None, "default", identity, **kwargs)
+    shard._members = list(members)
+    return shard
+
+
+def test_owner_is_stable_and_spread():
+    nodes = [node("node-%03d" % x) for x in range(300)]
+    shard = coordinator(["a", "b", "c"])
+    owners = [shard.owner(x) for x in nodes]
+    assert owners == [coordinator(["c", "a", "b"]).owner(x)
+                      for x in nodes]
+    for member in ["a", "b", "c"]:
+        assert 50 < owners.count(member) < 150
+
+
+def test_leaving_moves_only_the_leavers_nodes():
+    nodes = [node("node-%03d" % x) for x in range(300)]
+    before = coordinator(["a", "b", "c"])
+    after = coordinator(["a", "b"])
+    for x in nodes:
+        if before.owner(x) != "c":
+            assert after.owner(x) == before.owner(x)
+        else:
+            assert after.owner(x) in ["a", "b"]
+
+
+def test_label_mode_keeps_pool_together():
+    shard = coordinator(["a", "b", "c", "d"], mode="label", label="pool")
+    pool = [node("node-%d" % x, {"pool": "gpu"}) for x in range(20)]
+    assert len(set([shard.owner(x) for x in pool])) == 1
+    # A node without the label goes by its name.
+    assert shard.shard_key(node("lone")) == "node:lone"
+
+
+def test_identity_is_made_label_safe():
+    shard = coordinator(["x"], identity="pod/name:1")
+    assert shard.identity == "pod-name-1"
+
+
+class FakeConfigMaps(object):
+    """Keeps one ConfigMap, refuses writes to a stale version of it, and
+    holds the renewal thread's reads while the gate is shut."""
+
+    def __init__(self):
+        self.cm = None
+        self.version = 0
+        self.gate = threading.Event()
+        self.gate.set()
+        self.reading = threading.Event()
+
+    def read_namespaced_config_map(self, name, namespace):
+        if threading.current_thread().name == "shard-coordinator":
+            self.reading.set()
+            self.gate.wait()
+        if self.cm is None:
+            raise ApiException(status=404)
+        return copy.deepcopy(self.cm)
+
+    def _write(self, body):
+        self.version += 1
+        body.metadata.resource_version = str(self.version)
+        self.cm = body
+
+    def create_namespaced_config_map(self, namespace, body):
+        self._write(body)
+
+    def replace_namespaced_config_map(self, name, namespace, body):
+        if body.metadata.resource_version != str(self.version):
+            raise ApiException(status=409)
+        self._write(body)
+
+
+def test_leave_waits_for_renewal():
+    api = FakeConfigMaps()
+    shard = ShardCoordinator(api, "default", "a", member_ttl=0.3)
+    shard.join()
+    assert api.cm.data.keys() == {"a"}
+    renewer = shard._thread
+    # Catch the renewal thread between reading and writing.
+    api.gate.clear()
+    api.reading.clear()
+    assert api.reading.wait(5)
+    leaver = threading.Thread(target=shard.leave)
+    leaver.start()
+    leaver.join(0.2)
+    assert leaver.is_alive()
+    api.gate.set()
+    leaver.join(5)
+    assert not leaver.is_alive()
+    assert not renewer.is_alive()
+    assert api.cm.data == {}
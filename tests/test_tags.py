@@ -0,0 +1,36 @@
+import datetime
+from prepuller.scanrepo.tags import Tag, parse_time, time_key
+
+
+def test_parse_time_forms():
+    want = datetime.datetime(2018, 6, 1, 12, 30, 15, 120000)
+    for ts in ["2018-06-01T12:30:15.12Z", "2018-06-01T12:30:15.120000Z",
+               "2018-06-01T12:30:15.120000123Z", "2018-06-01 12:30:15.12",
+               "2018-06-01T14:30:15.12+02:00", "2018-06-01T10:00:15.12-0230"]:
+        assert parse_time(ts) == want, ts
+
+
+def test_parse_time_refuses_junk():
+    for ts in ["", "2018-06-01", "2018-06-01T12:30:15.Z",
+               "2018-06-01T12:30:15+2", None]:
+        try:
+            parse_time(ts)
+        except ValueError:
+            continue
+        assert False, ts
+
+
+def test_time_key_sorts_as_time():
+    stamps = ["2018-06-01T12:30:15.000001Z", "2018-06-01T12:30:15Z",
+              "2018-06-01T13:30:15.5+02:00", "2018-06-01T12:30:14.9"]
+    assert sorted(stamps, key=time_key) == [
+        "2018-06-01T13:30:15.5+02:00", "2018-06-01T12:30:14.9",
+        "2018-06-01T12:30:15Z", "2018-06-01T12:30:15.000001Z"]
+    assert time_key("2018-06-01T12:30:15.000001Z") == (
+        "2018-06-01T12:30:15.000001")
+
+
+def test_tag_describe():
+    assert Tag("d20180601").describe() == "Daily 2018_06_01"
+    assert Tag("w201822_x").describe() == "Weekly 2018_22_x"
+    assert Tag("r170").describe() == "Release 17.0"